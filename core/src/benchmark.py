@@ -0,0 +1,528 @@
+import argparse
+import asyncio
+import json
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable
+
+import lib.db
+import numpy as np
+import psycopg
+from lib.composition import Composition
+from lib.config import DATA_DIR
+from lib.db import ParallelWriter, encode_copy_batch, init_db
+from lib.features import calc_features, get_feature_tables
+from lib.game_data import get_game_data
+from lib.pipeline import NUM_WRITERS
+from lib.scoring import calc_scores, get_score_table, get_trait_matrix
+from lib.storage import PostgresStorage, SqliteStorage, Storage, process_pending
+from psycopg.conninfo import make_conninfo
+from psycopg.rows import dict_row
+
+import expand_comps
+import init_comp_champs
+from score_by_trait import (
+    TRAIT_WEIGHTS,
+    calc_score,
+    encode_scores,
+    init_trait_weights,
+    insert_scores,
+    score_columns,
+)
+
+BENCH_DB_NAME = "tft_bench"
+
+# Comps per micro-benchmark, sampled from the largest generated tier
+SAMPLE_SIZE = 20_000
+
+
+@dataclass
+class BenchResult:
+    name: str
+    size: int
+    rows: int
+
+    # One entry per repeat
+    seconds: list[float] = field(default_factory=list)
+
+    @property
+    def best(self) -> float:
+        return min(self.seconds)
+
+    @property
+    def rows_per_s(self) -> float:
+        return self.rows / self.best if self.best else 0
+
+    def to_json(self) -> dict:
+        return dict(
+            asdict(self),
+            best=self.best,
+            median=statistics.median(self.seconds),
+            rows_per_s=self.rows_per_s,
+            us_per_row=self.best / self.rows * 1e6 if self.rows else 0,
+        )
+
+
+def bench(
+    name: str,
+    size: int,
+    rows: int,
+    fn: Callable[[], Any],
+    repeats: int,
+    setup: Callable[[], Any] | None = None,
+) -> BenchResult:
+    """
+    Time fn() repeats times, setup() runs (untimed) before each repeat
+    """
+
+    result = BenchResult(name=name, size=size, rows=rows)
+    for _ in range(repeats):
+        if setup:
+            setup()
+
+        start = time.perf_counter()
+        fn()
+        result.seconds.append(time.perf_counter() - start)
+
+    print(
+        f"{name:<28} size {size}  {rows:>10,} rows  {result.best:8.3f}s  {result.rows_per_s:>14,.0f} rows/s"
+    )
+    return result
+
+
+def generate_tiers(max_size: int) -> dict[int, list[int]]:
+    """
+    The same tiers expand_comps.py generates, in memory
+    """
+
+    tiers = {
+        1: sorted(Composition.from_ids([id]).id for id in get_game_data().champions)
+    }
+    for size in range(2, max_size + 1):
+        tiers[size] = np.sort(expand_comps.expand_ids(tiers[size - 1])).tolist()
+
+    return tiers
+
+
+def bench_compute(
+    tiers: dict[int, list[int]], repeats: int, rng: random.Random
+) -> list[BenchResult]:
+    size = max(tiers)
+    sample = rng.sample(tiers[size], min(SAMPLE_SIZE, len(tiers[size])))
+    comps = [Composition(id) for id in sample]
+    id_lists = [c.ids for c in comps]
+    masks = np.array(sample, dtype=np.int64)
+
+    game = get_game_data()
+    matrix = get_trait_matrix(game.champions, game.traits)
+    score_table = get_score_table(matrix, game.traits, TRAIT_WEIGHTS)
+    feature_tables = get_feature_tables(matrix, game.champions, game.traits)
+
+    n = len(sample)
+    return [
+        bench(
+            "composition.from_ids",
+            size,
+            n,
+            lambda: [Composition.from_ids(ids) for ids in id_lists],
+            repeats,
+        ),
+        bench("composition.ids", size, n, lambda: [c.ids for c in comps], repeats),
+        bench(
+            "expand_comp",
+            size,
+            n,
+            lambda: [expand_comps.expand_comp(c) for c in comps],
+            repeats,
+        ),
+        bench(
+            "calc_score",
+            size,
+            n,
+            lambda: [calc_score(c, TRAIT_WEIGHTS) for c in comps],
+            repeats,
+        ),
+        bench(
+            "calc_scores",
+            size,
+            n,
+            lambda: calc_scores(matrix, score_table, masks),
+            repeats,
+        ),
+        bench(
+            "calc_features",
+            size,
+            n,
+            lambda: calc_features(feature_tables, masks),
+            repeats,
+        ),
+        bench(
+            "encode_copy_batch",
+            size,
+            n,
+            lambda: encode_copy_batch(
+                dict(id=("bigint", masks), size=("integer", size))
+            ),
+            repeats,
+        ),
+    ]
+
+
+def create_bench_db() -> str:
+    """
+    (Re)create a throwaway database next to the real one and point lib.db at it
+    """
+
+    with psycopg.connect(lib.db.DB_URL, autocommit=True) as conn:
+        conn.execute(f"DROP DATABASE IF EXISTS {BENCH_DB_NAME} WITH (FORCE)")
+        conn.execute(f"CREATE DATABASE {BENCH_DB_NAME}")
+
+    lib.db.DB_URL = make_conninfo(lib.db.DB_URL, dbname=BENCH_DB_NAME)
+    init_db().close()
+
+    return lib.db.DB_URL
+
+
+def drop_bench_db(url: str, original_url: str):
+    lib.db.DB_URL = original_url
+    with psycopg.connect(original_url, autocommit=True) as conn:
+        conn.execute(f"DROP DATABASE IF EXISTS {BENCH_DB_NAME} WITH (FORCE)")
+
+
+def bench_db(url: str, tiers: dict[int, list[int]], repeats: int) -> list[BenchResult]:
+    """
+    The COPY / DELETE paths of each script, at every generated tier size
+
+    Each repeat starts from the state the script would see,
+    eg the memberships of a tier are inserted after the tier and its todo rows exist
+    """
+
+    loop = asyncio.new_event_loop()
+    aconn = loop.run_until_complete(
+        psycopg.AsyncConnection.connect(url, row_factory=dict_row, autocommit=True)
+    )
+    db = init_db()
+    cursor = db.cursor()
+    writer = ParallelWriter(NUM_WRITERS)
+
+    def run(coro):
+        return loop.run_until_complete(coro)
+
+    def reset():
+        # Also empties every table referencing compositions
+        db.execute("TRUNCATE compositions CASCADE")
+
+    def load_tier(ids: list[int], size: int):
+        reset()
+        run(expand_comps.insert_tier(aconn, ids, size))
+
+    run(expand_comps.create_temp_insertion(aconn))
+
+    results: list[BenchResult] = []
+    for size, ids in tiers.items():
+        comps = [Composition(id) for id in ids]
+        masks = np.array(ids, dtype=np.int64)
+        scores = np.zeros(len(ids), dtype=np.float32)
+        n = len(ids)
+
+        def queue_merge():
+            run(expand_comps.insert_temp(aconn, masks))
+            run(expand_comps.dedupe_temp(aconn))
+            run(expand_comps.merge_temp(aconn))
+            run(expand_comps.truncate_temp(aconn))
+
+        def seed_expand_todos():
+            load_tier(ids, size)
+            db.execute(
+                "INSERT INTO needs_expansion SELECT id FROM compositions WHERE size = %s",
+                [size],
+            )
+
+        def in_transaction(fn: Callable[[], Any]):
+            def wrapped():
+                with db.transaction():
+                    fn()
+
+            return wrapped
+
+        results.extend(
+            [
+                bench(
+                    "expand.insert_tier",
+                    size,
+                    n,
+                    lambda: run(expand_comps.insert_tier(aconn, ids, size)),
+                    repeats,
+                    setup=reset,
+                ),
+                bench(
+                    "expand.write_tier",
+                    size,
+                    n,
+                    lambda: expand_comps.write_tier(writer, ids, size),
+                    repeats,
+                    setup=reset,
+                ),
+                bench("expand.queue_merge", size, n, queue_merge, repeats, setup=reset),
+                bench(
+                    "expand.delete_todos",
+                    size,
+                    n,
+                    lambda: run(expand_comps.delete_todos(aconn, comps)),
+                    repeats,
+                    setup=seed_expand_todos,
+                ),
+                bench(
+                    "memberships.copy",
+                    size,
+                    n,
+                    in_transaction(
+                        lambda: init_comp_champs.insert_comp_champs(ids, cursor)
+                    ),
+                    repeats,
+                    setup=lambda: load_tier(ids, size),
+                ),
+                bench(
+                    "memberships.delete_todos",
+                    size,
+                    n,
+                    in_transaction(lambda: init_comp_champs.delete_todos(ids, cursor)),
+                    repeats,
+                    setup=lambda: load_tier(ids, size),
+                ),
+                bench(
+                    "memberships.sql",
+                    size,
+                    n,
+                    in_transaction(
+                        lambda: init_comp_champs.insert_comp_champs_sql(cursor, size)
+                    ),
+                    repeats,
+                    setup=lambda: load_tier(ids, size),
+                ),
+                bench(
+                    "scores.copy",
+                    size,
+                    n,
+                    in_transaction(lambda: insert_scores(cursor, masks, scores)),
+                    repeats,
+                    setup=lambda: load_tier(ids, size),
+                ),
+                bench(
+                    "scores.parallel_copy",
+                    size,
+                    n,
+                    lambda: writer.copy(
+                        "scores_by_trait", encode_scores(masks, scores)
+                    ),
+                    repeats,
+                    setup=lambda: load_tier(ids, size),
+                ),
+            ]
+        )
+
+    reset()
+    writer.close()
+    run(aconn.close())
+    loop.close()
+    db.close()
+
+    return results
+
+
+def bench_storage(
+    storage: Storage, tiers: dict[int, list[int]], repeats: int
+) -> list[BenchResult]:
+    """
+    The Storage operations of pipeline.py --storage, to compare the backends
+    """
+
+    results: list[BenchResult] = []
+    for size, ids in tiers.items():
+        masks = np.array(ids, dtype=np.int64)
+        scores = np.zeros(len(ids), dtype=np.float32)
+        n = len(ids)
+
+        def insert_tier():
+            with storage.transaction():
+                storage.insert_tier(size, masks)
+
+        def load_tier():
+            storage.delete_tier(size)
+            insert_tier()
+
+        def fetch_all():
+            for _ in process_pending(
+                storage, "scores_by_trait", size, SAMPLE_SIZE, lambda ids: None
+            ):
+                pass
+
+        def insert_scores():
+            with storage.transaction():
+                storage.insert_rows("scores_by_trait", score_columns(masks, scores))
+
+        def mark_done():
+            with storage.transaction():
+                storage.mark_done("needs_champions", ids)
+
+        results.extend(
+            [
+                bench(
+                    f"{storage.name}.insert_tier",
+                    size,
+                    n,
+                    insert_tier,
+                    repeats,
+                    setup=lambda: storage.delete_tier(size),
+                ),
+                bench(
+                    f"{storage.name}.fetch_pending",
+                    size,
+                    n,
+                    fetch_all,
+                    repeats,
+                    setup=load_tier,
+                ),
+                bench(
+                    f"{storage.name}.insert_scores",
+                    size,
+                    n,
+                    insert_scores,
+                    repeats,
+                    setup=load_tier,
+                ),
+                bench(
+                    f"{storage.name}.mark_done",
+                    size,
+                    n,
+                    mark_done,
+                    repeats,
+                    setup=load_tier,
+                ),
+            ]
+        )
+        storage.delete_tier(size)
+
+    return results
+
+
+def get_metadata(args: argparse.Namespace) -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True
+        ).stdout.strip()
+    except OSError:
+        commit = None
+
+    return dict(
+        time=datetime.now().isoformat(),
+        commit=commit,
+        python=sys.version,
+        numpy=np.__version__,
+        platform=platform.platform(),
+        args={k: str(v) for k, v in vars(args).items()},
+    )
+
+
+def compare(results: list[dict], baseline_path: Path, threshold: float) -> bool:
+    """
+    Print the change in time per row against an earlier run, returns False on a regression
+    """
+
+    with open(baseline_path) as file:
+        baseline = {(r["name"], r["size"]): r for r in json.load(file)["results"]}
+
+    ok = True
+    for r in results:
+        old = baseline.get((r["name"], r["size"]))
+        if not old or not old["us_per_row"]:
+            continue
+
+        ratio = r["us_per_row"] / old["us_per_row"]
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  REGRESSION"
+            ok = False
+
+        print(f"{r['name']:<28} size {r['size']}  {ratio:6.2f}x{flag}")
+
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark expansion, scoring and the db write paths on the real tiers"
+    )
+    parser.add_argument(
+        "--max-size",
+        type=int,
+        default=5,
+        help="largest tier to generate (6 is 1.2M comps)",
+    )
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--no-db",
+        action="store_true",
+        help="only run the in-process / in-memory SQLite benchmarks",
+    )
+    parser.add_argument(
+        "--keep-db",
+        action="store_true",
+        help=f"don't drop the {BENCH_DB_NAME} database afterwards",
+    )
+    parser.add_argument("--output", type=Path)
+    parser.add_argument(
+        "--compare", type=Path, help="an earlier output file to compare against"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="slowdown (per row) that counts as a regression",
+    )
+    args = parser.parse_args()
+
+    init_trait_weights()
+    rng = random.Random(args.seed)
+
+    print(f"generating tiers up to size {args.max_size}")
+    tiers = generate_tiers(args.max_size)
+
+    results = bench_compute(tiers, args.repeats, rng)
+
+    with SqliteStorage() as storage:
+        results += bench_storage(storage, tiers, args.repeats)
+
+    if not args.no_db:
+        original_url = lib.db.DB_URL
+        url = create_bench_db()
+        try:
+            results += bench_db(url, tiers, args.repeats)
+            with PostgresStorage() as storage:
+                results += bench_storage(storage, tiers, args.repeats)
+        finally:
+            if not args.keep_db:
+                drop_bench_db(url, original_url)
+
+    output = args.output or DATA_DIR / "benchmarks" / f"{int(time.time())}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+
+    serialized = [r.to_json() for r in results]
+    with open(output, "w") as file:
+        json.dump(dict(meta=get_metadata(args), results=serialized), file, indent=2)
+    print(f"saved results to {output}")
+
+    if args.compare and not compare(serialized, args.compare, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,93 @@
+import argparse
 import asyncio
+import os
 import time
-from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from dataclasses import dataclass
 from functools import cached_property
-from typing import Iterable
+from itertools import repeat
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Sequence, TypeVar
 
+import numpy as np
 import psycopg
-from lib.composition import Composition
+from lib.composition import (
+    MAX_TEAM_SIZE,
+    Composition,
+    count_members,
+    get_components,
+    get_neighbors,
+)
 from lib.db import (
     DB_URL,
-    DbChampion,
-    DbTrait,
-    get_all_champions,
-    get_all_traits,
-    get_champions_by_trait,
+    CopyBatch,
+    ParallelWriter,
+    WorkSource,
+    acopy_batch,
+    amark_done,
+    connect_db,
+    copy_batch,
+    delete_tier,
+    encode_copy_batch,
     init_db,
+    read_tier_ids,
+)
+from lib.game_data import GameData, get_game_data, set_game_data
+from lib.metrics import (
+    METRICS,
+    add_metrics_args,
+    metrics_from_args,
+    record_utilization,
+    timed_call,
+)
+from lib.pipeline import MARK_TIER_DONE, NUM_WRITERS, get_done_tiers
+from lib.spill import (
+    DEFAULT_MAX_MEMORY,
+    DEFAULT_SPILL_DIR,
+    SpillSorter,
+    add_spill_args,
+    spill_from_args,
 )
-from lib.utils import print_elapsed
+from lib.utils import print_elapsed, to_batch_size, to_n_batches
+from numpy.typing import ArrayLike
 from psycopg.rows import dict_row
 from psycopg_pool import AsyncConnectionPool
 
-MAX_TEAM_SIZE = 8
+# Expected comp counts
+EXPECTED_TIER_SIZES = {
+    1: 60,
+    2: 317,
+    3: 2_272,
+    4: 18_275,
+    5: 152_422,
+    6: 1_260_036,
+    7: 10_055_919,
+    8: 76_112_903,
+}
 COMPS_PER_ITERATION = 300_000
+COMPS_PER_TIER_BATCH = 50_000
+
+# Comps per COPY when a spilled tier is inserted
+COMPS_PER_WRITE = 2_000_000
+
+N_WORKERS = os.cpu_count() or 1
+CHUNKS_PER_WORKER = 4
 
-_db = init_db()
-_cursor = _db.cursor()
+T = TypeVar("T")
+
+
+def create_pool() -> ProcessPoolExecutor:
+    """
+    Long-lived pool whose workers receive the lookup tables from the parent
+    instead of building them again
+    """
 
-ALL_CHAMPIONS = get_all_champions(_cursor)
-ALL_TRAITS = get_all_traits(_cursor)
-CHAMPIONS_BY_TRAIT = get_champions_by_trait(ALL_CHAMPIONS.values())
+    return ProcessPoolExecutor(
+        N_WORKERS,
+        initializer=set_game_data,
+        initargs=(get_game_data(),),
+    )
 
 
 @dataclass
@@ -37,92 +96,126 @@ class ExpandedComp:
     expansions: list[Composition]
 
     @cached_property
-    def hashes(self):
-        return [self.source.hash] + [c.hash for c in self.expansions]
+    def ids(self):
+        return [self.source.id] + [c.id for c in self.expansions]
 
 
-def get_comp_traits(comp: Composition) -> set[DbTrait]:
-    champs = [ALL_CHAMPIONS[id] for id in comp.ids]
+def expand_mask(mask: int, neighbors: list[int]) -> list[int]:
+    """
+    The comps of size N + 1 whose canonical parent is this comp
 
-    traits: set[DbTrait] = set()
-    for champ in champs:
-        for id in champ.traits:
-            traits.add(ALL_TRAITS[id])
+    Candidates are the champions sharing a trait with a member, ie the OR of the members'
+    neighbor masks. A comp's canonical parent is the comp minus its highest champion
+    that can be removed without disconnecting it, so every comp of size N + 1
+    comes from exactly one comp of size N and a whole tier expands without duplicates.
 
-    return traits
+    The child is canonical if removing any member higher than the added champion
+    disconnects it, ie if the added champion doesn't neighbor every component
+    the comp splits into without that member. The champions that do are a mask per
+    member, computed once per comp, so the candidates are checked with bit operations
+    """
 
+    candidates = get_neighbors(mask, neighbors) & ~mask
 
-def expand_comp(comp: Composition) -> ExpandedComp:
-    traits = get_comp_traits(comp)
+    members: list[int] = []
+    rest = mask
+    while rest:
+        bit = rest & -rest
+        rest ^= bit
+        members.append(bit)
+
+    # From the highest member down, the candidates between it and the member above
+    # are accepted unless a higher member stays removable with them added
+    accepted = 0
+    blocked = 0
+    below = -1
+    for member in reversed(members):
+        accepted |= candidates & below & ~((member << 1) - 1) & ~blocked
+
+        # Only the candidates below a member can be blocked by it
+        below = member - 1
+        if not candidates & below:
+            break
+
+        reconnecting = candidates
+        for component in get_components(mask ^ member, neighbors):
+            reconnecting &= get_neighbors(component, neighbors)
+        blocked |= reconnecting
+    accepted |= candidates & below & ~blocked
+
+    children: list[int] = []
+    while accepted:
+        bit = accepted & -accepted
+        accepted ^= bit
+        children.append(mask | bit)
+
+    return children
 
-    candidates: set[DbChampion] = set()
-    for t in traits:
-        for c in CHAMPIONS_BY_TRAIT[t.id]:
-            if c.id not in comp.ids:
-                candidates.add(c)
 
-    expansions = [comp.add(c.id) for c in candidates]
+def expand_comp(comp: Composition) -> ExpandedComp:
+    neighbors = get_game_data().champion_neighbors
+    expansions = [Composition(id) for id in expand_mask(comp.mask, neighbors)]
     return ExpandedComp(source=comp, expansions=expansions)
 
 
-async def insert_comps(comps: Iterable[Composition], conn: psycopg.AsyncConnection):
-    async with conn.cursor() as cursor:
-        async with cursor.copy("COPY compositions (id, size) FROM STDIN") as copy:
-            for cmp in comps:
-                await copy.write_row((cmp.hash, len(cmp)))
+def encode_comps(comps: Iterable[Composition]) -> CopyBatch:
+    comps = list(comps)
+    ids = np.array([c.id for c in comps], dtype=np.int64)
+    sizes = np.array([len(c) for c in comps], dtype=np.int32)
 
-        async with cursor.copy(
-            "COPY needs_expansion (id_composition) FROM STDIN"
-        ) as copy:
-            for cmp in comps:
-                await copy.write_row((cmp.hash,))
+    return encode_copy_batch(dict(id=("bigint", ids), size=("integer", sizes)))
 
-        async with cursor.copy(
-            "COPY needs_champions (id_composition) FROM STDIN"
-        ) as copy:
-            for cmp in comps:
-                await copy.write_row((cmp.hash,))
 
+def encode_todos(comp_ids: ArrayLike) -> CopyBatch:
+    return encode_copy_batch(dict(id_composition=("bigint", comp_ids)))
+
+
+async def insert_comps(comps: Iterable[Composition], conn: psycopg.AsyncConnection):
+    comps = list(comps)
+    comp_rows = encode_comps(comps)
+    todo_rows = encode_todos([c.id for c in comps])
 
-async def delete_todos(conn: psycopg.AsyncConnection, expanded: Iterable[Composition]):
     async with conn.cursor() as cursor:
-        await cursor.executemany(
-            """
-            DELETE FROM needs_expansion
-            WHERE id_composition = %s
-            """,
-            [(c.hash,) for c in expanded],
-        )
+        await acopy_batch(cursor, "compositions", comp_rows)
+        await acopy_batch(cursor, "needs_expansion", todo_rows)
+        await acopy_batch(cursor, "needs_champions", todo_rows)
+
 
+async def delete_todos(conn: psycopg.AsyncConnection, expanded: Iterable[Composition]):
+    await amark_done(conn, "needs_expansion", [c.id for c in expanded])
+
+
+def pending_expansions() -> WorkSource:
+    return WorkSource(
+        name="needs_expansion",
+        query="""
+            SELECT ne.id_composition id
+            FROM needs_expansion ne
+            INNER JOIN compositions c
+                ON c.id = ne.id_composition
+            WHERE
+                ne.id_composition > %(after)s
+                AND c.size < %(max_size)s
+            ORDER BY ne.id_composition
+            LIMIT %(limit)s
+            """,
+        batch_size=COMPS_PER_ITERATION,
+        params=dict(max_size=MAX_TEAM_SIZE),
+    )
 
-async def fetch_comps_to_expand(conn: psycopg.AsyncConnection, limit: int):
-    vals = [MAX_TEAM_SIZE]
-    limit_clause = ""
-    if limit and limit > 0:
-        limit_clause = "LIMIT %s" if limit and limit > 0 else ""
-        vals.append(limit)
 
-    rows = await (
-        await conn.execute(
-            f"""
-        SELECT c.id
-        FROM compositions c
-        INNER JOIN needs_expansion ne
-            ON ne.id_composition = c.id
-        WHERE c.size < %s
-        {limit_clause}
-        """,
-            vals,
-        )
-    ).fetchall()
+async def fetch_comps_to_expand(conn: psycopg.AsyncConnection, source: WorkSource):
+    with METRICS.phase("expand", "fetch") as timing:
+        ids = await source.anext_batch(conn)
+        timing.rows = len(ids)
 
     comps = [
         dict(
-            **r,
-            # Infer champions from hash instead of JOIN so we don't have to wait on the init_comp_champs script
-            comp=Composition([int(id) for id in r["id"].split(",")]),
+            id=id,
+            # Infer champions from id instead of JOIN so we don't have to wait on the init_comp_champs script
+            comp=Composition(id),
         )
-        for r in rows
+        for id in ids
     ]
 
     return comps
@@ -132,7 +225,7 @@ async def create_temp_insertion(conn: psycopg.AsyncConnection):
     await conn.execute(
         """
         CREATE TABLE IF NOT EXISTS temp_expand (
-            id      TEXT        PRIMARY KEY,
+            id      BIGINT      PRIMARY KEY,
             size    INTEGER     NOT NULL
         )
         """
@@ -141,11 +234,12 @@ async def create_temp_insertion(conn: psycopg.AsyncConnection):
     await conn.execute("TRUNCATE temp_expand")
 
 
-async def insert_temp(conn: psycopg.AsyncConnection, comps: Iterable[Composition]):
+async def insert_temp(conn: psycopg.AsyncConnection, comp_ids: np.ndarray):
+    rows = encode_copy_batch(
+        dict(id=("bigint", comp_ids), size=("integer", count_members(comp_ids)))
+    )
     async with conn.cursor() as cursor:
-        async with cursor.copy("COPY temp_expand (id, size) FROM STDIN") as copy:
-            for cmp in comps:
-                await copy.write_row((cmp.hash, len(cmp)))
+        await acopy_batch(cursor, "temp_expand", rows)
 
 
 async def dedupe_temp(conn: psycopg.AsyncConnection):
@@ -153,7 +247,9 @@ async def dedupe_temp(conn: psycopg.AsyncConnection):
         """
         DELETE FROM temp_expand te
         USING compositions c
-        WHERE c.id = te.id
+        WHERE
+            c.id = te.id
+            AND c.size = te.size
         """
     )
 
@@ -190,39 +286,63 @@ async def truncate_temp(conn: psycopg.AsyncConnection):
 
 async def process_expansions(
     conn: psycopg.AsyncConnection,
-    to_insert: list[Composition] | None = None,
+    to_insert: np.ndarray | None = None,
     to_delete: list[Composition] | None = None,
 ):
     if to_delete:
-        await delete_todos(conn, to_delete)
-
-    if to_insert:
-        await insert_temp(conn, to_insert)
-        await dedupe_temp(conn)
-        await merge_temp(conn)
-        await truncate_temp(conn)
+        with METRICS.phase("expand", "delete_todos") as timing:
+            timing.rows = len(to_delete)
+            await delete_todos(conn, to_delete)
+
+    if to_insert is not None and len(to_insert):
+        with METRICS.phase("expand", "insert_temp") as timing:
+            timing.rows = len(to_insert)
+            await insert_temp(conn, to_insert)
+        with METRICS.phase("expand", "dedupe_temp"):
+            await dedupe_temp(conn)
+        with METRICS.phase("expand", "merge_temp"):
+            await merge_temp(conn)
+        with METRICS.phase("expand", "truncate_temp"):
+            await truncate_temp(conn)
 
 
 def expand_db_comps(db_comps: list[dict]):
-    expanded_comps: list[ExpandedComp] = list()
-    for db_comp in db_comps:
-        cmp = db_comp["comp"]
-
-        ce = expand_comp(cmp)
-        expanded_comps.append(ce)
-
-    to_insert = set([cmp for ce in expanded_comps for cmp in ce.expansions])
-    to_delete = [ce.source for ce in expanded_comps]
+    to_delete: list[Composition] = [db_comp["comp"] for db_comp in db_comps]
+    to_insert = expand_ids([c.id for c in to_delete])
 
     return dict(to_insert=to_insert, to_delete=to_delete)
 
 
-async def calculate_updates(conn: psycopg.AsyncConnection) -> dict:
-    db_comps = await fetch_comps_to_expand(conn, limit=COMPS_PER_ITERATION)
+async def calculate_updates(
+    conn: psycopg.AsyncConnection, source: WorkSource, exe: ProcessPoolExecutor
+) -> dict:
+    db_comps = await fetch_comps_to_expand(conn, source)
+    chunks = to_n_batches(db_comps, N_WORKERS * CHUNKS_PER_WORKER)
 
     loop = asyncio.get_running_loop()
-    with ProcessPoolExecutor() as exe:
-        return await loop.run_in_executor(exe, expand_db_comps, db_comps)
+    with METRICS.phase("expand", "expand_db_comps") as timing:
+        timing.rows = len(db_comps)
+        results = await asyncio.gather(
+            *[
+                loop.run_in_executor(exe, timed_call, expand_db_comps, c)
+                for c in chunks
+                if c
+            ]
+        )
+
+    if results:
+        busy = sum(seconds for _, seconds in results)
+        record_utilization("workers", busy, timing.seconds, N_WORKERS, stage="expand")
+
+    # Children only come from their canonical parent so the chunks' results are disjoint
+    to_insert = np.concatenate(
+        [np.empty(0, dtype=np.int64)] + [r["to_insert"] for r, _ in results]
+    )
+    to_delete: list[Composition] = []
+    for r, _ in results:
+        to_delete.extend(r["to_delete"])
+
+    return dict(to_insert=to_insert, to_delete=to_delete)
 
 
 async def setup(conn: psycopg.AsyncConnection):
@@ -234,8 +354,8 @@ async def setup(conn: psycopg.AsyncConnection):
         print(f"Found existing comps in database, skipping initial seed phase")
     else:
         async with conn.transaction():
-            for champ in ALL_CHAMPIONS.values():
-                await insert_comps([Composition([champ.id])], conn)
+            for champ in get_game_data().champions.values():
+                await insert_comps([Composition.from_ids([champ.id])], conn)
 
     # Create temporary table for insertions (bc they need to be existence-checked)
     async with conn.transaction():
@@ -243,63 +363,360 @@ async def setup(conn: psycopg.AsyncConnection):
         await truncate_temp(conn)
 
 
-async def main():
-    async with AsyncConnectionPool(DB_URL, kwargs={"row_factory": dict_row}) as pool:
-        async with pool.connection() as conn:
-            await setup(conn)
-            # await conn.commit()
+def expand_ids(comp_ids: Sequence[int] | np.ndarray) -> np.ndarray:
+    """
+    The children of the comps, as int64s so workers send back one buffer
+    instead of pickling a Python int per comp
+    """
 
-    updates = dict()
+    neighbors = get_game_data().champion_neighbors
 
-    while True:
-        async with AsyncConnectionPool(
-            DB_URL, kwargs={"row_factory": dict_row}
-        ) as pool:
-            async with pool.connection() as conn:
-                start = time.time()
-                num_expanded = len(updates.get("to_delete", []))
-                num_created = len(updates.get("to_insert", []))
+    result: list[int] = []
+    for id in np.asarray(comp_ids, dtype=np.int64).tolist():
+        result.extend(expand_mask(id, neighbors))
 
-                print_elapsed(
-                    start,
-                    f"processing {num_expanded:,} comps that were expanded to {num_created:,} new comps",
-                )
-                [_, updates] = await asyncio.gather(
-                    process_expansions(conn, **updates),
-                    calculate_updates(conn),
-                )
+    return np.array(result, dtype=np.int64)
 
-                if not updates["to_insert"] and not updates["to_delete"]:
-                    print(f"no more comps of size < {MAX_TEAM_SIZE} to expand")
-                    break
 
-                elapsed = time.time() - start
-                avg = num_expanded / elapsed
-                print_elapsed(start, f"done ({avg:.1f} expansions/s)")
+def map_bounded(
+    exe: ProcessPoolExecutor,
+    fn: Callable[..., T],
+    batches: Iterable,
+    max_pending: int = N_WORKERS * CHUNKS_PER_WORKER,
+) -> Iterator[tuple[T, float]]:
+    """
+    exe.map(timed_call, repeat(fn), batches) with at most max_pending batches submitted
+    but not consumed, so results don't pile up in memory when the consumer falls behind
+    """
 
-                if not updates:
-                    break
+    pending: deque[Future] = deque()
+    for batch in batches:
+        pending.append(exe.submit(timed_call, fn, batch))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
 
-                # await conn.commit()
+    while pending:
+        yield pending.popleft().result()
 
 
-if __name__ == "__main__":
+def seed_tier(game: GameData) -> list[int]:
+    """
+    The size 1 tier, a comp for each champion
+    """
+
+    return sorted(Composition.from_ids([id]).id for id in game.champions)
+
+
+def expand_tier(
+    exe: ProcessPoolExecutor, tier: Sequence[int] | np.ndarray
+) -> np.ndarray:
+    # Each child only comes from its canonical parent, so the batches' results are disjoint.
+    # (Only adding champions with a higher id than the current max doesn't work
+    #  because removing the max champion can leave a comp that isn't trait-connected)
+    if not len(tier):
+        return np.empty(0, dtype=np.int64)
+
+    batches = to_batch_size(tier, COMPS_PER_TIER_BATCH)
+    size = len(Composition(int(tier[0]))) + 1
+
+    busy = 0.0
+    result: list[np.ndarray] = []
+    with METRICS.phase("expand", "expand_ids", size=size) as timing:
+        timing.rows = len(tier)
+        for ids, seconds in exe.map(timed_call, repeat(expand_ids), batches):
+            result.append(ids)
+            busy += seconds
+
+    record_utilization("workers", busy, timing.seconds, N_WORKERS, stage="expand")
+
+    with METRICS.phase("expand", "sort", size=size):
+        return np.sort(np.concatenate(result))
+
+
+def expand_tier_spilled(
+    exe: ProcessPoolExecutor,
+    tier: Sequence[int] | np.ndarray,
+    path: Path,
+    max_memory: int = DEFAULT_MAX_MEMORY,
+) -> np.ndarray:
+    """
+    expand_tier() with a memory budget, for tiers that don't fit in memory
+
+    The children are collected by a SpillSorter and the sorted tier is written to path
+    and returned memory-mapped, so it can be the next tier's parents without being loaded
     """
-    Expected comp counts
-        size   count
-        1	        60
-        2	       317
-        3	     2,272
-        4	    18,275
-        5	   152,422
-        6    1,260,036
-        7   10,055,919
-        8   76,112,903
+
+    if not len(tier):
+        return np.empty(0, dtype=np.int64)
+
+    batches = to_batch_size(tier, COMPS_PER_TIER_BATCH)
+    size = len(Composition(int(tier[0]))) + 1
+
+    busy = 0.0
+    with SpillSorter(max_memory, path.parent) as sorter:
+        with METRICS.phase("expand", "expand_ids", size=size) as timing:
+            timing.rows = len(tier)
+            for ids, seconds in map_bounded(exe, expand_ids, batches):
+                sorter.add(ids)
+                busy += seconds
+
+        record_utilization("workers", busy, timing.seconds, N_WORKERS, stage="expand")
+
+        with METRICS.phase("expand", "merge", size=size) as timing:
+            result = sorter.save(path)
+            timing.rows = len(result)
+
+        METRICS.gauge("spill_runs", len(sorter.runs), stage="expand", size=size)
+
+    return result
+
+
+async def fetch_tier(conn: psycopg.AsyncConnection, size: int) -> list[int]:
+    with METRICS.phase("expand", "fetch_tier", size=size) as timing:
+        rows = await (
+            await conn.execute(
+                """
+                SELECT id
+                FROM compositions
+                WHERE size = %s
+                """,
+                [size],
+            )
+        ).fetchall()
+        timing.rows = len(rows)
+
+    return sorted(r["id"] for r in rows)
+
+
+async def insert_tier(conn: psycopg.AsyncConnection, tier: list[int], size: int):
+    ids = np.array(tier, dtype=np.int64)
+    comp_rows = encode_copy_batch(dict(id=("bigint", ids), size=("integer", size)))
+    todo_rows = encode_todos(ids)
+
+    with METRICS.phase("expand", "copy", size=size) as timing:
+        timing.rows = len(tier)
+        async with conn.transaction():
+            async with conn.cursor() as cursor:
+                await acopy_batch(cursor, "compositions", comp_rows)
+                await acopy_batch(cursor, "needs_champions", todo_rows)
+
+
+def write_tier(writer: ParallelWriter, tier: Sequence[int] | np.ndarray, size: int):
+    """
+    insert_tier() split over several connections
+
+    The shards commit separately so an interrupted write leaves a partial tier,
+    see delete_tier()
     """
 
-    # import cProfile
-    # from pstats import SortKey
+    ids = np.array(tier, dtype=np.int64)
+    comp_rows = encode_copy_batch(dict(id=("bigint", ids), size=("integer", size)))
+    todo_rows = encode_todos(ids)
+
+    def write_shard(cursor: psycopg.Cursor, bounds: tuple[int, int]):
+        copy_batch(cursor, "compositions", comp_rows.slice(*bounds))
+        copy_batch(cursor, "needs_champions", todo_rows.slice(*bounds))
+
+    with METRICS.phase("expand", "copy", size=size) as timing:
+        timing.rows = len(tier)
+        writer.run(writer.shards(len(tier)), write_shard)
+
+
+def write_tier_chunks(
+    writer: ParallelWriter, tier: Sequence[int] | np.ndarray, size: int
+):
+    """
+    write_tier() a chunk at a time, so a tier is never encoded all at once
+    """
+
+    for start in range(0, len(tier), COMPS_PER_WRITE):
+        write_tier(writer, tier[start : start + COMPS_PER_WRITE], size)
+
+
+async def setup_tiers(
+    conn: psycopg.AsyncConnection, writer: ParallelWriter
+) -> tuple[int, Sequence[int] | np.ndarray]:
+    """
+    Find the largest complete tier in the db, seeding the first one if necessary
+    """
+
+    row = await (
+        await conn.execute(
+            """
+            SELECT MAX(c.size) size
+            FROM compositions c
+            INNER JOIN needs_expansion ne
+                ON ne.id_composition = c.id
+            WHERE c.size < %s
+            """,
+            [MAX_TEAM_SIZE],
+        )
+    ).fetchone()
+    if row and row["size"] is not None:
+        raise Exception(
+            f"Found unexpanded comps of size {row['size']} from the queue mode, finish those with --mode queue first"
+        )
+
+    with connect_db() as db:
+        done = get_done_tiers(db)
+        size = 0
+        while ("expand", size + 1) in done:
+            size += 1
+
+        # A tier is only marked done once every shard of its write has committed
+        row = db.execute("SELECT MAX(size) size FROM compositions").fetchone()
+        max_size = row["size"] if row and row["size"] is not None else 0
+        for partial in range(max_size, size, -1):
+            print(f"Found a partially inserted tier of size {partial}, deleting it")
+            delete_tier(db, partial)
+
+        if size:
+            print(f"Found existing comps in database, resuming from size {size}")
+            return size, read_tier_ids(db, size)
+
+    tier = seed_tier(get_game_data())
+    await asyncio.to_thread(write_tier, writer, tier, 1)
+    await conn.execute(MARK_TIER_DONE, ["expand", 1])
+
+    return 1, tier
+
+
+async def main_tiers(
+    num_writers: int,
+    max_memory: int | None = None,
+    spill_dir: Path = DEFAULT_SPILL_DIR,
+):
+    """
+    Generate each tier from the previous one in memory and bulk-load it in one pass
+
+    With max_memory (in bytes) each tier is expanded by expand_tier_spilled() instead,
+    into a file in spill_dir that's deleted once the next tier is done with it
+
+    Unlike the queue mode, needs_expansion is not used
+    """
+
+    spilled: list[Path] = []
+
+    async with await psycopg.AsyncConnection.connect(
+        DB_URL, row_factory=dict_row, autocommit=True
+    ) as conn:
+        with ParallelWriter(num_writers) as writer, create_pool() as exe:
+            size, tier = await setup_tiers(conn, writer)
+
+            try:
+                while size < MAX_TEAM_SIZE:
+                    start = time.time()
+
+                    print_elapsed(
+                        start, f"expanding {len(tier):,} comps of size {size}"
+                    )
+                    if max_memory:
+                        spill_dir.mkdir(parents=True, exist_ok=True)
+                        spilled.append(spill_dir / f"size_{size + 1}.ids")
+                        tier = expand_tier_spilled(exe, tier, spilled[-1], max_memory)
+                        if len(spilled) > 1:
+                            spilled.pop(0).unlink()
+                    else:
+                        tier = expand_tier(exe, tier)
+                    size += 1
+
+                    print_elapsed(
+                        start, f"inserting {len(tier):,} comps of size {size}"
+                    )
+                    await asyncio.to_thread(write_tier_chunks, writer, tier, size)
+                    await conn.execute(MARK_TIER_DONE, ["expand", size])
+
+                    elapsed = time.time() - start
+                    avg = len(tier) / elapsed
+                    print_elapsed(start, f"done ({avg:.1f} comps/s)")
+            finally:
+                for path in spilled:
+                    path.unlink(missing_ok=True)
+
+
+async def main():
+    async with AsyncConnectionPool(DB_URL, kwargs={"row_factory": dict_row}) as pool:
+        async with pool.connection() as conn:
+            await setup(conn)
+            # await conn.commit()
+
+    source = pending_expansions()
+    async with AsyncConnectionPool(DB_URL, kwargs={"row_factory": dict_row}) as pool:
+        async with pool.connection() as conn:
+            await source.aload(conn)
+
+    updates = dict()
+
+    with create_pool() as exe:
+        while True:
+            async with AsyncConnectionPool(
+                DB_URL, kwargs={"row_factory": dict_row}
+            ) as pool:
+                async with pool.connection() as conn:
+                    start = time.time()
+                    num_expanded = len(updates.get("to_delete", []))
+                    num_created = len(updates.get("to_insert", []))
+
+                    print_elapsed(
+                        start,
+                        f"processing {num_expanded:,} comps that were expanded to {num_created:,} new comps",
+                    )
+                    [_, updates_next] = await asyncio.gather(
+                        process_expansions(conn, **updates),
+                        calculate_updates(conn, source, exe),
+                    )
+
+                    METRICS.gauge(
+                        "queue_depth", len(updates_next["to_insert"]), stage="expand"
+                    )
+
+                    if updates.get("to_delete"):
+                        last_id = max(c.id for c in updates["to_delete"])
+                        await source.asave(conn, last_id)
+
+                    # The fetch ran alongside the previous batch's inserts so it may have missed them
+                    if num_created == 0 and not updates_next["to_delete"]:
+                        print(f"no more comps of size < {MAX_TEAM_SIZE} to expand")
+                        for size in range(1, MAX_TEAM_SIZE + 1):
+                            await conn.execute(MARK_TIER_DONE, ["expand", size])
+                        break
+
+                    elapsed = time.time() - start
+                    avg = num_expanded / elapsed
+                    print_elapsed(start, f"done ({avg:.1f} expansions/s)")
+
+                    updates = updates_next
+
+                    # await conn.commit()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--mode",
+        choices=["tiers", "queue"],
+        default="tiers",
+        help="tiers: expand in memory one size at a time. queue: expand in batches via the needs_expansion table",
+    )
+    parser.add_argument(
+        "--writers",
+        type=int,
+        default=NUM_WRITERS,
+        help="connections each tier is inserted over (tiers mode)",
+    )
+    parser.add_argument(
+        "--partitioned",
+        action="store_true",
+        help="when creating the tables, partition them by comp size",
+    )
+    add_spill_args(parser)
+    add_metrics_args(parser)
+    args = parser.parse_args()
 
-    # cProfile.run("main()", sort=SortKey.CUMULATIVE)
+    init_db(args.partitioned).close()
 
-    asyncio.run(main())
+    with metrics_from_args(args):
+        if args.mode == "tiers":
+            asyncio.run(main_tiers(args.writers, **spill_from_args(args)))
+        else:
+            asyncio.run(main())
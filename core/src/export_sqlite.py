@@ -0,0 +1,40 @@
+import argparse
+import time
+from pathlib import Path
+
+from lib.columnar import ColumnarStore
+from lib.config import DATA_DIR
+from lib.db import init_db
+from lib.export import export_columnar, export_sqlite
+from lib.utils import print_elapsed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--file",
+        type=Path,
+        default=DATA_DIR / "db.sqlite",
+        help="SQLite file for the web app (its DB_FILE)",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="delete the existing file instead of only exporting new tiers / scores",
+    )
+    parser.add_argument(
+        "--columnar",
+        type=Path,
+        metavar="DIR",
+        help="export the files written by pipeline.py --columnar instead of the db",
+    )
+    args = parser.parse_args()
+
+    if args.full:
+        args.file.unlink(missing_ok=True)
+
+    start = time.time()
+    if args.columnar:
+        export_columnar(ColumnarStore(args.columnar), args.file)
+    else:
+        export_sqlite(init_db(), args.file)
+    print_elapsed(start, f"exported to {args.file}")
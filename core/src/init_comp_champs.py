@@ -1,74 +1,234 @@
+import argparse
 import time
-from typing import Iterable
 
-from lib.db import get_all_champions, init_db
+import numpy as np
+from lib.composition import MAX_CHAMPION_ID, count_members
+from lib.db import (
+    Columns,
+    CopyBatch,
+    Database,
+    ParallelWriter,
+    WorkSource,
+    copy_batch,
+    encode_copy_batch,
+    init_db,
+    mark_done,
+    shard_bounds,
+)
+from lib.metrics import METRICS, add_metrics_args, metrics_from_args
+from lib.pipeline import add_batch_args, process_batches
 from lib.utils import print_elapsed
+from numpy.typing import ArrayLike
 from psycopg import Cursor
 
-db = init_db()
-cursor = db.cursor()
+COMPS_PER_ITERATION = 1_000_000
 
-ALL_CHAMPIONS = get_all_champions(cursor)
 
+def pending_champions(batch_size: int = COMPS_PER_ITERATION) -> WorkSource:
+    return WorkSource(
+        name="needs_champions",
+        query="""
+            SELECT id_composition id
+            FROM needs_champions
+            WHERE id_composition > %(after)s
+            ORDER BY id_composition
+            LIMIT %(limit)s
+            """,
+        batch_size=batch_size,
+    )
 
-def fetch_missing(limit=1_000_000):
-    rows = db.execute(
-        """
-        SELECT id_composition
-        FROM needs_champions c
-        LIMIT %s
-        """,
-        [limit],
+
+def comp_champ_columns(comp_ids: ArrayLike) -> Columns:
+    masks = np.asarray(comp_ids, dtype=np.int64)
+
+    # (comp, champion) pairs for every set bit
+    bits = np.arange(MAX_CHAMPION_ID + 1, dtype=np.int64)
+    is_member = (masks[:, None] >> bits) & 1 == 1
+    comp_idxs, champion_ids = np.nonzero(is_member)
+
+    return dict(
+        id_composition=("bigint", masks[comp_idxs]),
+        id_champion=("integer", champion_ids),
+        size=("integer", count_members(masks)[comp_idxs]),
     )
 
-    return [r["id_composition"] for r in rows]
 
+def encode_comp_champs(comp_ids: list[int]) -> CopyBatch:
+    return encode_copy_batch(comp_champ_columns(comp_ids))
+
+
+def insert_comp_champs(comp_ids: list[int], cursor: Cursor):
+    copy_batch(cursor, "composition_champions", encode_comp_champs(comp_ids))
 
-def insert_comp_champs(hashes: list[str], cursor: Cursor):
-    params: list[tuple[str, int]] = []
-    for hash in hashes:
-        ids = [int(id) for id in hash.split(",")]
 
-        for id in ids:
-            params.append((hash, id))
+def delete_todos(comp_ids: list[int], cursor: Cursor):
+    mark_done(cursor, "needs_champions", comp_ids)
 
-    with cursor.copy(
-        "COPY composition_champions (id_composition, id_champion) FROM STDIN"
-    ) as copy:
-        for p in params:
-            copy.write_row(p)
 
+# Claim a tier's todo markers and derive its memberships from the ids in the same statement
+_CLAIM_TIER = """
+    DELETE FROM needs_champions nc
+    USING compositions c
+    WHERE
+        c.id = nc.id_composition
+        AND c.size = %(size)s
+    RETURNING nc.id_composition, c.size
+"""
 
-def delete_todos(hashes: Iterable[str], cursor: Cursor):
-    cursor.executemany(
+
+def insert_comp_champs_sql(cursor: Cursor, size: int) -> int:
+    cursor.execute(
         f"""
-        DELETE FROM needs_champions
-        WHERE id_composition = %s
+        WITH done AS ({_CLAIM_TIER})
+        INSERT INTO composition_champions (id_composition, id_champion, size)
+        SELECT d.id_composition, ch.id, d.size
+        FROM done d
+        INNER JOIN champions ch
+            ON (d.id_composition >> ch.id) & 1 = 1
         """,
-        [(h,) for h in hashes],
+        dict(size=size),
     )
 
+    return cursor.rowcount
 
-def main():
-    while True:
-        start = time.time()
 
-        print_elapsed(start, "fetching")
-        missing = fetch_missing()
-        if not missing:
-            break
+def init_champions_column(db: Database):
+    """
+    Alternative to the composition_champions junction table,
+    "which comps contain X and Y" becomes "champions @> ARRAY[X, Y]::SMALLINT[]"
+    """
+
+    db.execute("ALTER TABLE compositions ADD COLUMN IF NOT EXISTS champions SMALLINT[]")
+    db.execute(
+        """
+        CREATE INDEX IF NOT EXISTS compositions_champions_idx
+        ON compositions USING GIN (champions)
+        """
+    )
+
+
+def update_champions_column(cursor: Cursor, size: int) -> int:
+    cursor.execute(
+        f"""
+        WITH done AS ({_CLAIM_TIER})
+        UPDATE compositions c
+        SET champions = ARRAY(
+            SELECT ch.id::SMALLINT
+            FROM champions ch
+            WHERE (c.id >> ch.id) & 1 = 1
+            ORDER BY ch.id
+        )
+        FROM done d
+        WHERE c.id = d.id_composition
+        """,
+        dict(size=size),
+    )
+
+    return cursor.rowcount
 
-        with db.transaction():
-            print_elapsed(start, f"inserting {len(missing):,} rows")
-            insert_comp_champs(missing, cursor)
 
-            print_elapsed(start, f"deleting todos")
-            delete_todos(missing, cursor)
+def get_pending_sizes(cursor: Cursor) -> list[int]:
+    rows = cursor.execute(
+        """
+        SELECT DISTINCT c.size
+        FROM needs_champions nc
+        INNER JOIN compositions c
+            ON c.id = nc.id_composition
+        ORDER BY c.size
+        """
+    ).fetchall()
+
+    return [r["size"] for r in rows]
+
+
+def main_sql(mode: str):
+    """
+    Populate memberships server-side, one statement per tier
+    """
+
+    db = init_db()
+    cursor = db.cursor()
+
+    if mode == "array":
+        init_champions_column(db)
+
+    for size in get_pending_sizes(cursor):
+        start = time.time()
+
+        print_elapsed(start, f"processing comps of size {size}")
+        with METRICS.phase("memberships", mode, size=size) as timing:
+            with db.transaction():
+                if mode == "array":
+                    count = update_champions_column(cursor, size)
+                else:
+                    count = insert_comp_champs_sql(cursor, size)
+            timing.rows = count
 
         elapsed = time.time() - start
-        avg = len(missing) / elapsed
-        print_elapsed(start, f"done ({avg:.1f} it/s)")
+        avg = count / elapsed
+        print_elapsed(start, f"done ({count:,} rows, {avg:.1f} it/s)")
+
+
+def main(batch_size: int, max_queued: int, num_writers: int):
+    """
+    Fetch, encode and COPY + delete todos run in parallel, a batch each
+    """
+
+    db = init_db()
+
+    # Split by comp so each shard deletes the todos of the memberships it wrote
+    Shard = tuple[list[int], CopyBatch]
+
+    def encode_shards(comp_ids: list[int]) -> list[Shard]:
+        return [
+            (comp_ids[start:end], encode_comp_champs(comp_ids[start:end]))
+            for start, end in shard_bounds(len(comp_ids), num_writers)
+        ]
+
+    def write_shard(cursor: Cursor, shard: Shard):
+        comp_ids, rows = shard
+        copy_batch(cursor, "composition_champions", rows)
+        delete_todos(comp_ids, cursor)
+
+    def write(writer: ParallelWriter, comp_ids: list[int], shards: list[Shard]):
+        writer.run(shards, write_shard)
+
+    start = time.time()
+    with ParallelWriter(num_writers) as writer:
+        for count in process_batches(
+            db,
+            pending_champions(batch_size),
+            encode_shards,
+            write,
+            "memberships",
+            writer,
+            max_queued,
+        ):
+            avg = count / (time.time() - start)
+            print_elapsed(start, f"{count:,} comps ({avg:.1f} it/s)")
+            start = time.time()
+
+    print_elapsed(start, "all comps have memberships")
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--mode",
+        choices=["sql", "array", "copy"],
+        default="sql",
+        help=(
+            "sql: fill composition_champions with one INSERT ... SELECT per tier. "
+            "array: fill a compositions.champions SMALLINT[] column (GIN indexed) instead. "
+            "copy: compute memberships in python and COPY them in batches"
+        ),
+    )
+    add_batch_args(parser, COMPS_PER_ITERATION)
+    add_metrics_args(parser)
+    args = parser.parse_args()
+
+    with metrics_from_args(args):
+        if args.mode == "copy":
+            main(args.batch_size, args.queue_depth, args.writers)
+        else:
+            main_sql(args.mode)
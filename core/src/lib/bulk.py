@@ -0,0 +1,111 @@
+import time
+
+from lib.db import Database, DatabaseOrCursor, is_partitioned
+from lib.metrics import METRICS
+from lib.utils import print_elapsed
+
+# Constraints that are only checks (the foreign keys) or that nothing reads while
+# the tiers are generated (composition_champions' primary key and unique index).
+# The primary keys of the other tables stay, they dedupe comps and back the pending-work queries
+_DEFERRABLE = """
+    SELECT
+        conname name,
+        conrelid::regclass::text table_name,
+        contype type,
+        pg_get_constraintdef(oid) definition
+    FROM pg_constraint
+    WHERE
+        -- Partitions inherit their constraints from the parent table
+        conparentid = 0
+        AND (
+            (
+                contype = 'f'
+                AND (
+                    confrelid IN (SELECT relid FROM pg_partition_tree('compositions'))
+                    OR conrelid IN (
+                        SELECT relid FROM pg_partition_tree('composition_champions')
+                    )
+                )
+            )
+            OR (
+                contype IN ('p', 'u')
+                AND conrelid = 'composition_champions'::regclass
+            )
+        )
+"""
+
+# Memory for the index builds / validation scans once the load is done
+MAINTENANCE_WORK_MEM = "2GB"
+
+
+def defer_constraints(db: Database) -> int:
+    """
+    Drop the deferrable constraints, remembering them in deferred_constraints
+
+    Every row of composition_champions otherwise updates two B-trees and runs two
+    foreign key checks, which gets slower as the tables grow.
+    Returns the number of constraints dropped
+    """
+
+    with db.transaction():
+        rows = db.execute(_DEFERRABLE).fetchall()
+
+        for r in rows:
+            db.execute(
+                """
+                INSERT INTO deferred_constraints (name, table_name, type, definition)
+                VALUES (%(name)s, %(table_name)s, %(type)s, %(definition)s)
+                """,
+                r,
+            )
+
+        # Foreign keys first, they can depend on the unique indexes
+        for r in sorted(rows, key=lambda r: r["type"] != "f"):
+            db.execute(f'ALTER TABLE {r["table_name"]} DROP CONSTRAINT {r["name"]}')
+
+    return len(rows)
+
+
+def get_deferred_constraints(db: DatabaseOrCursor) -> list[dict]:
+    return db.execute(
+        "SELECT name, table_name, type, definition FROM deferred_constraints"
+    ).fetchall()
+
+
+def restore_constraints(db: Database):
+    """
+    Rebuild whatever defer_constraints() dropped, each index is built with a single sort
+    and each foreign key is checked with a single scan instead of once per row
+
+    Every constraint is restored in its own transaction so an interrupted restore can be resumed
+    """
+
+    rows = get_deferred_constraints(db)
+    if not rows:
+        return
+
+    db.execute(f"SET maintenance_work_mem = '{MAINTENANCE_WORK_MEM}'")
+
+    # Indexes first, the foreign keys need them to validate quickly
+    for r in sorted(rows, key=lambda r: r["type"] == "f"):
+        start = time.time()
+        table, name = r["table_name"], r["name"]
+
+        with METRICS.phase("bulk", "restore", constraint=name), db.transaction():
+            # Partitioned tables don't support NOT VALID foreign keys
+            if r["type"] == "f" and not is_partitioned(db, table):
+                # NOT VALID + VALIDATE doesn't block writes to the referenced table while checking
+                db.execute(
+                    f'ALTER TABLE {table} ADD CONSTRAINT {name} {r["definition"]} NOT VALID'
+                )
+                db.execute(f"ALTER TABLE {table} VALIDATE CONSTRAINT {name}")
+            else:
+                db.execute(
+                    f'ALTER TABLE {table} ADD CONSTRAINT {name} {r["definition"]}'
+                )
+
+            db.execute("DELETE FROM deferred_constraints WHERE name = %s", [name])
+
+        print_elapsed(start, f"restored {name}")
+
+    db.execute("RESET maintenance_work_mem")
@@ -0,0 +1,100 @@
+import os
+import re
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+from lib.config import DATA_DIR
+from lib.scoring import score_checksum
+
+DEFAULT_COLUMNAR_DIR = DATA_DIR / "columnar"
+
+# column -> dtype
+COLUMNAR_COLUMNS = {
+    "ids": np.int64,
+    "scores": np.float32,
+}
+
+_TIER_DIR_PATTERN = re.compile(r"size_(\d+)")
+
+
+class ColumnarStore:
+    """
+    The tiers as flat files instead of Postgres tables, eg data/columnar/size_6/ids.npy
+
+    ids holds the tier's sorted comp bitmasks, the other columns are parallel to it.
+    Memberships aren't stored since they're the bits of the id.
+    Columns are plain .npy files so reads are memory-mapped (np.load(mmap_mode="r"))
+    and only touch the pages that are used.
+    A column is written under a temporary name and renamed when complete,
+    so an interrupted run never leaves a partial column behind
+    """
+
+    def __init__(self, path: Path = DEFAULT_COLUMNAR_DIR) -> None:
+        self.path = path
+
+    def column_path(self, size: int, name: str) -> Path:
+        return self.path / f"size_{size}" / f"{name}.npy"
+
+    def has_column(self, size: int, name: str) -> bool:
+        return self.column_path(size, name).exists()
+
+    def read_column(self, size: int, name: str) -> np.ndarray:
+        return np.load(self.column_path(size, name), mmap_mode="r")
+
+    @contextmanager
+    def write_column(self, size: int, name: str, num_rows: int) -> Iterator[np.ndarray]:
+        """
+        Yields a writable memory-mapped array that becomes the column once the block exits
+        """
+
+        path = self.column_path(size, name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+
+        array = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=COLUMNAR_COLUMNS[name], shape=(num_rows,)
+        )
+        try:
+            yield array
+            array.flush()
+        except BaseException:
+            del array
+            tmp_path.unlink(missing_ok=True)
+            raise
+
+        del array
+        os.replace(tmp_path, path)
+
+    def save_column(self, size: int, name: str, values: np.ndarray):
+        with self.write_column(size, name, len(values)) as array:
+            array[:] = values
+
+    def get_tier_counts(self) -> dict[int, tuple[int, int, int]]:
+        """
+        Returns size -> (number of comps, number of scores, score_checksum()),
+        like export.get_tier_counts()
+        """
+
+        counts: dict[int, tuple[int, int, int]] = dict()
+        if not self.path.exists():
+            return counts
+
+        for dir in self.path.iterdir():
+            match = _TIER_DIR_PATTERN.fullmatch(dir.name)
+            if not match:
+                continue
+
+            size = int(match.group(1))
+            if not self.has_column(size, "ids"):
+                continue
+
+            num_comps = len(self.read_column(size, "ids"))
+            if self.has_column(size, "scores"):
+                scores = self.read_column(size, "scores")
+                counts[size] = (num_comps, len(scores), score_checksum(scores))
+            else:
+                counts[size] = (num_comps, 0, 0)
+
+        return dict(sorted(counts.items()))
@@ -1,26 +1,120 @@
-from functools import cached_property
+from typing import Iterable
+
+import numpy as np
+
+# Compositions are stored as BIGINT (signed) so the sign bit is off-limits
+MAX_CHAMPION_ID = 62
+
+MAX_TEAM_SIZE = 8
+
+
+def ids_to_mask(ids: Iterable[int]) -> int:
+    mask = 0
+    for id in ids:
+        assert 0 <= id <= MAX_CHAMPION_ID, id
+        mask |= 1 << id
+
+    return mask
+
+
+def mask_to_ids(mask: int) -> list[int]:
+    ids: list[int] = []
+
+    id = 0
+    while mask:
+        if mask & 1:
+            ids.append(id)
+
+        mask >>= 1
+        id += 1
+
+    return ids
+
+
+def count_members(masks: np.ndarray) -> np.ndarray:
+    """
+    Size of each comp in an array of masks (a popcount per element)
+    """
+
+    bits = np.unpackbits(masks.astype(np.int64).view(np.uint8).reshape(-1, 8), axis=1)
+    return bits.sum(axis=1, dtype=np.int32)
+
+
+def get_neighbors(mask: int, neighbors: list[int]) -> int:
+    """
+    OR of the members' neighbor masks (see GameData.champion_neighbors)
+    """
+
+    result = 0
+    while mask:
+        bit = mask & -mask
+        mask ^= bit
+        result |= neighbors[bit.bit_length() - 1]
+
+    return result
+
+
+def get_components(mask: int, neighbors: list[int]) -> list[int]:
+    """
+    Split the comp into groups of members linked by chains of shared traits
+    """
+
+    components: list[int] = []
+    while mask:
+        seen = frontier = mask & -mask
+        while frontier:
+            bit = frontier & -frontier
+            frontier ^= bit
+
+            found = neighbors[bit.bit_length() - 1] & mask & ~seen
+            seen |= found
+            frontier |= found
+
+        components.append(seen)
+        mask &= ~seen
+
+    return components
 
 
 class Composition:
-    ids: list[int]
+    """
+    A set of champions, encoded as a bitmask where bit N is set if champion N is a member
+
+    The mask is also the composition's primary key in the database
+    """
+
+    mask: int
+
+    def __init__(self, mask: int = 0) -> None:
+        self.mask = mask
 
-    def __init__(self, ids: list[int]) -> None:
-        self.ids = ids
+    @classmethod
+    def from_ids(cls, ids: Iterable[int]) -> "Composition":
+        return cls(ids_to_mask(ids))
 
-    @cached_property
-    def hash(self) -> str:
-        ids_sorted = sorted(self.ids)
-        return ",".join(str(id) for id in ids_sorted)
+    @property
+    def id(self) -> int:
+        return self.mask
+
+    @property
+    def ids(self) -> list[int]:
+        return mask_to_ids(self.mask)
 
     def __hash__(self) -> int:
-        return hash(self.hash)
+        return hash(self.mask)
 
     def __eq__(self, value: object) -> bool:
-        return hash(value) == hash(self)
+        return isinstance(value, Composition) and value.mask == self.mask
+
+    def __contains__(self, id_champion: int) -> bool:
+        return bool(self.mask >> id_champion & 1)
 
     def add(self, id_champion: int):
-        ids = self.ids.copy() + [id_champion]
-        return Composition(ids)
+        assert 0 <= id_champion <= MAX_CHAMPION_ID, id_champion
+        return Composition(self.mask | 1 << id_champion)
 
     def __len__(self):
-        return len(self.ids)
+        return self.mask.bit_count()
+
+    def __repr__(self) -> str:
+        return f"Composition({self.ids})"
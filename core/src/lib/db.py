@@ -1,23 +1,71 @@
-from dataclasses import dataclass
-from typing import Iterable, TypeAlias, cast
-
+import os
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import (
+    AsyncIterator,
+    Callable,
+    Iterable,
+    Iterator,
+    Sized,
+    TypeAlias,
+    TypeVar,
+    cast,
+)
+
+import numpy as np
 import psycopg
 from data._champions import ALL_CHAMPIONS, ALL_TRAITS, Trait
+from lib.composition import MAX_TEAM_SIZE
+from numpy.typing import ArrayLike
 from psycopg.rows import dict_row
+from psycopg_pool import ConnectionPool
+
+T = TypeVar("T")
 
 Database: TypeAlias = psycopg.Connection
 DatabaseOrCursor: TypeAlias = Database | psycopg.Cursor
 
-DB_URL = "host=db dbname=postgres user=postgres password=postgres"
+# The docker-compose db service unless overridden
+DB_URL = os.environ.get(
+    "DB_URL", "host=db dbname=postgres user=postgres password=postgres"
+)
 
 
-def init_db() -> Database:
-    db = psycopg.connect(
+def connect_db() -> Database:
+    return psycopg.connect(
         DB_URL,
         row_factory=dict_row,
         autocommit=True,
     )
 
+
+# Arbitrary key for the advisory lock held while init_db() runs
+_INIT_DB_LOCK = 7_385_001
+
+
+def init_db(partitioned: bool = False) -> Database:
+    """
+    Create any missing tables
+
+    partitioned only applies to a new database, it creates the tables with
+    one partition per comp size (see _init_partitioned_tables())
+    """
+
+    db = connect_db()
+
+    # Several hosts can start at once (pipeline.py --distributed)
+    db.execute("SELECT pg_advisory_lock(%s)", [_INIT_DB_LOCK])
+    try:
+        _init_tables(db, partitioned)
+        _init_data(db)
+        db.commit()
+    finally:
+        db.execute("SELECT pg_advisory_unlock(%s)", [_INIT_DB_LOCK])
+
+    return db
+
+
+def _init_tables(db: Database, partitioned: bool):
     db.execute(
         """
         CREATE TABLE IF NOT EXISTS champions (
@@ -69,10 +117,24 @@ def init_db() -> Database:
         """
     )
 
+    _migrate_text_ids(db)
+
+    row = db.execute("SELECT to_regclass('compositions') oid").fetchone()
+    if partitioned and row and row["oid"] is None:
+        _init_partitioned_tables(db)
+
+    # A partitioned compositions has no unique index on id alone to reference
+    # (every unique index has to contain the partition key)
+    composition_fk = (
+        ", FOREIGN KEY (id_composition) REFERENCES compositions(id)"
+        if not is_partitioned(db, "compositions")
+        else ""
+    )
+
     db.execute(
         """
         CREATE TABLE IF NOT EXISTS compositions (
-            id              TEXT        PRIMARY KEY,
+            id              BIGINT      PRIMARY KEY,
 
             size            INTEGER     NOT NULL
         )
@@ -82,8 +144,9 @@ def init_db() -> Database:
     db.execute(
         """
         CREATE TABLE IF NOT EXISTS composition_champions (
-            id_composition      TEXT        NOT NULL,
+            id_composition      BIGINT      NOT NULL,
             id_champion         INTEGER     NOT NULL,
+            size                INTEGER,
 
             FOREIGN KEY (id_composition) REFERENCES compositions(id),
             FOREIGN KEY (id_champion) REFERENCES champions(id),
@@ -97,7 +160,8 @@ def init_db() -> Database:
     db.execute(
         """
         CREATE TABLE IF NOT EXISTS scores_by_trait (
-            id_composition      TEXT        PRIMARY KEY,
+            id_composition      BIGINT      PRIMARY KEY,
+            size                INTEGER,
 
             score               REAL        NOT NULL,
 
@@ -108,31 +172,356 @@ def init_db() -> Database:
 
     db.execute(
         """
-        CREATE TABLE IF NOT EXISTS needs_expansion (
-            id_composition		TEXT		PRIMARY KEY,
-            
-            FOREIGN KEY (id_composition) REFERENCES compositions(id)
+        CREATE TABLE IF NOT EXISTS scoring_profiles (
+            id                  SERIAL      PRIMARY KEY,
+
+            name                TEXT        NOT NULL,
+            version             INTEGER     NOT NULL    DEFAULT 0,
+            scored_version      INTEGER     NOT NULL    DEFAULT -1,
+            started_version     INTEGER,
+
+            UNIQUE (name)
+        )
+        """
+    )
+
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS scoring_profile_weights (
+            id_profile      INTEGER     NOT NULL,
+            id_trait        INTEGER     NOT NULL,
+
+            weights         REAL[],
+            version         INTEGER     NOT NULL,
+
+            FOREIGN KEY (id_profile) REFERENCES scoring_profiles(id),
+            FOREIGN KEY (id_trait) REFERENCES traits(id),
+            PRIMARY KEY (id_profile, id_trait)
         )
         """
     )
 
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS scores (
+            id_profile          INTEGER     NOT NULL,
+            id_composition      BIGINT      NOT NULL,
+
+            score               REAL        NOT NULL,
+
+            FOREIGN KEY (id_profile) REFERENCES scoring_profiles(id),
+            PRIMARY KEY (id_profile, id_composition)
+            {composition_fk}
+        )
+        """.format(
+            composition_fk=composition_fk
+        )
+    )
+
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS needs_expansion (
+            id_composition		BIGINT		PRIMARY KEY
+            {composition_fk}
+        )
+        """.format(
+            composition_fk=composition_fk
+        )
+    )
+
     db.execute(
         """
         CREATE TABLE IF NOT EXISTS needs_champions (
-            id_composition		TEXT		PRIMARY KEY,
-            
-            FOREIGN KEY (id_composition) REFERENCES compositions(id)
+            id_composition		BIGINT		PRIMARY KEY
+            {composition_fk}
+        )
+        """.format(
+            composition_fk=composition_fk
+        )
+    )
+
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS work_checkpoints (
+            name        TEXT        PRIMARY KEY,
+
+            last_id     BIGINT      NOT NULL
+        )
+        """
+    )
+
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS pipeline_tiers (
+            stage       TEXT        NOT NULL,
+            size        INTEGER     NOT NULL,
+
+            PRIMARY KEY (stage, size)
+        )
+        """
+    )
+
+    # Id ranges of a tier claimed by the workers of pipeline.py --distributed (see lib/leases.py),
+    # the range is (first_id, last_id]
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS work_leases (
+            stage       TEXT            NOT NULL,
+            size        INTEGER         NOT NULL,
+            first_id    BIGINT          NOT NULL,
+
+            last_id     BIGINT          NOT NULL,
+            worker      TEXT,
+            expires_at  TIMESTAMPTZ,
+            done        BOOLEAN         NOT NULL    DEFAULT FALSE,
+
+            PRIMARY KEY (stage, size, first_id)
+        )
+        """
+    )
+
+    # Constraints dropped for a bulk load (see lib/bulk.py), restored afterwards
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS deferred_constraints (
+            name            TEXT        PRIMARY KEY,
+
+            table_name      TEXT        NOT NULL,
+            type            TEXT        NOT NULL,
+            definition      TEXT        NOT NULL
         )
         """
     )
 
+    # Added for partitioning by size, rows from before are NULL
+    for table in ["composition_champions", "scores_by_trait"]:
+        db.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS size INTEGER")
+
+    # For walking a single tier in id order,
+    # a partitioned compositions' primary key already covers it
+    if not is_partitioned(db, "compositions"):
+        db.execute(
+            "CREATE INDEX IF NOT EXISTS compositions_size_id_idx ON compositions (size, id)"
+        )
+
     db.execute("ALTER USER postgres SET work_mem TO '5GB'")
 
-    _init_data(db)
 
-    db.commit()
+# Tables with one partition per comp size, created by init_db(partitioned=True)
+PARTITIONED_TABLES = ["compositions", "composition_champions", "scores_by_trait"]
 
-    return db
+
+def _init_partitioned_tables(db: Database):
+    """
+    compositions and the tables holding a row (or rows) per comp, list-partitioned by size
+
+    A size is a function of the id so (id, size) is as unique as id.
+    Queries on one tier only touch its partition and a tier can be redone with a TRUNCATE
+    """
+
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS compositions (
+            id              BIGINT      NOT NULL,
+
+            size            INTEGER     NOT NULL,
+
+            PRIMARY KEY (id, size)
+        ) PARTITION BY LIST (size)
+        """
+    )
+
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS composition_champions (
+            id_composition      BIGINT      NOT NULL,
+            id_champion         INTEGER     NOT NULL,
+            size                INTEGER     NOT NULL,
+
+            FOREIGN KEY (id_champion) REFERENCES champions(id),
+            PRIMARY KEY (id_champion, id_composition, size),
+
+            UNIQUE (id_composition, id_champion, size)
+        ) PARTITION BY LIST (size)
+        """
+    )
+
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS scores_by_trait (
+            id_composition      BIGINT      NOT NULL,
+            size                INTEGER     NOT NULL,
+
+            score               REAL        NOT NULL,
+
+            PRIMARY KEY (id_composition, size)
+        ) PARTITION BY LIST (size)
+        """
+    )
+
+    for size in range(1, MAX_TEAM_SIZE + 1):
+        for table in PARTITIONED_TABLES:
+            db.execute(
+                f"""
+                CREATE TABLE {get_partition(table, size)}
+                PARTITION OF {table} FOR VALUES IN ({size})
+                """
+            )
+
+        # Between partitions rather than the parents,
+        # so a tier's partitions can be truncated together
+        for table in ["composition_champions", "scores_by_trait"]:
+            db.execute(
+                f"""
+                ALTER TABLE {get_partition(table, size)}
+                ADD FOREIGN KEY (id_composition, size)
+                REFERENCES {get_partition("compositions", size)} (id, size)
+                """
+            )
+
+
+def get_partition(table: str, size: int) -> str:
+    return f"{table}_{size}"
+
+
+def is_partitioned(db: DatabaseOrCursor, table: str = "compositions") -> bool:
+    row = db.execute(
+        "SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", [table]
+    ).fetchone()
+    return bool(row and row["relkind"] == "p")
+
+
+# Per-comp tables that aren't partitioned, cleared row by row when a tier is deleted
+_TIER_DERIVED_TABLES = [
+    "needs_expansion",
+    "needs_champions",
+    "scores",
+]
+
+
+def count_tier_rows(db: Database, size: int) -> dict[str, int]:
+    """
+    Rows per table that delete_tier() would remove, the tables without any are left out
+    """
+
+    row = db.execute(
+        "SELECT COUNT(*) count FROM compositions WHERE size = %s", [size]
+    ).fetchone()
+    if not row or not row["count"]:
+        return dict()
+
+    counts = dict(compositions=row["count"])
+    for table in ["composition_champions", "scores_by_trait"] + _TIER_DERIVED_TABLES:
+        row = db.execute(
+            f"""
+            SELECT COUNT(*) count
+            FROM {table} t
+            JOIN compositions c ON c.id = t.id_composition
+            WHERE c.size = %s
+            """,
+            [size],
+        ).fetchone()
+        if row and row["count"]:
+            counts[table] = row["count"]
+
+    return counts
+
+
+def delete_tier(db: Database, size: int):
+    """
+    Remove a tier's comps and everything derived from them,
+    eg whatever an interrupted write of the tier committed
+
+    In a partitioned db this is a TRUNCATE of the tier's partitions
+    instead of a DELETE that has to find the tier's rows
+    """
+
+    with db.transaction():
+        for table in _TIER_DERIVED_TABLES:
+            db.execute(
+                f"""
+                DELETE FROM {table} t
+                USING compositions c
+                WHERE
+                    c.id = t.id_composition
+                    AND c.size = %s
+                """,
+                [size],
+            )
+
+        if is_partitioned(db, "compositions"):
+            partitions = [get_partition(t, size) for t in PARTITIONED_TABLES]
+            db.execute(f"TRUNCATE {', '.join(partitions)}")
+        else:
+            for table in ["composition_champions", "scores_by_trait"]:
+                db.execute(
+                    f"""
+                    DELETE FROM {table} t
+                    USING compositions c
+                    WHERE
+                        c.id = t.id_composition
+                        AND c.size = %s
+                    """,
+                    [size],
+                )
+            db.execute("DELETE FROM compositions WHERE size = %s", [size])
+
+        db.execute("DELETE FROM pipeline_tiers WHERE size = %s", [size])
+        db.execute("DELETE FROM work_leases WHERE size = %s", [size])
+
+
+COMPOSITION_TABLES = [
+    "composition_champions",
+    "scores_by_trait",
+    "needs_expansion",
+    "needs_champions",
+]
+
+
+def _migrate_text_ids(db: Database):
+    """
+    Convert composition ids from comma-joined champion ids ("3,17,42") to bitmasks
+    """
+
+    row = db.execute(
+        """
+        SELECT data_type FROM information_schema.columns
+        WHERE table_name = 'compositions' AND column_name = 'id'
+        """
+    ).fetchone()
+    if not row or row["data_type"] != "text":
+        return
+
+    print("Migrating composition ids from TEXT to BIGINT bitmasks")
+
+    with db.transaction():
+        db.execute(
+            """
+            CREATE OR REPLACE FUNCTION pg_temp.hash_to_mask(hash TEXT) RETURNS BIGINT AS $$
+                SELECT COALESCE(SUM(1::BIGINT << id::INTEGER), 0)::BIGINT
+                FROM unnest(string_to_array(hash, ',')) id
+            $$ LANGUAGE SQL IMMUTABLE
+            """
+        )
+
+        for table in COMPOSITION_TABLES:
+            db.execute(
+                f"ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {table}_id_composition_fkey"
+            )
+
+        db.execute(
+            "ALTER TABLE compositions ALTER COLUMN id TYPE BIGINT USING pg_temp.hash_to_mask(id)"
+        )
+        db.execute("DROP TABLE IF EXISTS temp_expand")
+
+        for table in COMPOSITION_TABLES:
+            db.execute(
+                f"""
+                ALTER TABLE {table}
+                    ALTER COLUMN id_composition TYPE BIGINT USING pg_temp.hash_to_mask(id_composition),
+                    ADD FOREIGN KEY (id_composition) REFERENCES compositions(id)
+                """
+            )
 
 
 def _init_data(db: Database):
@@ -201,7 +590,7 @@ class DbTrait:
 def get_all_traits(db: DatabaseOrCursor) -> dict[int, DbTrait]:
     rows = db.execute(
         """
-        SELECT t.id, t.name, ARRAY_AGG(thresh.threshold) thresholds FROM traits t
+        SELECT t.id, t.name, ARRAY_AGG(thresh.threshold ORDER BY thresh.threshold) thresholds FROM traits t
         LEFT JOIN trait_thresholds thresh
         ON thresh.id_trait = t.id
         GROUP BY t.id
@@ -217,6 +606,8 @@ class DbChampion:
     id: int
     cost: int
     name: str
+    range: int
+    uses_ap: bool
 
     traits: list[int]
 
@@ -227,7 +618,7 @@ class DbChampion:
 def get_all_champions(db: DatabaseOrCursor) -> dict[int, DbChampion]:
     rows = db.execute(
         """
-        SELECT c.id, c.cost, c.name, ARRAY_AGG(t.id_trait) as traits FROM champions c
+        SELECT c.id, c.cost, c.name, c.range, c.uses_ap, ARRAY_AGG(t.id_trait) as traits FROM champions c
         LEFT JOIN champion_traits t ON t.id_champion = c.id
         GROUP BY c.id 
         """
@@ -248,3 +639,375 @@ def get_champions_by_trait(
             result[trait].append(champ)
 
     return result
+
+
+@dataclass
+class WorkSource:
+    """
+    Streams the ids of pending work in fixed-size batches, in ascending id order
+
+    Each batch is a keyset page ("WHERE id > %(after)s ORDER BY id LIMIT %(limit)s")
+    so every fetch is an index range scan that starts where the last one stopped,
+    instead of rescanning the rows that were already processed.
+
+    Rows can be added behind the cursor while a script runs (eg new comps), so when
+    a pass reaches the end it wraps around, and it's only exhausted after a pass that
+    finds nothing. Sources whose rows don't disappear once processed must set wrap=False.
+
+    The query must select an "id" column and use the %(after)s and %(limit)s params.
+    Call save() in the same transaction that completes a batch to checkpoint it,
+    a restarted script then resumes after the last completed batch.
+    """
+
+    name: str
+    query: str
+    batch_size: int
+    params: dict = field(default_factory=dict)
+    wrap: bool = True
+
+    last_id: int = -1
+    wrapped: bool = False
+
+    def _params(self) -> dict:
+        return dict(self.params, after=self.last_id, limit=self.batch_size)
+
+    def _advance(self, ids: list[int]) -> bool:
+        """
+        Returns whether to fetch again (because the cursor wrapped around)
+        """
+
+        if ids:
+            self.last_id = ids[-1]
+            self.wrapped = False
+            return False
+        elif not self.wrap or self.last_id < 0 or self.wrapped:
+            self.last_id = -1
+            return False
+        else:
+            self.last_id = -1
+            self.wrapped = True
+            return True
+
+    def load(self, db: DatabaseOrCursor):
+        row = db.execute(
+            "SELECT last_id FROM work_checkpoints WHERE name = %s", [self.name]
+        ).fetchone()
+        if row:
+            self.last_id = row["last_id"]
+
+    def save(self, db: DatabaseOrCursor, last_id: int | None = None):
+        last_id = self.last_id if last_id is None else last_id
+        db.execute(_SAVE_CHECKPOINT, [self.name, last_id])
+
+    def next_batch(self, db: DatabaseOrCursor) -> list[int]:
+        while True:
+            rows = db.execute(self.query, self._params()).fetchall()
+            ids = [r["id"] for r in rows]
+
+            if not self._advance(ids):
+                return ids
+
+    def scan(self, db: DatabaseOrCursor) -> Iterator[list[int]]:
+        """
+        One pass from last_id to the end, without wrapping around
+        """
+
+        while rows := db.execute(self.query, self._params()).fetchall():
+            ids = [r["id"] for r in rows]
+            self.last_id = ids[-1]
+            yield ids
+
+    def batches(self, db: DatabaseOrCursor) -> Iterator[list[int]]:
+        self.load(db)
+
+        while ids := self.next_batch(db):
+            yield ids
+
+        self.save(db)
+
+    async def aload(self, conn: psycopg.AsyncConnection):
+        row = await (
+            await conn.execute(
+                "SELECT last_id FROM work_checkpoints WHERE name = %s", [self.name]
+            )
+        ).fetchone()
+        if row:
+            self.last_id = row["last_id"]
+
+    async def asave(self, conn: psycopg.AsyncConnection, last_id: int | None = None):
+        last_id = self.last_id if last_id is None else last_id
+        await conn.execute(_SAVE_CHECKPOINT, [self.name, last_id])
+
+    async def anext_batch(self, conn: psycopg.AsyncConnection) -> list[int]:
+        while True:
+            rows = await (await conn.execute(self.query, self._params())).fetchall()
+            ids = [r["id"] for r in rows]
+
+            if not self._advance(ids):
+                return ids
+
+    async def abatches(self, conn: psycopg.AsyncConnection) -> AsyncIterator[list[int]]:
+        await self.aload(conn)
+
+        while ids := await self.anext_batch(conn):
+            yield ids
+
+        await self.asave(conn)
+
+
+_MARK_DONE = "DELETE FROM {table} WHERE id_composition = ANY(%s::BIGINT[])"
+
+
+def mark_done(db: DatabaseOrCursor, table: str, comp_ids: list[int]):
+    """
+    Remove a whole batch of todo markers (eg from needs_champions) in one statement
+    """
+
+    db.execute(_MARK_DONE.format(table=table), [comp_ids])
+
+
+async def amark_done(conn: psycopg.AsyncConnection, table: str, comp_ids: list[int]):
+    await conn.execute(_MARK_DONE.format(table=table), [comp_ids])
+
+
+_SAVE_CHECKPOINT = """
+    INSERT INTO work_checkpoints (name, last_id)
+    VALUES (%s, %s)
+    ON CONFLICT (name) DO UPDATE SET last_id = EXCLUDED.last_id
+"""
+
+
+# Postgres column type -> big-endian numpy type with the same binary COPY representation
+BINARY_COPY_TYPES = {
+    "smallint": ">i2",
+    "integer": ">i4",
+    "bigint": ">i8",
+    "real": ">f4",
+    "double precision": ">f8",
+}
+
+_COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + b"\x00\x00\x00\x00" + b"\x00\x00\x00\x00"
+_COPY_TRAILER = b"\xff\xff"
+_COPY_CHUNK_SIZE = 64 * 1024 * 1024
+
+
+@dataclass
+class CopyBatch:
+    """
+    Rows pre-encoded in Postgres' binary COPY format
+
+    The same batch can be written to any table with matching columns,
+    eg needs_expansion and needs_champions
+    """
+
+    columns: list[str]
+    data: bytes
+    num_rows: int
+
+    def statement(self, table: str) -> str:
+        return f"COPY {table} ({', '.join(self.columns)}) FROM STDIN (FORMAT BINARY)"
+
+    def chunks(self) -> Iterator[memoryview]:
+        view = memoryview(self.data)
+        for start in range(0, len(view), _COPY_CHUNK_SIZE):
+            yield view[start : start + _COPY_CHUNK_SIZE]
+
+    def slice(self, start: int, end: int) -> "CopyBatch":
+        """
+        Rows start..end as their own batch, rows are fixed-width so nothing is re-encoded
+        """
+
+        if not self.num_rows:
+            return self
+
+        body = len(self.data) - len(_COPY_HEADER) - len(_COPY_TRAILER)
+        row_size = body // self.num_rows
+        offset = len(_COPY_HEADER)
+
+        return CopyBatch(
+            columns=self.columns,
+            data=_COPY_HEADER
+            + self.data[offset + start * row_size : offset + end * row_size]
+            + _COPY_TRAILER,
+            num_rows=end - start,
+        )
+
+
+def _copy_row_dtype(columns: dict[str, str]) -> np.dtype:
+    fields: list[tuple[str, str]] = [("num_fields", ">i2")]
+    for name, pg_type in columns.items():
+        fields.append((f"{name}_length", ">i4"))
+        fields.append((name, BINARY_COPY_TYPES[pg_type]))
+
+    return np.dtype(fields)
+
+
+# column -> (Postgres type, values), the format of encode_copy_batch()
+Columns: TypeAlias = dict[str, tuple[str, ArrayLike]]
+
+
+def encode_copy_batch(columns: Columns) -> CopyBatch:
+    """
+    Encode whole columns at once, eg encode_copy_batch(dict(id=("bigint", ids), size=("integer", sizes)))
+
+    Every tuple is a fixed-width record (field count, then a length + value per column)
+    so the batch is built as a single numpy structured array instead of row by row
+    """
+
+    dtype = _copy_row_dtype({name: pg_type for name, (pg_type, _) in columns.items()})
+
+    # Scalars (eg a tier's size) are broadcast
+    num_rows = 0
+    for _, values in columns.values():
+        if np.ndim(values) > 0:
+            num_rows = len(cast(Sized, values))
+
+    rows = np.empty(num_rows, dtype=dtype)
+    rows["num_fields"] = len(columns)
+    for name, (pg_type, values) in columns.items():
+        rows[f"{name}_length"] = np.dtype(BINARY_COPY_TYPES[pg_type]).itemsize
+        rows[name] = values
+
+    return CopyBatch(
+        columns=list(columns),
+        data=_COPY_HEADER + rows.tobytes() + _COPY_TRAILER,
+        num_rows=num_rows,
+    )
+
+
+def copy_batch(cursor: psycopg.Cursor, table: str, batch: CopyBatch):
+    with cursor.copy(batch.statement(table)) as copy:
+        for chunk in batch.chunks():
+            copy.write(chunk)
+
+
+async def acopy_batch(cursor: psycopg.AsyncCursor, table: str, batch: CopyBatch):
+    async with cursor.copy(batch.statement(table)) as copy:
+        for chunk in batch.chunks():
+            await copy.write(chunk)
+
+
+def shard_bounds(num_rows: int, num_shards: int) -> list[tuple[int, int]]:
+    """
+    Split rows 0..num_rows into (at most) num_shards contiguous, non-empty ranges
+    """
+
+    num_shards = max(min(num_shards, num_rows), 1)
+    bounds = [num_rows * idx // num_shards for idx in range(num_shards + 1)]
+    return list(zip(bounds, bounds[1:]))
+
+
+class ParallelWriter:
+    """
+    Writes a batch as several shards at once, each on its own connection,
+    so a bulk load isn't capped at what a single backend can ingest
+
+    Batches are sorted by id so contiguous shards are key ranges,
+    ie each backend works on its own part of the indexes.
+    Every shard commits on its own, so a shard's writes have to make sense without the others,
+    eg a shard's memberships are written with the deletes of that shard's todo markers
+    """
+
+    def __init__(self, num_connections: int) -> None:
+        self.num_connections = num_connections
+        self.pool = ConnectionPool(
+            DB_URL,
+            min_size=num_connections,
+            max_size=num_connections,
+            kwargs=dict(row_factory=dict_row, autocommit=True),
+            open=True,
+        )
+        self.exe = ThreadPoolExecutor(num_connections)
+
+    def __enter__(self) -> "ParallelWriter":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.exe.shutdown()
+        self.pool.close()
+
+    def shards(self, num_rows: int) -> list[tuple[int, int]]:
+        return shard_bounds(num_rows, self.num_connections)
+
+    def run(self, shards: Iterable[T], write: Callable[[psycopg.Cursor, T], None]):
+        """
+        Run write(cursor, shard) for every shard concurrently, each in its own transaction
+        """
+
+        def run_shard(shard: T):
+            with self.pool.connection() as conn:
+                with conn.transaction():
+                    write(conn.cursor(), shard)
+
+        futures = [self.exe.submit(run_shard, shard) for shard in shards]
+        wait(futures)
+        for future in futures:
+            future.result()
+
+    def copy(self, table: str, batch: CopyBatch):
+        self.run(
+            self.shards(batch.num_rows),
+            lambda cursor, bounds: copy_batch(cursor, table, batch.slice(*bounds)),
+        )
+
+
+def read_copy_batches(
+    cursor: psycopg.Cursor,
+    query: str,
+    columns: dict[str, str],
+    params: dict | None = None,
+    batch_size: int = 1_000_000,
+) -> Iterator[np.ndarray]:
+    """
+    Stream a query's rows with binary COPY, decoded into structured arrays of ~batch_size rows
+
+    The inverse of encode_copy_batch(), so the columns (name -> Postgres type)
+    must match the query's select list and can't contain NULLs.
+    Fields are big-endian, use .astype() before doing math on them
+    """
+
+    dtype = _copy_row_dtype(columns)
+    row_size = dtype.itemsize
+    buffer = bytearray()
+    is_header_read = False
+
+    with cursor.copy(f"COPY ({query}) TO STDOUT (FORMAT BINARY)", params) as copy:
+        for data in copy:
+            buffer += data
+
+            if not is_header_read and len(buffer) >= len(_COPY_HEADER):
+                assert buffer.startswith(_COPY_HEADER)
+                del buffer[: len(_COPY_HEADER)]
+                is_header_read = True
+
+            num_rows = len(buffer) // row_size
+            if is_header_read and num_rows >= batch_size:
+                end = num_rows * row_size
+                yield np.frombuffer(bytes(buffer[:end]), dtype=dtype)
+                del buffer[:end]
+
+    assert buffer.endswith(_COPY_TRAILER)
+    del buffer[-len(_COPY_TRAILER) :]
+
+    if buffer:
+        yield np.frombuffer(bytes(buffer), dtype=dtype)
+
+
+def read_tier_ids(db: Database, size: int) -> np.ndarray:
+    """
+    The tier's comp ids in ascending order, as int64s instead of a row per comp
+    """
+
+    batches = read_copy_batches(
+        db.cursor(),
+        "SELECT id FROM compositions WHERE size = %(size)s ORDER BY id",
+        dict(id="bigint"),
+        dict(size=size),
+    )
+    return np.concatenate(
+        [np.empty(0, dtype=np.int64)]
+        + [batch["id"].astype(np.int64) for batch in batches]
+    )
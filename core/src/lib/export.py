@@ -0,0 +1,497 @@
+import sqlite3
+import time
+from pathlib import Path
+from typing import Callable, Iterable, Iterator
+
+import numpy as np
+from lib.columnar import ColumnarStore
+from lib.composition import MAX_CHAMPION_ID
+from lib.db import Database, read_copy_batches
+from lib.features import (
+    FEATURE_COLUMNS,
+    FeatureTables,
+    calc_features,
+    get_feature_tables,
+)
+from lib.game_data import GameData, get_game_data, load_game_data
+from lib.scoring import SCORE_CHECKSUM_SCALE, get_trait_matrix
+from lib.utils import print_elapsed
+
+# Rows per SQLite transaction
+ROWS_PER_COMMIT = 5_000_000
+
+# Rows per slice of a memory-mapped column
+ROWS_PER_READ = 1_000_000
+
+SQLITE_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS champions (
+        id          INTEGER     PRIMARY KEY,
+
+        cost        INTEGER     NOT NULL,
+        name        TEXT        NOT NULL,
+        range       INTEGER     NOT NULL,
+        uses_ap     INTEGER     NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS traits (
+        id      INTEGER     PRIMARY KEY,
+
+        name    TEXT        NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS trait_thresholds (
+        id          INTEGER     PRIMARY KEY,
+        id_trait    INTEGER     NOT NULL,
+
+        threshold   INTEGER     NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS champion_traits (
+        id_champion     INTEGER     NOT NULL,
+        id_trait        INTEGER     NOT NULL,
+
+        PRIMARY KEY (id_champion, id_trait)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS compositions (
+        id                  INTEGER     PRIMARY KEY,
+
+        size                INTEGER     NOT NULL,
+        max_cost            INTEGER     NOT NULL,
+        total_cost          INTEGER     NOT NULL,
+        num_ap              INTEGER     NOT NULL,
+        num_ad              INTEGER     NOT NULL,
+        num_melee           INTEGER     NOT NULL,
+        num_semi_ranged     INTEGER     NOT NULL,
+        num_ranged          INTEGER     NOT NULL,
+        trait_mask          INTEGER     NOT NULL,
+        active_trait_mask   INTEGER     NOT NULL
+    )
+    """,
+    # No primary key, its indexes are built after the load
+    """
+    CREATE TABLE IF NOT EXISTS composition_champions (
+        id_composition      INTEGER     NOT NULL,
+        id_champion         INTEGER     NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS scores_by_trait (
+        id_composition      INTEGER     PRIMARY KEY,
+
+        score               REAL        NOT NULL
+    )
+    """,
+]
+
+# table -> (index name, definition)
+# Size leads so the usual size + feature filter is a single range scan,
+# filters without a size still get a skip-scan since there are only a few sizes.
+# The masks aren't indexed, bitwise filters can't use a b-tree anyway
+SQLITE_INDEXES = {
+    "compositions": [
+        ("compositions_max_cost", "compositions (size, max_cost)"),
+        ("compositions_total_cost", "compositions (size, total_cost)"),
+        ("compositions_num_ap", "compositions (size, num_ap)"),
+        ("compositions_num_ad", "compositions (size, num_ad)"),
+        ("compositions_num_melee", "compositions (size, num_melee)"),
+        ("compositions_num_semi_ranged", "compositions (size, num_semi_ranged)"),
+        ("compositions_num_ranged", "compositions (size, num_ranged)"),
+    ],
+    "composition_champions": [
+        (
+            "composition_champions_id_composition",
+            "composition_champions (id_composition, id_champion)",
+        ),
+        (
+            "composition_champions_id_champion",
+            "composition_champions (id_champion, id_composition)",
+        ),
+    ],
+    "scores_by_trait": [
+        ("scores_by_trait_score", "scores_by_trait (score)"),
+    ],
+}
+
+GAME_DATA_TABLES = {
+    "champions": ["id", "cost", "name", "range", "uses_ap"],
+    "traits": ["id", "name"],
+    "trait_thresholds": ["id", "id_trait", "threshold"],
+    "champion_traits": ["id_champion", "id_trait"],
+}
+
+
+def _migrate_features(conn: sqlite3.Connection):
+    """
+    Files exported before the feature columns existed are re-exported from scratch
+    """
+
+    columns = [r[1] for r in conn.execute("PRAGMA table_info(compositions)")]
+    if columns and "max_cost" not in columns:
+        conn.execute("DROP TABLE compositions")
+        conn.execute("DROP TABLE IF EXISTS composition_champions")
+
+
+def init_sqlite(path: Path) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, isolation_level=None)
+
+    # Nothing to recover if the export crashes, it can just be rerun
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA cache_size = -1000000")
+
+    _migrate_features(conn)
+    for statement in SQLITE_SCHEMA:
+        conn.execute(statement)
+
+    return conn
+
+
+def drop_indexes(conn: sqlite3.Connection, table: str):
+    for name, _ in SQLITE_INDEXES.get(table, []):
+        conn.execute(f"DROP INDEX IF EXISTS {name}")
+
+
+def create_indexes(conn: sqlite3.Connection, table: str):
+    for name, definition in SQLITE_INDEXES.get(table, []):
+        start = time.time()
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {definition}")
+        print_elapsed(start, f"indexed {definition}")
+
+
+class SqliteLoader:
+    """
+    Bulk inserts into SQLite, committing every ROWS_PER_COMMIT rows
+    """
+
+    def __init__(self, conn: sqlite3.Connection) -> None:
+        self.conn = conn
+        self.start = time.time()
+        self.num_rows = 0
+        self.num_uncommitted = 0
+
+        self.conn.execute("BEGIN")
+
+    def insert(self, statement: str, rows: list[tuple]):
+        self.conn.executemany(statement, rows)
+        self.num_rows += len(rows)
+        self.num_uncommitted += len(rows)
+
+        if self.num_uncommitted >= ROWS_PER_COMMIT:
+            self.conn.execute("COMMIT")
+            self.conn.execute("BEGIN")
+            self.num_uncommitted = 0
+            self.print_progress()
+
+    def close(self):
+        self.conn.execute("COMMIT")
+        self.print_progress()
+
+    def print_progress(self):
+        avg = self.num_rows / (time.time() - self.start)
+        print_elapsed(self.start, f"{self.num_rows:,} rows ({avg:.1f} rows/s)")
+
+
+def get_game_data_rows(db: Database) -> dict[str, list[tuple]]:
+    rows: dict[str, list[tuple]] = dict()
+    for table, columns in GAME_DATA_TABLES.items():
+        result = db.execute(f"SELECT {', '.join(columns)} FROM {table}").fetchall()
+        rows[table] = [tuple(r[c] for c in columns) for r in result]
+
+    return rows
+
+
+def to_game_data_rows(game: GameData) -> dict[str, list[tuple]]:
+    """
+    The rows init_db() seeds the game data tables with, for exports without a db
+    """
+
+    thresholds = [
+        (id_trait, threshold)
+        for id_trait, trait in game.traits.items()
+        for threshold in trait.thresholds
+    ]
+
+    return dict(
+        champions=[
+            (c.id, c.cost, c.name, c.range, c.uses_ap) for c in game.champions.values()
+        ],
+        traits=[(t.id, t.name) for t in game.traits.values()],
+        # Serial ids in insertion order, like the Postgres table
+        trait_thresholds=[
+            (idx + 1, id_trait, threshold)
+            for idx, (id_trait, threshold) in enumerate(thresholds)
+        ],
+        champion_traits=[
+            (c.id, id_trait) for c in game.champions.values() for id_trait in c.traits
+        ],
+    )
+
+
+def export_game_data(conn: sqlite3.Connection, rows: dict[str, list[tuple]]):
+    conn.execute("BEGIN")
+    for table, columns in GAME_DATA_TABLES.items():
+        conn.execute(f"DELETE FROM {table}")
+        conn.executemany(
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+            rows[table],
+        )
+    conn.execute("COMMIT")
+
+
+def get_tier_counts(db: Database) -> dict[int, tuple[int, int, int]]:
+    """
+    Returns size -> (number of comps, number of scores, score checksum),
+    the checksum is lib.scoring.score_checksum() of the tier's scores
+    """
+
+    rows = db.execute(
+        """
+        SELECT
+            c.size,
+            COUNT(*) num_comps,
+            COUNT(s.id_composition) num_scores,
+            SUM(trunc(s.score::float8 * %(scale)s)::bigint) checksum
+        FROM compositions c
+        LEFT JOIN scores_by_trait s
+            ON s.id_composition = c.id
+        GROUP BY c.size
+        """,
+        dict(scale=SCORE_CHECKSUM_SCALE),
+    ).fetchall()
+
+    return {
+        r["size"]: (r["num_comps"], r["num_scores"], int(r["checksum"] or 0))
+        for r in rows
+    }
+
+
+def get_sqlite_tier_counts(
+    conn: sqlite3.Connection,
+) -> dict[int, tuple[int, int, int]]:
+    rows = conn.execute(
+        """
+        SELECT
+            c.size,
+            COUNT(*),
+            COUNT(s.id_composition),
+            SUM(CAST(s.score * :scale AS INTEGER))
+        FROM compositions c
+        LEFT JOIN scores_by_trait s
+            ON s.id_composition = c.id
+        GROUP BY c.size
+        """,
+        dict(scale=SCORE_CHECKSUM_SCALE),
+    ).fetchall()
+
+    return {
+        size: (num_comps, num_scores, checksum or 0)
+        for size, num_comps, num_scores, checksum in rows
+    }
+
+
+def to_membership_rows(comp_ids: np.ndarray) -> list[tuple]:
+    """
+    Memberships are a function of the (bitmask) id so they're derived here
+    instead of streaming the much larger junction table out of Postgres
+    """
+
+    bits = np.arange(MAX_CHAMPION_ID + 1, dtype=np.int64)
+    comp_idxs, champion_ids = np.nonzero((comp_ids[:, None] >> bits) & 1 == 1)
+
+    return list(zip(comp_ids[comp_idxs].tolist(), champion_ids.tolist()))
+
+
+def read_tier(db: Database, size: int) -> Iterator[np.ndarray]:
+    batches = read_copy_batches(
+        db.cursor(),
+        "SELECT id FROM compositions WHERE size = %(size)s ORDER BY id",
+        dict(id="bigint"),
+        dict(size=size),
+    )
+    for batch in batches:
+        yield batch["id"].astype(np.int64)
+
+
+def read_scores(db: Database, size: int) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+    batches = read_copy_batches(
+        db.cursor(),
+        """
+        SELECT s.id_composition, s.score
+        FROM scores_by_trait s
+        INNER JOIN compositions c
+            ON c.id = s.id_composition
+        WHERE c.size = %(size)s
+        ORDER BY s.id_composition
+        """,
+        dict(id_composition="bigint", score="real"),
+        dict(size=size),
+    )
+    for batch in batches:
+        yield batch["id_composition"].astype(np.int64), batch["score"].astype(
+            np.float32
+        )
+
+
+def read_columnar_tier(store: ColumnarStore, size: int) -> Iterator[np.ndarray]:
+    ids = store.read_column(size, "ids")
+    for start in range(0, len(ids), ROWS_PER_READ):
+        yield np.asarray(ids[start : start + ROWS_PER_READ])
+
+
+def read_columnar_scores(
+    store: ColumnarStore, size: int
+) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+    ids = store.read_column(size, "ids")
+    scores = store.read_column(size, "scores")
+    for start in range(0, len(ids), ROWS_PER_READ):
+        end = start + ROWS_PER_READ
+        yield np.asarray(ids[start:end]), np.asarray(scores[start:end])
+
+
+def export_tier(
+    conn: sqlite3.Connection,
+    tables: FeatureTables,
+    size: int,
+    is_partial: bool,
+    batches: Iterable[np.ndarray],
+):
+    if is_partial:
+        conn.execute(
+            """
+            DELETE FROM composition_champions
+            WHERE id_composition IN (SELECT id FROM compositions WHERE size = ?)
+            """,
+            [size],
+        )
+
+    columns = ["id", "size", *FEATURE_COLUMNS]
+    statement = f"INSERT OR IGNORE INTO compositions ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+
+    loader = SqliteLoader(conn)
+    for ids in batches:
+        features = calc_features(tables, ids)
+
+        loader.insert(
+            statement,
+            list(
+                zip(
+                    ids.tolist(),
+                    [size] * len(ids),
+                    *(features[name].tolist() for name in FEATURE_COLUMNS),
+                )
+            ),
+        )
+        loader.insert(
+            "INSERT INTO composition_champions (id_composition, id_champion) VALUES (?, ?)",
+            to_membership_rows(ids),
+        )
+    loader.close()
+
+
+def export_scores(
+    conn: sqlite3.Connection, batches: Iterable[tuple[np.ndarray, np.ndarray]]
+):
+    loader = SqliteLoader(conn)
+    for ids, scores in batches:
+        loader.insert(
+            "INSERT OR REPLACE INTO scores_by_trait (id_composition, score) VALUES (?, ?)",
+            list(zip(ids.tolist(), scores.tolist())),
+        )
+    loader.close()
+
+
+def export_tiers(
+    conn: sqlite3.Connection,
+    game: GameData,
+    counts: dict[int, tuple[int, int, int]],
+    read_tier: Callable[[int], Iterable[np.ndarray]],
+    read_scores: Callable[[int], Iterable[tuple[np.ndarray, np.ndarray]]],
+):
+    """
+    Only the tiers whose comp or score counts differ from the existing file are exported,
+    so rerunning after new tiers / scores are added only copies those.
+    Scores are also compared by checksum, so a rescored tier is exported again
+    """
+
+    exported_counts = get_sqlite_tier_counts(conn)
+
+    # size -> whether some of the tier was already exported
+    new_tiers: dict[int, bool] = dict()
+    new_scores: list[int] = []
+    for size, (num_comps, num_scores, checksum) in sorted(counts.items()):
+        num_exported_comps, num_exported_scores, exported_checksum = (
+            exported_counts.get(size, (0, 0, 0))
+        )
+
+        if num_comps != num_exported_comps:
+            new_tiers[size] = num_exported_comps > 0
+        if num_scores != num_exported_scores or checksum != exported_checksum:
+            new_scores.append(size)
+
+    if new_tiers:
+        matrix = get_trait_matrix(game.champions, game.traits)
+        tables = get_feature_tables(matrix, game.champions, game.traits)
+
+        for table in ["compositions", "composition_champions"]:
+            drop_indexes(conn, table)
+
+        for size, is_partial in new_tiers.items():
+            print(f"exporting comps of size {size}")
+            export_tier(conn, tables, size, is_partial, read_tier(size))
+
+        for table in ["compositions", "composition_champions"]:
+            create_indexes(conn, table)
+
+    if new_scores:
+        drop_indexes(conn, "scores_by_trait")
+
+        for size in new_scores:
+            print(f"exporting scores of size {size}")
+            export_scores(conn, read_scores(size))
+
+        create_indexes(conn, "scores_by_trait")
+
+    conn.execute("ANALYZE")
+
+
+def export_sqlite(db: Database, path: Path):
+    """
+    Copy the Postgres tables the web app reads into a SQLite file, see export_tiers()
+    """
+
+    conn = init_sqlite(path)
+    export_game_data(conn, get_game_data_rows(db))
+    export_tiers(
+        conn,
+        load_game_data(db),
+        get_tier_counts(db),
+        lambda size: read_tier(db, size),
+        lambda size: read_scores(db, size),
+    )
+    conn.close()
+
+
+def export_columnar(store: ColumnarStore, path: Path):
+    """
+    export_sqlite() from the files written by pipeline.py --columnar
+    """
+
+    game = get_game_data()
+
+    conn = init_sqlite(path)
+    export_game_data(conn, to_game_data_rows(game))
+    export_tiers(
+        conn,
+        game,
+        store.get_tier_counts(),
+        lambda size: read_columnar_tier(store, size),
+        lambda size: read_columnar_scores(store, size),
+    )
+    conn.close()
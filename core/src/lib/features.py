@@ -0,0 +1,107 @@
+from dataclasses import dataclass
+
+import numpy as np
+from lib.db import DbChampion, DbTrait
+from lib.scoring import ROWS_PER_CHUNK, TraitMatrix, count_traits, to_membership
+
+# column -> postgres type, in table order
+FEATURE_COLUMNS = {
+    "max_cost": "smallint",
+    "total_cost": "smallint",
+    "num_ap": "smallint",
+    "num_ad": "smallint",
+    "num_melee": "smallint",
+    "num_semi_ranged": "smallint",
+    "num_ranged": "smallint",
+    "trait_mask": "bigint",
+    "active_trait_mask": "bigint",
+}
+
+# Columns that are the sum of a per-champion value
+_SUMMED_COLUMNS = [
+    "total_cost",
+    "num_ap",
+    "num_ad",
+    "num_melee",
+    "num_semi_ranged",
+    "num_ranged",
+]
+
+
+@dataclass
+class FeatureTables:
+    """
+    Lookup tables for computing composition features in bulk
+
+    champion_values[i, j] is champion i's value for _SUMMED_COLUMNS[j],
+    the trait arrays follow matrix.trait_ids
+    """
+
+    matrix: TraitMatrix
+    champion_costs: np.ndarray
+    champion_values: np.ndarray
+    trait_bits: np.ndarray
+    min_thresholds: np.ndarray
+
+
+def get_feature_tables(
+    matrix: TraitMatrix, champions: dict[int, DbChampion], traits: dict[int, DbTrait]
+) -> FeatureTables:
+    assert max(traits) < 63, "trait ids must fit in a (signed) bigint mask"
+
+    costs = np.zeros(matrix.num_champions, dtype=np.float32)
+    values = np.zeros((matrix.num_champions, len(_SUMMED_COLUMNS)), dtype=np.float32)
+    for champ in champions.values():
+        costs[champ.id] = champ.cost
+        values[champ.id] = [
+            champ.cost,
+            champ.uses_ap,
+            not champ.uses_ap,
+            champ.range == 1,
+            champ.range == 2,
+            champ.range > 2,
+        ]
+
+    trait_bits = np.array([1 << id for id in matrix.trait_ids], dtype=np.int64)
+    min_thresholds = np.array(
+        [min(traits[id].thresholds) for id in matrix.trait_ids], dtype=np.uint8
+    )
+
+    return FeatureTables(
+        matrix=matrix,
+        champion_costs=costs,
+        champion_values=values,
+        trait_bits=trait_bits,
+        min_thresholds=min_thresholds,
+    )
+
+
+def calc_features(tables: FeatureTables, masks: np.ndarray) -> dict[str, np.ndarray]:
+    """
+    Returns column -> N values, see FEATURE_COLUMNS
+    """
+
+    features = {name: np.empty(len(masks), dtype=np.int64) for name in FEATURE_COLUMNS}
+
+    for start in range(0, len(masks), ROWS_PER_CHUNK):
+        end = start + ROWS_PER_CHUNK
+        chunk = masks[start:end]
+
+        membership = to_membership(tables.matrix, chunk)
+        features["max_cost"][start:end] = (membership * tables.champion_costs).max(
+            axis=1
+        )
+
+        sums = membership @ tables.champion_values
+        for idx, name in enumerate(_SUMMED_COLUMNS):
+            features[name][start:end] = sums[:, idx]
+
+        counts = count_traits(tables.matrix, chunk)
+        features["trait_mask"][start:end] = np.where(
+            counts > 0, tables.trait_bits, 0
+        ).sum(axis=1)
+        features["active_trait_mask"][start:end] = np.where(
+            counts >= tables.min_thresholds, tables.trait_bits, 0
+        ).sum(axis=1)
+
+    return features
@@ -0,0 +1,100 @@
+from dataclasses import dataclass
+from functools import cached_property
+from typing import cast
+
+from data._champions import ALL_CHAMPIONS, ALL_TRAITS, Trait
+from lib.composition import MAX_CHAMPION_ID
+from lib.db import (
+    DatabaseOrCursor,
+    DbChampion,
+    DbTrait,
+    get_all_champions,
+    get_all_traits,
+    get_champions_by_trait,
+)
+
+
+@dataclass
+class GameData:
+    """
+    Read-only champion / trait lookup tables shared by every script
+    """
+
+    champions: dict[int, DbChampion]
+    traits: dict[int, DbTrait]
+
+    @cached_property
+    def champions_by_trait(self) -> dict[int, list[DbChampion]]:
+        return get_champions_by_trait(self.champions.values())
+
+    @cached_property
+    def champion_neighbors(self) -> list[int]:
+        """
+        champion id -> mask of the other champions that share a trait with it
+        """
+
+        neighbors = [0] * (MAX_CHAMPION_ID + 1)
+        for champs in self.champions_by_trait.values():
+            mask = 0
+            for c in champs:
+                mask |= 1 << c.id
+            for c in champs:
+                neighbors[c.id] |= mask
+
+        return [mask & ~(1 << id) for id, mask in enumerate(neighbors)]
+
+
+def build_game_data() -> GameData:
+    """
+    Build the lookup tables from data/_champions.py (the same data init_db() seeds the db with)
+    """
+
+    traits: dict[int, DbTrait] = dict()
+    for key, trait in ALL_TRAITS.__dict__.items():
+        if key.startswith("__"):
+            continue
+
+        trait = cast(Trait, trait)
+        traits[trait.id] = DbTrait(
+            id=trait.id,
+            name=trait.name,
+            thresholds=list(trait.thresholds),
+        )
+
+    champions: dict[int, DbChampion] = dict()
+    for ch in ALL_CHAMPIONS:
+        champions[ch.id] = DbChampion(
+            id=ch.id,
+            cost=ch.cost,
+            name=ch.name,
+            range=ch.range,
+            uses_ap=ch.uses_ap,
+            traits=[t.id for t in ch.traits],
+        )
+
+    return GameData(champions=champions, traits=traits)
+
+
+def load_game_data(db: DatabaseOrCursor) -> GameData:
+    return GameData(champions=get_all_champions(db), traits=get_all_traits(db))
+
+
+_GAME_DATA: GameData | None = None
+
+
+def get_game_data() -> GameData:
+    global _GAME_DATA
+
+    if _GAME_DATA is None:
+        _GAME_DATA = build_game_data()
+
+    return _GAME_DATA
+
+
+def set_game_data(data: GameData):
+    """
+    Override the lookup tables, eg with load_game_data() or in a worker initializer
+    """
+
+    global _GAME_DATA
+    _GAME_DATA = data
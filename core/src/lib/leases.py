@@ -0,0 +1,394 @@
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Callable, Iterator
+
+from lib.db import Database, connect_db
+from lib.metrics import METRICS
+from lib.pipeline import get_done_tiers, mark_tier_done
+from lib.utils import print_elapsed
+
+# Seconds a claimed lease is held before another worker may take it over
+LEASE_TIMEOUT = 600
+
+# Seconds between checks for other workers' leases / tiers
+POLL_INTERVAL = 5
+
+# The upper bound of the last range, above every (non-negative BIGINT) comp id
+MAX_ID = (1 << 63) - 1
+
+
+@dataclass
+class Lease:
+    """
+    The comps of a tier with first_id < id <= last_id
+    """
+
+    stage: str
+    size: int
+    first_id: int
+    last_id: int
+
+    @property
+    def params(self) -> dict:
+        return dict(
+            stage=self.stage,
+            size=self.size,
+            first_id=self.first_id,
+            last_id=self.last_id,
+        )
+
+
+@dataclass
+class LeasedStage:
+    """
+    A Stage whose tiers are split into id ranges for any number of workers,
+    on any number of hosts sharing the db, to claim
+
+    compute(db, lease) runs outside of a transaction. write(db, lease, value)
+    runs in the transaction that completes the lease, which only commits if the worker
+    still holds the lease (ie it didn't expire and get claimed by another worker),
+    so each range is written exactly once
+    """
+
+    name: str
+    compute: Callable[[Database, Lease], Any]
+    write: Callable[[Database, Lease, Any], int]
+
+    # (stage, size) pairs that have to be done before a tier starts
+    requires: Callable[[int], list[tuple[str, int]]]
+
+    # Comps per lease
+    batch_size: int
+
+    # The tier whose ids are split into ranges, eg the parent tier for expand
+    leased_size: Callable[[int], int] = lambda size: size
+
+    # Runs once a tier's leases are all done, by the worker that marks it done
+    finish: Callable[[Database, int], None] | None = None
+
+
+def get_worker_name(idx: int = 0) -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{idx}"
+
+
+def create_leases(db: Database, stage: LeasedStage, size: int):
+    """
+    Split the tier into ranges of batch_size comps, unless that was done already
+
+    Every worker computes the same ranges (the tier is complete by then)
+    so it doesn't matter which one gets there first. The ranges are a single insert,
+    so once any exist they all do and the tier isn't numbered again
+    """
+
+    created = db.execute(
+        "SELECT 1 FROM work_leases WHERE stage = %s AND size = %s LIMIT 1",
+        [stage.name, size],
+    ).fetchone()
+    if created:
+        return
+
+    db.execute(
+        """
+        WITH bounds AS (
+            SELECT id
+            FROM (
+                SELECT id, ROW_NUMBER() OVER (ORDER BY id) rn
+                FROM compositions
+                WHERE size = %(leased_size)s
+            ) t
+            WHERE rn %% %(batch_size)s = 0
+
+            UNION ALL
+            SELECT %(max_id)s
+        )
+        INSERT INTO work_leases (stage, size, first_id, last_id)
+        SELECT
+            %(stage)s,
+            %(size)s,
+            COALESCE(LAG(id) OVER (ORDER BY id), -1),
+            id
+        FROM bounds
+        ON CONFLICT DO NOTHING
+        """,
+        dict(
+            stage=stage.name,
+            size=size,
+            leased_size=stage.leased_size(size),
+            batch_size=stage.batch_size,
+            max_id=MAX_ID,
+        ),
+    )
+
+
+def claim_lease(
+    db: Database, stage: str, size: int, worker: str, timeout: float
+) -> Lease | None:
+    """
+    Take the first range that's unclaimed or whose lease expired
+
+    Ranges locked by another worker's claim / write are skipped instead of waited on
+    """
+
+    row = db.execute(
+        """
+        UPDATE work_leases l
+        SET
+            worker = %(worker)s,
+            expires_at = NOW() + make_interval(secs => %(timeout)s)
+        FROM (
+            SELECT stage, size, first_id
+            FROM work_leases
+            WHERE
+                stage = %(stage)s
+                AND size = %(size)s
+                AND NOT done
+                AND (expires_at IS NULL OR expires_at < NOW())
+            ORDER BY first_id
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        ) free
+        WHERE
+            l.stage = free.stage
+            AND l.size = free.size
+            AND l.first_id = free.first_id
+        RETURNING l.first_id, l.last_id
+        """,
+        dict(stage=stage, size=size, worker=worker, timeout=timeout),
+    ).fetchone()
+
+    if not row:
+        return None
+    return Lease(stage=stage, size=size, **row)
+
+
+@contextmanager
+def keep_lease(
+    db: Database, lease: Lease, worker: str, timeout: float
+) -> Iterator[None]:
+    """
+    Renew the lease (from another thread, db must be a connection of its own)
+    while the block runs, so a lease only expires if its worker stops
+    rather than whenever a batch takes longer than the timeout
+    """
+
+    stopped = threading.Event()
+
+    def renew():
+        while not stopped.wait(timeout / 3):
+            db.execute(
+                """
+                UPDATE work_leases
+                SET expires_at = NOW() + make_interval(secs => %(timeout)s)
+                WHERE
+                    stage = %(stage)s
+                    AND size = %(size)s
+                    AND first_id = %(first_id)s
+                    AND worker = %(worker)s
+                    AND NOT done
+                """,
+                dict(lease.params, worker=worker, timeout=timeout),
+            )
+
+    thread = threading.Thread(target=renew, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def count_open_leases(db: Database, stage: str, size: int) -> int:
+    row = db.execute(
+        """
+        SELECT COUNT(*) count
+        FROM work_leases
+        WHERE
+            stage = %(stage)s
+            AND size = %(size)s
+            AND NOT done
+        """,
+        dict(stage=stage, size=size),
+    ).fetchone()
+
+    return row["count"] if row else 0
+
+
+def complete_lease(
+    db: Database, stage: LeasedStage, lease: Lease, worker: str, value: Any
+) -> int | None:
+    """
+    Write the lease's results and mark it done, returns None (and writes nothing)
+    if the lease was lost to another worker
+    """
+
+    with db.transaction():
+        # Locking the row also keeps it from being claimed while this commits
+        row = db.execute(
+            """
+            SELECT 1 held
+            FROM work_leases
+            WHERE
+                stage = %(stage)s
+                AND size = %(size)s
+                AND first_id = %(first_id)s
+                AND worker = %(worker)s
+                AND NOT done
+            FOR UPDATE
+            """,
+            dict(lease.params, worker=worker),
+        ).fetchone()
+        if not row:
+            return None
+
+        count = stage.write(db, lease, value)
+        db.execute(
+            """
+            UPDATE work_leases
+            SET done = TRUE
+            WHERE
+                stage = %(stage)s
+                AND size = %(size)s
+                AND first_id = %(first_id)s
+            """,
+            lease.params,
+        )
+
+    return count
+
+
+def wait_for_tiers(
+    db: Database,
+    requirements: list[tuple[str, int]],
+    poll_interval: float,
+    stopped: threading.Event,
+):
+    while not all(r in get_done_tiers(db) for r in requirements):
+        if stopped.wait(poll_interval):
+            raise Exception("Stopping, another worker failed")
+
+
+def run_worker(
+    db: Database,
+    stages: list[LeasedStage],
+    sizes: list[int],
+    worker: str,
+    timeout: float = LEASE_TIMEOUT,
+    poll_interval: float = POLL_INTERVAL,
+    stopped: threading.Event | None = None,
+) -> Iterator[tuple[str, int, int]]:
+    """
+    Claim and process leases until every stage is done for every tier,
+    yields (stage, size, number of comps) for each completed lease
+
+    A tier is marked done (in pipeline_tiers) by whichever worker
+    sees its last lease completed. Workers that run out of leases
+    while others are still held wait for them to finish or expire
+    """
+
+    stopped = stopped or threading.Event()
+    keeper_db = connect_db()
+
+    try:
+        yield from _run_worker(
+            db, keeper_db, stages, sizes, worker, timeout, poll_interval, stopped
+        )
+    finally:
+        keeper_db.close()
+
+
+def _run_worker(
+    db: Database,
+    keeper_db: Database,
+    stages: list[LeasedStage],
+    sizes: list[int],
+    worker: str,
+    timeout: float,
+    poll_interval: float,
+    stopped: threading.Event,
+) -> Iterator[tuple[str, int, int]]:
+    for size in sizes:
+        for stage in stages:
+            wait_for_tiers(db, stage.requires(size), poll_interval, stopped)
+            if (stage.name, size) in get_done_tiers(db):
+                continue
+
+            create_leases(db, stage, size)
+            while not stopped.is_set():
+                lease = claim_lease(db, stage.name, size, worker, timeout)
+                if lease:
+                    with (
+                        METRICS.phase(stage.name, "compute", size=size),
+                        keep_lease(keeper_db, lease, worker, timeout),
+                    ):
+                        value = stage.compute(db, lease)
+                    with METRICS.phase(stage.name, "write", size=size) as timing:
+                        count = complete_lease(db, stage, lease, worker, value)
+                        timing.rows = count
+
+                    if count is None:
+                        METRICS.count("leases_lost", stage=stage.name)
+                    else:
+                        yield stage.name, size, count
+                elif count_open_leases(db, stage.name, size) == 0:
+                    if stage.finish:
+                        stage.finish(db, size)
+                    mark_tier_done(db, stage.name, size)
+                    break
+                else:
+                    stopped.wait(poll_interval)
+
+            if stopped.is_set():
+                raise Exception("Stopping, another worker failed")
+
+
+def run_workers(
+    stages: list[LeasedStage],
+    sizes: list[int],
+    num_workers: int,
+    timeout: float = LEASE_TIMEOUT,
+    poll_interval: float = POLL_INTERVAL,
+):
+    """
+    run_worker() in several threads of this process, each with its own connection
+    """
+
+    stopped = threading.Event()
+    errors: list[BaseException] = []
+
+    def run(idx: int):
+        db = connect_db()
+        worker = get_worker_name(idx)
+
+        try:
+            start = time.time()
+            for stage, size, count in run_worker(
+                db, stages, sizes, worker, timeout, poll_interval, stopped
+            ):
+                avg = count / (time.time() - start)
+                print_elapsed(
+                    start,
+                    f"{worker}: {stage} {count:,} comps of size {size} ({avg:.1f} it/s)",
+                )
+                start = time.time()
+        except BaseException as e:
+            errors.append(e)
+            stopped.set()
+        finally:
+            db.close()
+
+    threads = [
+        threading.Thread(target=run, args=[idx], daemon=True)
+        for idx in range(num_workers)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    if errors:
+        raise errors[0]
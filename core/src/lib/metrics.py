@@ -0,0 +1,278 @@
+import argparse
+import json
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator, TextIO, TypeVar
+
+T = TypeVar("T")
+
+# (metric name, sorted label pairs)
+MetricKey = tuple[str, tuple[tuple[str, str], ...]]
+
+PROMETHEUS_PREFIX = "tft_"
+
+
+@dataclass
+class Timing:
+    """
+    Set rows inside the timed block to also get a row count and rows/s
+    """
+
+    rows: int | None = None
+    seconds: float = 0
+
+
+@dataclass
+class TimerTotals:
+    seconds: float = 0
+    calls: int = 0
+    rows: int = 0
+
+
+def _key(name: str, labels: dict[str, Any]) -> MetricKey:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Metrics:
+    """
+    Timers, counters and gauges for the pipeline scripts
+
+    Every timer / gauge update is appended to a JSON-lines file and / or aggregated
+    for a Prometheus text endpoint. Both are off by default, in which case
+    only the in-memory totals are kept (a dict update per batch)
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.timers: dict[MetricKey, TimerTotals] = dict()
+        self.counters: dict[MetricKey, float] = dict()
+        self.gauges: dict[MetricKey, float] = dict()
+
+        self.file: TextIO | None = None
+        self.server: ThreadingHTTPServer | None = None
+
+    def open_file(self, path: Path):
+        self.file = open(path, "a", buffering=1)
+
+    def serve(self, port: int):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.to_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("", port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+        if self.server:
+            self.server.shutdown()
+            self.server = None
+
+    def _write(self, event: dict):
+        if self.file:
+            self.file.write(json.dumps(dict(time=time.time(), **event)) + "\n")
+
+    @contextmanager
+    def timer(self, name: str, **labels) -> Iterator[Timing]:
+        timing = Timing()
+        start = time.perf_counter()
+        try:
+            yield timing
+        finally:
+            timing.seconds = time.perf_counter() - start
+            self.record(name, timing, **labels)
+
+    def phase(self, stage: str, phase: str, **labels):
+        """
+        Time one phase of a batch, eg phase(stage="expand", phase="dedupe_temp")
+        """
+
+        return self.timer("phase", stage=stage, phase=phase, **labels)
+
+    def record(self, name: str, timing: Timing, **labels):
+        with self.lock:
+            totals = self.timers.setdefault(_key(name, labels), TimerTotals())
+            totals.seconds += timing.seconds
+            totals.calls += 1
+            totals.rows += timing.rows or 0
+
+            event: dict[str, Any] = dict(
+                type="timer", name=name, seconds=timing.seconds, **labels
+            )
+            if timing.rows is not None:
+                event["rows"] = timing.rows
+                if timing.seconds > 0:
+                    event["rows_per_s"] = timing.rows / timing.seconds
+            self._write(event)
+
+    def count(self, name: str, value: float = 1, **labels):
+        with self.lock:
+            key = _key(name, labels)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name: str, value: float, **labels):
+        with self.lock:
+            self.gauges[_key(name, labels)] = value
+            self._write(dict(type="gauge", name=name, value=value, **labels))
+
+    def to_prometheus(self) -> str:
+        def fmt(name: str, labels: tuple[tuple[str, str], ...], value: float):
+            label_str = ",".join(f'{k}="{v}"' for k, v in labels)
+            return f"{PROMETHEUS_PREFIX}{name}{{{label_str}}} {value}"
+
+        lines: list[str] = []
+        with self.lock:
+            for (name, labels), totals in sorted(self.timers.items()):
+                lines.append(fmt(f"{name}_seconds_total", labels, totals.seconds))
+                lines.append(fmt(f"{name}_calls_total", labels, totals.calls))
+                lines.append(fmt(f"{name}_rows_total", labels, totals.rows))
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(fmt(f"{name}_total", labels, value))
+            for (name, labels), value in sorted(self.gauges.items()):
+                lines.append(fmt(name, labels, value))
+
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+
+def timed_batches(
+    batches: Iterable[list[T]], stage: str, phase: str = "fetch", **labels
+) -> Iterator[list[T]]:
+    """
+    Times how long each batch took to produce, eg a WorkSource fetch
+    """
+
+    it = iter(batches)
+    while True:
+        with METRICS.phase(stage, phase, **labels) as timing:
+            batch = next(it, None)
+            timing.rows = len(batch) if batch is not None else 0
+
+        if batch is None:
+            return
+        yield batch
+
+
+def timed_call(fn: Callable[..., T], *args) -> tuple[T, float]:
+    """
+    Run fn in a pool worker and return how long it was busy, for utilization metrics
+    """
+
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def record_utilization(
+    name: str, busy_seconds: float, wall_seconds: float, num_workers: int, **labels
+):
+    if wall_seconds > 0:
+        METRICS.gauge(
+            f"{name}_utilization",
+            busy_seconds / (wall_seconds * num_workers),
+            **labels,
+        )
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of every thread (of this process) at a fixed interval
+    and writes the counts as collapsed stacks, the input format of flamegraph.pl / speedscope
+
+    Unlike cProfile there's no per-call overhead, so it can stay on for a whole tier
+    """
+
+    def __init__(self, path: Path, interval: float = 0.01) -> None:
+        self.path = path
+        self.interval = interval
+        self.stacks: Counter[str] = Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+
+                names: list[str] = []
+                f = frame
+                while f:
+                    code = f.f_code
+                    names.append(f"{Path(code.co_filename).name}:{code.co_name}")
+                    f = f.f_back
+
+                self.stacks[";".join(reversed(names))] += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+        with open(self.path, "w") as file:
+            for stack, count in self.stacks.most_common():
+                file.write(f"{stack} {count}\n")
+
+
+def add_metrics_args(parser: argparse.ArgumentParser):
+    group = parser.add_argument_group("metrics")
+    group.add_argument(
+        "--metrics-file", type=Path, help="append timings / gauges as JSON lines"
+    )
+    group.add_argument(
+        "--metrics-port", type=int, help="serve Prometheus metrics on this port"
+    )
+    group.add_argument(
+        "--profile-file",
+        type=Path,
+        help="sample the stacks of this process and write them here as collapsed stacks",
+    )
+    group.add_argument(
+        "--profile-interval",
+        type=float,
+        default=0.01,
+        help="seconds between stack samples",
+    )
+
+
+@contextmanager
+def metrics_from_args(args: argparse.Namespace) -> Iterator[Metrics]:
+    if args.metrics_file:
+        METRICS.open_file(args.metrics_file)
+    if args.metrics_port:
+        METRICS.serve(args.metrics_port)
+
+    profiler = None
+    if args.profile_file:
+        profiler = SamplingProfiler(args.profile_file, args.profile_interval)
+        profiler.start()
+
+    try:
+        yield METRICS
+    finally:
+        if profiler:
+            profiler.stop()
+        METRICS.close()
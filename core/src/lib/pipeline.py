@@ -0,0 +1,360 @@
+import argparse
+import threading
+import time
+from dataclasses import dataclass, field
+from queue import Full, Queue
+from typing import Any, Callable, Iterable, Iterator, TypeVar
+
+from lib.db import (
+    Database,
+    DatabaseOrCursor,
+    ParallelWriter,
+    WorkSource,
+    connect_db,
+)
+from lib.metrics import METRICS, timed_batches
+
+T = TypeVar("T")
+
+# Batches each step may run ahead of the next one
+MAX_QUEUED_BATCHES = 2
+
+# Connections each batch is written over
+NUM_WRITERS = 4
+
+
+@dataclass
+class Stage:
+    """
+    A step that processes one size tier at a time
+
+    run_tier(db, size) yields the number of comps in each batch it commits.
+    Batches have to be idempotent, a tier is rerun from the start (and should skip
+    whatever was already committed) if the pipeline stops before the tier is marked done
+    """
+
+    name: str
+    run_tier: Callable[[Database, int], Iterable[int]]
+
+    # (stage, size) pairs that have to be done before a tier starts
+    requires: Callable[[int], list[tuple[str, int]]]
+
+
+def get_done_tiers(db: DatabaseOrCursor) -> set[tuple[str, int]]:
+    rows = db.execute("SELECT stage, size FROM pipeline_tiers").fetchall()
+    return {(r["stage"], r["size"]) for r in rows}
+
+
+MARK_TIER_DONE = """
+    INSERT INTO pipeline_tiers (stage, size) VALUES (%s, %s)
+    ON CONFLICT DO NOTHING
+"""
+
+
+def mark_tier_done(db: DatabaseOrCursor, stage: str, size: int):
+    db.execute(MARK_TIER_DONE, [stage, size])
+
+
+@dataclass
+class StageProgress:
+    stage: Stage
+
+    # Tiers this run has to process and their expected comp counts
+    pending: dict[int, int]
+
+    size: int | None = None
+    num_done: int = 0
+    num_done_tier: int = 0
+    start: float | None = None
+    finished: bool = False
+
+    @property
+    def backlog(self) -> int:
+        return max(sum(self.pending.values()) - self.num_done, 0)
+
+    @property
+    def throughput(self) -> float:
+        if self.start is None or not self.num_done:
+            return 0
+        return self.num_done / (time.time() - self.start)
+
+    def describe(self) -> str:
+        name = self.stage.name
+        if self.finished:
+            return f"{name}: done ({self.num_done:,} comps)"
+        elif self.size is None:
+            return f"{name}: waiting (backlog {self.backlog:,})"
+
+        expected = self.pending[self.size]
+        eta = self.backlog / self.throughput if self.throughput else None
+        return " | ".join(
+            [
+                f"{name}: size {self.size} {self.num_done_tier:,} / {expected:,}",
+                f"{self.throughput:.1f} comps/s",
+                f"backlog {self.backlog:,}",
+                f"eta {format_duration(eta)}",
+            ]
+        )
+
+
+def format_duration(seconds: float | None) -> str:
+    if seconds is None:
+        return "?"
+
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02}m{seconds:02}s"
+
+
+@dataclass
+class Pipeline:
+    """
+    Runs every stage in its own thread, a stage starts on a tier as soon as
+    the tiers it requires are done (rather than after the upstream stage finished every tier)
+
+    Completed tiers are recorded in pipeline_tiers so a restarted pipeline
+    picks up where it stopped
+    """
+
+    stages: list[Stage]
+    expected_sizes: dict[int, int]
+    report_interval: float = 30
+
+    done: set[tuple[str, int]] = field(default_factory=set)
+    progress: dict[str, StageProgress] = field(default_factory=dict)
+    error: BaseException | None = None
+    cond: threading.Condition = field(default_factory=threading.Condition)
+
+    def wait_for(self, requirements: list[tuple[str, int]]):
+        with self.cond:
+            while not all(r in self.done for r in requirements):
+                if self.error:
+                    raise Exception("Stopping, another stage failed")
+                self.cond.wait()
+
+    def run_stage(self, stage: Stage):
+        db = connect_db()
+        progress = self.progress[stage.name]
+
+        try:
+            for size in progress.pending:
+                self.wait_for(stage.requires(size))
+
+                progress.size = size
+                progress.num_done_tier = 0
+                if progress.start is None:
+                    progress.start = time.time()
+
+                with METRICS.timer("tier", stage=stage.name, size=size) as timing:
+                    for count in stage.run_tier(db, size):
+                        progress.num_done += count
+                        progress.num_done_tier += count
+                    timing.rows = progress.num_done_tier
+
+                # Tiers can come out smaller / larger than expected
+                progress.num_done += progress.pending[size] - progress.num_done_tier
+
+                mark_tier_done(db, stage.name, size)
+                with self.cond:
+                    self.done.add((stage.name, size))
+                    self.cond.notify_all()
+
+            progress.finished = True
+        except BaseException as e:
+            with self.cond:
+                self.error = self.error or e
+                self.cond.notify_all()
+        finally:
+            db.close()
+
+    def get_queue_depth(self, progress: StageProgress) -> int:
+        """
+        Comps in the tiers whose requirements are done but that this stage hasn't started
+        """
+
+        with self.cond:
+            return sum(
+                count
+                for size, count in progress.pending.items()
+                if size != progress.size
+                and (progress.stage.name, size) not in self.done
+                and all(r in self.done for r in progress.stage.requires(size))
+            )
+
+    def report(self):
+        for name, progress in self.progress.items():
+            print(progress.describe())
+
+            METRICS.gauge("backlog", progress.backlog, stage=name)
+            METRICS.gauge("rows_per_s", progress.throughput, stage=name)
+            METRICS.gauge("queue_depth", self.get_queue_depth(progress), stage=name)
+        print()
+
+    def run(self):
+        db = connect_db()
+        self.done = get_done_tiers(db)
+        db.close()
+
+        for stage in self.stages:
+            pending = {
+                size: count
+                for size, count in self.expected_sizes.items()
+                if (stage.name, size) not in self.done
+            }
+            self.progress[stage.name] = StageProgress(stage=stage, pending=pending)
+
+        threads = [
+            threading.Thread(target=self.run_stage, args=[stage], daemon=True)
+            for stage in self.stages
+        ]
+        for t in threads:
+            t.start()
+
+        while any(t.is_alive() for t in threads):
+            deadline = time.time() + self.report_interval
+            for t in threads:
+                t.join(max(deadline - time.time(), 0))
+            self.report()
+
+        if self.error:
+            raise self.error
+
+
+_END = object()
+
+
+def in_background(
+    items: Iterable[T], max_queued: int = MAX_QUEUED_BATCHES
+) -> Iterator[T]:
+    """
+    Produces the items in another thread, at most max_queued ahead of the consumer
+
+    A full queue blocks the producer, so a slow consumer also bounds
+    the memory used by a fast producer. Exceptions are re-raised in the consumer
+    """
+
+    queue: Queue[tuple[Any, BaseException | None]] = Queue(maxsize=max_queued)
+    stopped = threading.Event()
+
+    def put(item: Any, error: BaseException | None = None) -> bool:
+        while not stopped.is_set():
+            try:
+                queue.put((item, error), timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce():
+        it = iter(items)
+        try:
+            for item in it:
+                if not put(item):
+                    return
+            put(_END)
+        except BaseException as e:
+            put(_END, e)
+        finally:
+            # Stops the upstream threads too if the items are another in_background()
+            close = getattr(it, "close", None)
+            if close:
+                close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item, error = queue.get()
+            if error:
+                raise error
+            if item is _END:
+                return
+            yield item
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def process_batches(
+    db: Database,
+    source: WorkSource,
+    compute: Callable[[list[int]], T],
+    write: Callable[[ParallelWriter, list[int], T], None],
+    stage: str,
+    writer: ParallelWriter,
+    max_queued: int = MAX_QUEUED_BATCHES,
+) -> Iterator[int]:
+    """
+    Fetches batch N + 1, computes batch N and writes batch N - 1 at the same time
+    and yields the number of comps in each committed batch
+
+    Fetches use their own connection and write() gets the caller's ParallelWriter,
+    the batch's checkpoint is saved once every shard is committed.
+    Pending rows only disappear once they're written,
+    so rather than wrapping around mid-pass (and refetching batches that are still queued)
+    every pass is drained before the next one starts from the beginning
+    """
+
+    labels = dict(source=source.name)
+
+    def compute_batches(batches: Iterable[list[int]]) -> Iterator[tuple[list[int], T]]:
+        for ids in batches:
+            with METRICS.phase(stage, "compute", **labels) as timing:
+                values = compute(ids)
+                timing.rows = len(ids)
+            yield ids, values
+
+    fetch_db = connect_db()
+    source.load(db)
+
+    try:
+        while True:
+            first_id = source.last_id
+            num_done = 0
+
+            fetched = in_background(
+                timed_batches(source.scan(fetch_db), stage, **labels), max_queued
+            )
+            computed = in_background(compute_batches(fetched), max_queued)
+
+            for ids, values in computed:
+                with METRICS.phase(stage, "write", **labels) as timing:
+                    write(writer, ids, values)
+                    source.save(db, ids[-1])
+                    timing.rows = len(ids)
+
+                num_done += len(ids)
+                yield len(ids)
+
+            # Rows may have been added behind the first pass
+            if not source.wrap or (first_id < 0 and not num_done):
+                break
+            source.last_id = -1
+
+        source.last_id = -1
+        source.save(db)
+    finally:
+        fetch_db.close()
+
+
+def add_batch_args(parser: argparse.ArgumentParser, batch_size: int):
+    group = parser.add_argument_group("batching")
+    group.add_argument(
+        "--batch-size",
+        type=int,
+        default=batch_size,
+        help="comps per fetch / write",
+    )
+    group.add_argument(
+        "--queue-depth",
+        type=int,
+        default=MAX_QUEUED_BATCHES,
+        help="batches the fetch / compute steps may run ahead of the writes",
+    )
+    group.add_argument(
+        "--writers",
+        type=int,
+        default=NUM_WRITERS,
+        help="connections to split each write over",
+    )
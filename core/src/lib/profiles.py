@@ -0,0 +1,184 @@
+from dataclasses import dataclass
+
+from lib.db import DatabaseOrCursor, DbTrait
+from lib.game_data import GameData
+from lib.scoring import TraitWeights
+
+
+@dataclass
+class ScoringProfile:
+    """
+    A named set of trait weight overrides
+
+    Every change bumps the profile's version and stamps the changed trait with it,
+    so the traits changed since the last complete scoring pass are the ones
+    with a version greater than scored_version.
+
+    started_version is the version the unfinished scoring run started from,
+    so if a first run is interrupted, the comps it scored can be rescored
+    after a weight change too
+    """
+
+    id: int
+    name: str
+    version: int
+    scored_version: int
+    started_version: int | None
+
+    # Weights of None mean the trait was reset to the default scoring
+    weights: dict[int, list[float] | None]
+    trait_versions: dict[int, int]
+
+    @property
+    def stale_traits(self) -> list[int]:
+        """
+        Traits changed since the oldest weights any existing score was computed with
+        """
+
+        if self.scored_version >= 0:
+            base = self.scored_version
+        elif self.started_version is not None:
+            base = self.started_version
+        else:
+            return []
+
+        return [id for id, version in self.trait_versions.items() if version > base]
+
+    def to_trait_weights(self, game: GameData) -> TraitWeights:
+        return {
+            game.traits[id]: weights
+            for id, weights in self.weights.items()
+            if weights is not None
+        }
+
+
+def get_profile(db: DatabaseOrCursor, name: str) -> ScoringProfile | None:
+    row = db.execute(
+        """
+        SELECT id, name, version, scored_version, started_version
+        FROM scoring_profiles
+        WHERE name = %s
+        """,
+        [name],
+    ).fetchone()
+    if not row:
+        return None
+
+    weight_rows = db.execute(
+        """
+        SELECT id_trait, weights, version
+        FROM scoring_profile_weights
+        WHERE id_profile = %s
+        """,
+        [row["id"]],
+    ).fetchall()
+
+    return ScoringProfile(
+        **row,
+        weights={r["id_trait"]: r["weights"] for r in weight_rows},
+        trait_versions={r["id_trait"]: r["version"] for r in weight_rows},
+    )
+
+
+def get_all_profiles(db: DatabaseOrCursor) -> list[ScoringProfile]:
+    rows = db.execute("SELECT name FROM scoring_profiles ORDER BY name").fetchall()
+    return [p for r in rows if (p := get_profile(db, r["name"]))]
+
+
+def create_profile(db: DatabaseOrCursor, name: str) -> ScoringProfile:
+    db.execute(
+        """
+        INSERT INTO scoring_profiles (name) VALUES (%s)
+        ON CONFLICT (name) DO NOTHING
+        """,
+        [name],
+    )
+
+    profile = get_profile(db, name)
+    assert profile
+    return profile
+
+
+def set_trait_weights(
+    db: DatabaseOrCursor,
+    profile: ScoringProfile,
+    trait: DbTrait,
+    weights: list[float] | None,
+) -> ScoringProfile:
+    if weights is not None:
+        assert len(weights) <= len(trait.thresholds), (trait, weights)
+
+    row = db.execute(
+        """
+        UPDATE scoring_profiles
+        SET version = version + 1
+        WHERE id = %s
+        RETURNING version
+        """,
+        [profile.id],
+    ).fetchone()
+    assert row
+
+    db.execute(
+        """
+        INSERT INTO scoring_profile_weights
+            (id_profile, id_trait, weights, version) VALUES
+            (%s, %s, %s, %s)
+        ON CONFLICT (id_profile, id_trait) DO UPDATE
+            SET weights = EXCLUDED.weights, version = EXCLUDED.version
+        """,
+        [profile.id, trait.id, weights, row["version"]],
+    )
+
+    updated = get_profile(db, profile.name)
+    assert updated
+    return updated
+
+
+def start_scoring(db: DatabaseOrCursor, profile: ScoringProfile) -> ScoringProfile:
+    """
+    Record the version a scoring run starts from, unless an interrupted run already did
+    """
+
+    db.execute(
+        """
+        UPDATE scoring_profiles
+        SET started_version = COALESCE(started_version, version)
+        WHERE id = %s
+        """,
+        [profile.id],
+    )
+
+    updated = get_profile(db, profile.name)
+    assert updated
+    return updated
+
+
+def mark_scored(db: DatabaseOrCursor, profile: ScoringProfile):
+    """
+    Record that every score is up to date as of the profile's (loaded) version
+    """
+
+    db.execute(
+        """
+        UPDATE scoring_profiles
+        SET scored_version = %s, started_version = NULL
+        WHERE id = %s
+        """,
+        [profile.version, profile.id],
+    )
+
+
+def parse_weights(game: GameData, arg: str) -> tuple[int, list[float] | None]:
+    name, _, values = arg.partition("=")
+
+    for trait in game.traits.values():
+        if trait.name.lower() == name.lower():
+            break
+    else:
+        raise Exception(f'Trait not found: "{name}"')
+
+    if values == "default":
+        return trait.id, None
+    else:
+        return trait.id, [float(v) for v in values.split(",")]
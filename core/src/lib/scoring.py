@@ -0,0 +1,138 @@
+from dataclasses import dataclass
+from typing import TypeAlias
+
+import numpy as np
+from lib.db import DbChampion, DbTrait
+
+TraitWeights: TypeAlias = dict[DbTrait, list[float]]
+
+# Rows per matrix multiplication, keeps the (N x champions) membership matrix at ~250MB
+ROWS_PER_CHUNK = 1 << 20
+
+# Fixed-point scale of score_checksum(), about the precision of a float32 score
+SCORE_CHECKSUM_SCALE = 1_000_000
+
+
+def score_checksum(scores: np.ndarray) -> int:
+    """
+    The sum of the scores in fixed point, to tell whether a tier was rescored
+
+    Each float32 score is widened to float64, scaled and truncated, which gives the same
+    integers in numpy, Postgres (trunc()) and SQLite (CAST AS INTEGER) so the sums match
+    """
+
+    total = 0
+    for start in range(0, len(scores), ROWS_PER_CHUNK):
+        chunk = np.asarray(scores[start : start + ROWS_PER_CHUNK], dtype=np.float64)
+        total += int(np.trunc(chunk * SCORE_CHECKSUM_SCALE).astype(np.int64).sum())
+
+    return total
+
+
+def score_trait(trait: DbTrait, count: int, overrides: list[float] | None) -> float:
+    score = 0
+
+    for idx, thresh in enumerate(trait.thresholds):
+        if count >= thresh:
+            if not overrides:
+                # No weight override, use default
+                score += 1
+            elif idx < len(overrides):
+                # Use weight override
+                score += overrides[idx]
+            else:
+                # Weight overrides for trait but not this count (which is larger than max threshold)
+                break
+        else:
+            # Thresholds are in ascending order so we stop checking when one is smaller
+            break
+
+    return score
+
+
+@dataclass
+class TraitMatrix:
+    """
+    Lookup tables for scoring compositions in bulk
+
+    champion_traits[i, j] is 1 if champion i has the trait trait_ids[j]
+    """
+
+    trait_ids: list[int]
+    champion_traits: np.ndarray
+
+    @property
+    def num_champions(self) -> int:
+        return self.champion_traits.shape[0]
+
+    @property
+    def max_count(self) -> int:
+        return int(self.champion_traits.sum(axis=0).max())
+
+
+def get_trait_matrix(
+    champions: dict[int, DbChampion], traits: dict[int, DbTrait]
+) -> TraitMatrix:
+    trait_ids = sorted(traits)
+    trait_idxs = {id: idx for idx, id in enumerate(trait_ids)}
+
+    champion_traits = np.zeros((max(champions) + 1, len(trait_ids)), dtype=np.float32)
+    for champ in champions.values():
+        for id in champ.traits:
+            champion_traits[champ.id, trait_idxs[id]] = 1
+
+    return TraitMatrix(trait_ids=trait_ids, champion_traits=champion_traits)
+
+
+def get_score_table(
+    matrix: TraitMatrix, traits: dict[int, DbTrait], weights: TraitWeights
+) -> np.ndarray:
+    """
+    Precompute score_trait() for every (trait, count) pair
+    """
+
+    table = np.zeros((len(matrix.trait_ids), matrix.max_count + 1), dtype=np.float32)
+    for idx, id in enumerate(matrix.trait_ids):
+        trait = traits[id]
+        for count in range(table.shape[1]):
+            table[idx, count] = score_trait(trait, count, weights.get(trait))
+
+    return table
+
+
+def to_membership(matrix: TraitMatrix, masks: np.ndarray) -> np.ndarray:
+    """
+    Convert N composition bitmasks into an (N x champions) matrix of 0s and 1s
+    """
+
+    bits = np.arange(matrix.num_champions, dtype=np.uint64)
+    membership = (masks.astype(np.uint64)[:, None] >> bits) & np.uint64(1)
+    return membership.astype(np.float32)
+
+
+def count_traits(matrix: TraitMatrix, masks: np.ndarray) -> np.ndarray:
+    """
+    Returns an (N x traits) matrix of trait counts, columns follow matrix.trait_ids
+    """
+
+    counts = np.empty((len(masks), len(matrix.trait_ids)), dtype=np.uint8)
+    for start in range(0, len(masks), ROWS_PER_CHUNK):
+        end = start + ROWS_PER_CHUNK
+        membership = to_membership(matrix, masks[start:end])
+        counts[start:end] = membership @ matrix.champion_traits
+
+    return counts
+
+
+def calc_scores(
+    matrix: TraitMatrix, score_table: np.ndarray, masks: np.ndarray
+) -> np.ndarray:
+    trait_idxs = np.arange(len(matrix.trait_ids))
+
+    scores = np.empty(len(masks), dtype=np.float32)
+    for start in range(0, len(masks), ROWS_PER_CHUNK):
+        end = start + ROWS_PER_CHUNK
+        counts = count_traits(matrix, masks[start:end])
+        scores[start:end] = score_table[trait_idxs, counts].sum(axis=1)
+
+    return scores
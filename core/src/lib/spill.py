@@ -0,0 +1,188 @@
+import argparse
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+from lib.config import DATA_DIR
+from lib.metrics import METRICS
+from numpy.typing import ArrayLike
+
+# Bytes of ids a SpillSorter holds in memory
+DEFAULT_MAX_MEMORY = 512 * 1024**2
+
+DEFAULT_SPILL_DIR = DATA_DIR / "spill"
+
+_ID_BYTES = np.dtype(np.int64).itemsize
+
+
+def unique_sorted(ids: np.ndarray) -> np.ndarray:
+    """
+    Drop the repeats from a sorted array
+    """
+
+    if len(ids) < 2:
+        return ids
+
+    keep = np.empty(len(ids), dtype=bool)
+    keep[0] = True
+    np.not_equal(ids[1:], ids[:-1], out=keep[1:])
+    return ids[keep]
+
+
+class SpillSorter:
+    """
+    Sorts and dedupes a stream of int64 ids (eg comp bitmasks) with a fixed memory budget
+
+    Ids go into a preallocated buffer. Whenever it fills up, the buffer is sorted, deduped
+    and written to disk as a run. merge() then does a k-way merge of the runs a block
+    of each at a time, so peak memory is about max_bytes however many ids are added.
+    If nothing was spilled the buffer is sorted in place without touching the disk.
+    Nothing can be added once the merge has started
+    """
+
+    def __init__(
+        self, max_bytes: int = DEFAULT_MAX_MEMORY, dir: Path = DEFAULT_SPILL_DIR
+    ) -> None:
+        # Deduping a full buffer briefly needs a second one
+        self.capacity = max(1, max_bytes // (2 * _ID_BYTES))
+        self.buffer = np.empty(self.capacity, dtype=np.int64)
+        self.num_buffered = 0
+
+        self.dir = dir
+        self.run_dir: Path | None = None
+        self.runs: list[Path] = []
+
+    def add(self, ids: ArrayLike):
+        ids = np.asarray(ids, dtype=np.int64)
+
+        while len(ids):
+            count = min(len(ids), self.capacity - self.num_buffered)
+            self.buffer[self.num_buffered : self.num_buffered + count] = ids[:count]
+            self.num_buffered += count
+            ids = ids[count:]
+
+            if self.num_buffered == self.capacity:
+                self.spill()
+
+    def _sort_buffer(self) -> np.ndarray:
+        ids = self.buffer[: self.num_buffered]
+        ids.sort()
+        self.num_buffered = 0
+
+        return unique_sorted(ids)
+
+    def spill(self):
+        """
+        Write the buffered ids to disk as a sorted run
+        """
+
+        if not self.num_buffered:
+            return
+
+        if self.run_dir is None:
+            self.dir.mkdir(parents=True, exist_ok=True)
+            self.run_dir = Path(tempfile.mkdtemp(prefix="runs_", dir=self.dir))
+
+        with METRICS.phase("spill", "write") as timing:
+            run = self._sort_buffer()
+            path = self.run_dir / f"run_{len(self.runs)}.npy"
+            np.save(path, run)
+            timing.rows = len(run)
+
+        self.runs.append(path)
+        METRICS.count("spill_bytes", run.nbytes)
+
+    def merge(self) -> Iterator[np.ndarray]:
+        """
+        Yields every id added so far in ascending order and without repeats,
+        in chunks of at most capacity ids
+        """
+
+        if not self.runs:
+            ids = self._sort_buffer()
+            if len(ids):
+                yield ids
+            return
+
+        # The merge gets the buffer's share of the budget
+        self.spill()
+        self.buffer = np.empty(0, dtype=np.int64)
+
+        # Memory-mapped, only the blocks being merged are read
+        runs = [np.load(path, mmap_mode="r") for path in self.runs]
+        starts = [0] * len(runs)
+        block_size = max(1, self.capacity // len(runs))
+
+        while True:
+            blocks = [run[s : s + block_size] for run, s in zip(runs, starts)]
+            active = [b for b in blocks if len(b)]
+            if not active:
+                return
+
+            # Every id up to the lowest block end is in the current blocks
+            # since each run is sorted, so those can be merged without the rest of the runs
+            bound = min(b[-1] for b in active)
+
+            parts: list[np.ndarray] = []
+            for idx, block in enumerate(blocks):
+                end = int(np.searchsorted(block, bound, side="right"))
+                parts.append(block[:end])
+                starts[idx] += end
+
+            merged = np.concatenate(parts)
+            merged.sort()
+            yield unique_sorted(merged)
+
+    def save(self, path: Path) -> np.ndarray:
+        """
+        merge() into a raw int64 file and return it memory-mapped
+        """
+
+        num_ids = 0
+        with open(path, "wb") as file:
+            for ids in self.merge():
+                file.write(ids.tobytes())
+                num_ids += len(ids)
+
+        if not num_ids:
+            return np.empty(0, dtype=np.int64)
+        return np.memmap(path, dtype=np.int64, mode="r")
+
+    def close(self):
+        if self.run_dir is not None:
+            shutil.rmtree(self.run_dir, ignore_errors=True)
+            self.run_dir = None
+        self.runs = []
+
+    def __enter__(self) -> "SpillSorter":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def add_spill_args(parser: argparse.ArgumentParser):
+    group = parser.add_argument_group("spilling")
+    group.add_argument(
+        "--max-memory",
+        type=int,
+        metavar="MB",
+        help="expand each tier with at most this much memory for its comp ids, spilling sorted runs to disk",
+    )
+    group.add_argument(
+        "--spill-dir",
+        type=Path,
+        default=DEFAULT_SPILL_DIR,
+        help="where the sorted runs and expanded tiers are written with --max-memory",
+    )
+
+
+def spill_from_args(args: argparse.Namespace) -> dict:
+    """
+    max_memory (in bytes) / spill_dir kwargs for main_tiers() / expand_to()
+    """
+
+    max_memory = args.max_memory * 1024**2 if args.max_memory else None
+    return dict(max_memory=max_memory, spill_dir=args.spill_dir)
@@ -0,0 +1,434 @@
+import json
+import sqlite3
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Callable, ContextManager, Iterator, Sized, cast
+
+import numpy as np
+from lib.db import (
+    Columns,
+    Database,
+    DbChampion,
+    DbTrait,
+    copy_batch,
+    delete_tier,
+    encode_copy_batch,
+    init_db,
+    mark_done,
+    read_tier_ids,
+)
+from lib.export import to_game_data_rows
+from lib.game_data import GameData, build_game_data, load_game_data
+from lib.pipeline import get_done_tiers, mark_tier_done
+
+# Tables whose rows are work still to do rather than results, see Storage.fetch_pending()
+TODO_TABLES = ["needs_expansion", "needs_champions"]
+
+
+class Storage(ABC):
+    """
+    What the tier pipeline needs from a database (see run_storage() in pipeline.py),
+    so it can run on Postgres or on a local SQLite file / in-memory db
+
+    Writes outside of transaction() are committed immediately
+    """
+
+    name: str
+
+    @abstractmethod
+    def get_game_data(self) -> GameData: ...
+
+    @abstractmethod
+    def get_done_tiers(self) -> set[tuple[str, int]]:
+        """
+        The (stage, size) pairs in pipeline_tiers
+        """
+
+    @abstractmethod
+    def mark_tier_done(self, stage: str, size: int): ...
+
+    @abstractmethod
+    def read_tier(self, size: int) -> np.ndarray:
+        """
+        The tier's comp ids in ascending order
+        """
+
+    def insert_tier(self, size: int, comp_ids: np.ndarray):
+        self.insert_rows(
+            "compositions", dict(id=("bigint", comp_ids), size=("integer", size))
+        )
+        self.insert_rows("needs_champions", dict(id_composition=("bigint", comp_ids)))
+
+    @abstractmethod
+    def delete_tier(self, size: int):
+        """
+        Remove a tier's comps, everything derived from them and its pipeline_tiers rows
+        """
+
+    @abstractmethod
+    def insert_rows(self, table: str, columns: Columns): ...
+
+    @abstractmethod
+    def fetch_pending(self, table: str, size: int, after: int, limit: int) -> list[int]:
+        """
+        The next ids (> after) of the comps of a size with a row in table, for TODO_TABLES,
+        or without one otherwise (eg the comps that aren't scored yet)
+        """
+
+    @abstractmethod
+    def mark_done(self, table: str, comp_ids: list[int]):
+        """
+        Delete the comps' rows from a todo table
+        """
+
+    @abstractmethod
+    def transaction(self) -> ContextManager: ...
+
+    @abstractmethod
+    def close(self): ...
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PostgresStorage(Storage):
+    name = "postgres"
+
+    def __init__(self, db: Database | None = None) -> None:
+        self.db = db or init_db()
+
+    def get_game_data(self) -> GameData:
+        return load_game_data(self.db)
+
+    def get_done_tiers(self) -> set[tuple[str, int]]:
+        return get_done_tiers(self.db)
+
+    def mark_tier_done(self, stage: str, size: int):
+        mark_tier_done(self.db, stage, size)
+
+    def read_tier(self, size: int) -> np.ndarray:
+        return read_tier_ids(self.db, size)
+
+    def delete_tier(self, size: int):
+        delete_tier(self.db, size)
+
+    def insert_rows(self, table: str, columns: Columns):
+        copy_batch(self.db.cursor(), table, encode_copy_batch(columns))
+
+    def fetch_pending(self, table: str, size: int, after: int, limit: int) -> list[int]:
+        condition = "EXISTS" if table in TODO_TABLES else "NOT EXISTS"
+        rows = self.db.execute(
+            f"""
+            SELECT c.id
+            FROM compositions c
+            WHERE
+                c.size = %(size)s
+                AND c.id > %(after)s
+                AND {condition} (
+                    SELECT 1 FROM {table} t
+                    WHERE t.id_composition = c.id
+                )
+            ORDER BY c.id
+            LIMIT %(limit)s
+            """,
+            dict(size=size, after=after, limit=limit),
+        ).fetchall()
+        return [r["id"] for r in rows]
+
+    def mark_done(self, table: str, comp_ids: list[int]):
+        mark_done(self.db, table, comp_ids)
+
+    def transaction(self) -> ContextManager:
+        return self.db.transaction()
+
+    def close(self):
+        self.db.close()
+
+
+SQLITE_STORAGE_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS champions (
+        id          INTEGER     PRIMARY KEY,
+
+        cost        INTEGER     NOT NULL,
+        name        TEXT        NOT NULL,
+        range       INTEGER     NOT NULL,
+        uses_ap     INTEGER     NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS traits (
+        id      INTEGER     PRIMARY KEY,
+
+        name    TEXT        NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS trait_thresholds (
+        id          INTEGER     PRIMARY KEY,
+        id_trait    INTEGER     NOT NULL,
+
+        threshold   INTEGER     NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS champion_traits (
+        id_champion     INTEGER     NOT NULL,
+        id_trait        INTEGER     NOT NULL,
+
+        PRIMARY KEY (id_champion, id_trait)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS compositions (
+        id      INTEGER     PRIMARY KEY,
+
+        size    INTEGER     NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS compositions_size_id_idx ON compositions (size, id)",
+    """
+    CREATE TABLE IF NOT EXISTS composition_champions (
+        id_composition      INTEGER     NOT NULL,
+        id_champion         INTEGER     NOT NULL,
+        size                INTEGER,
+
+        PRIMARY KEY (id_champion, id_composition)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS scores_by_trait (
+        id_composition      INTEGER     PRIMARY KEY,
+        size                INTEGER,
+
+        score               REAL        NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS needs_expansion (
+        id_composition      INTEGER     PRIMARY KEY
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS needs_champions (
+        id_composition      INTEGER     PRIMARY KEY
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS pipeline_tiers (
+        stage       TEXT        NOT NULL,
+        size        INTEGER     NOT NULL,
+
+        PRIMARY KEY (stage, size)
+    )
+    """,
+]
+
+# Per-comp tables, cleared when a tier is deleted
+_SQLITE_TIER_TABLES = [
+    "composition_champions",
+    "scores_by_trait",
+    "needs_expansion",
+    "needs_champions",
+]
+
+
+class SqliteStorage(Storage):
+    """
+    The same tables in a SQLite file, or in memory with the default path
+
+    The game data is seeded from data/_champions.py like init_db() does
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str = ":memory:") -> None:
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute("PRAGMA cache_size = -1000000")
+
+        for statement in SQLITE_STORAGE_SCHEMA:
+            self.conn.execute(statement)
+
+        if not self.conn.execute("SELECT 1 FROM champions LIMIT 1").fetchone():
+            with self.transaction():
+                for table, rows in to_game_data_rows(build_game_data()).items():
+                    placeholders = ", ".join("?" * len(rows[0]))
+                    self.conn.executemany(
+                        f"INSERT INTO {table} VALUES ({placeholders})", rows
+                    )
+
+    def get_game_data(self) -> GameData:
+        thresholds: dict[int, list[int]] = dict()
+        for id_trait, threshold in self.conn.execute(
+            "SELECT id_trait, threshold FROM trait_thresholds ORDER BY threshold"
+        ):
+            thresholds.setdefault(id_trait, []).append(threshold)
+
+        champion_traits: dict[int, list[int]] = dict()
+        for id_champion, id_trait in self.conn.execute(
+            "SELECT id_champion, id_trait FROM champion_traits"
+        ):
+            champion_traits.setdefault(id_champion, []).append(id_trait)
+
+        traits = {
+            id: DbTrait(id=id, name=name, thresholds=thresholds.get(id, []))
+            for id, name in self.conn.execute("SELECT id, name FROM traits")
+        }
+        champions = {
+            id: DbChampion(
+                id=id,
+                cost=cost,
+                name=name,
+                range=range,
+                uses_ap=bool(uses_ap),
+                traits=champion_traits.get(id, []),
+            )
+            for id, cost, name, range, uses_ap in self.conn.execute(
+                "SELECT id, cost, name, range, uses_ap FROM champions"
+            )
+        }
+
+        return GameData(champions=champions, traits=traits)
+
+    def get_done_tiers(self) -> set[tuple[str, int]]:
+        rows = self.conn.execute("SELECT stage, size FROM pipeline_tiers")
+        return {(stage, size) for stage, size in rows}
+
+    def mark_tier_done(self, stage: str, size: int):
+        self.conn.execute(
+            "INSERT OR IGNORE INTO pipeline_tiers (stage, size) VALUES (?, ?)",
+            [stage, size],
+        )
+
+    def read_tier(self, size: int) -> np.ndarray:
+        rows = self.conn.execute(
+            "SELECT id FROM compositions WHERE size = ? ORDER BY id", [size]
+        )
+        return np.fromiter((id for id, in rows), dtype=np.int64)
+
+    def delete_tier(self, size: int):
+        with self.transaction():
+            for table in _SQLITE_TIER_TABLES:
+                self.conn.execute(
+                    f"""
+                    DELETE FROM {table}
+                    WHERE id_composition IN (SELECT id FROM compositions WHERE size = ?)
+                    """,
+                    [size],
+                )
+            self.conn.execute("DELETE FROM compositions WHERE size = ?", [size])
+            self.conn.execute("DELETE FROM pipeline_tiers WHERE size = ?", [size])
+
+    def insert_rows(self, table: str, columns: Columns):
+        # Scalars (eg a tier's size) are broadcast, like encode_copy_batch()
+        num_rows = 0
+        for _, values in columns.values():
+            if np.ndim(values) > 0:
+                num_rows = len(cast(Sized, values))
+
+        values = [
+            np.broadcast_to(np.asarray(v), (num_rows,)).tolist()
+            for _, v in columns.values()
+        ]
+        placeholders = ", ".join("?" * len(columns))
+        self.conn.executemany(
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})",
+            zip(*values),
+        )
+
+    def fetch_pending(self, table: str, size: int, after: int, limit: int) -> list[int]:
+        condition = "EXISTS" if table in TODO_TABLES else "NOT EXISTS"
+        rows = self.conn.execute(
+            f"""
+            SELECT c.id
+            FROM compositions c
+            WHERE
+                c.size = :size
+                AND c.id > :after
+                AND {condition} (
+                    SELECT 1 FROM {table} t
+                    WHERE t.id_composition = c.id
+                )
+            ORDER BY c.id
+            LIMIT :limit
+            """,
+            dict(size=size, after=after, limit=limit),
+        )
+        return [id for id, in rows]
+
+    def mark_done(self, table: str, comp_ids: list[int]):
+        # One statement per batch, like lib.db.mark_done()
+        self.conn.execute(
+            f"""
+            DELETE FROM {table}
+            WHERE id_composition IN (SELECT value FROM json_each(?))
+            """,
+            [json.dumps(comp_ids)],
+        )
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        # Nested blocks become savepoints, like psycopg's
+        if self.conn.in_transaction:
+            begin, commit, rollback = (
+                ["SAVEPOINT nested"],
+                ["RELEASE nested"],
+                ["ROLLBACK TO nested", "RELEASE nested"],
+            )
+        else:
+            begin, commit, rollback = ["BEGIN"], ["COMMIT"], ["ROLLBACK"]
+
+        for statement in begin:
+            self.conn.execute(statement)
+        try:
+            yield
+        except BaseException:
+            for statement in rollback:
+                self.conn.execute(statement)
+            raise
+        for statement in commit:
+            self.conn.execute(statement)
+
+    def close(self):
+        self.conn.close()
+
+
+def open_storage(spec: str) -> Storage:
+    """
+    "postgres" (at lib.db.DB_URL), "sqlite:<path>" or "memory"
+    """
+
+    if spec == "memory":
+        return SqliteStorage()
+    elif spec.startswith("sqlite:"):
+        return SqliteStorage(spec.removeprefix("sqlite:"))
+    elif spec == "postgres":
+        return PostgresStorage()
+    else:
+        raise Exception(f'Unknown storage: "{spec}"')
+
+
+def process_pending(
+    storage: Storage,
+    table: str,
+    size: int,
+    batch_size: int,
+    write: Callable[[np.ndarray], None],
+) -> Iterator[int]:
+    """
+    write() every batch of a tier's pending comps in its own transaction,
+    yields the number of comps in each batch
+    """
+
+    after = -1
+    while ids := storage.fetch_pending(table, size, after, batch_size):
+        with storage.transaction():
+            write(np.array(ids, dtype=np.int64))
+
+        after = ids[-1]
+        yield len(ids)
@@ -0,0 +1,313 @@
+import heapq
+from dataclasses import dataclass, field
+
+from lib.composition import Composition, ids_to_mask
+from lib.game_data import GameData
+from lib.scoring import TraitWeights, get_score_table, get_trait_matrix
+
+
+@dataclass
+class TopKConstraints:
+    required: set[int] = field(default_factory=set)
+    excluded: set[int] = field(default_factory=set)
+    max_cost: int | None = None
+
+
+@dataclass
+class RankedComp:
+    comp: Composition
+    score: float
+
+
+def _hull_slopes(gains: list[float]) -> list[float]:
+    """
+    Per-champion increments of the upper concave envelope of gains[0..m],
+    keeping only the positive ones (adding fewer champions is always an option)
+    """
+
+    slopes: list[float] = []
+    start = 0
+    while start < len(gains) - 1:
+        end, slope = max(
+            (
+                (end, (gains[end] - gains[start]) / (end - start))
+                for end in range(start + 1, len(gains))
+            ),
+            key=lambda x: (x[1], x[0]),
+        )
+        if slope <= 0:
+            break
+
+        slopes.extend([slope] * (end - start))
+        start = end
+
+    return slopes
+
+
+class _Search:
+    """
+    Branch-and-bound over the comps that expand_comps.py generates,
+    ie the champion sets whose trait-sharing graph is connected
+
+    Each connected set is enumerated exactly once from its lowest champion id
+    (the ESU algorithm, Wernicke 2006) and a branch is cut when an upper bound on
+    the best score reachable from it can't beat the current k-th best comp.
+
+    The bound relaxes the remaining picks into "trait slots":
+    the r champions still to be picked add at most S trait memberships (the r largest
+    trait counts among the candidates) and trait t can get at most min(r, candidates with t).
+    Spending those slots on the concave envelopes of the per-trait score gains
+    is a fractional knapsack, solved greedily.
+    """
+
+    def __init__(
+        self,
+        game: GameData,
+        weights: TraitWeights,
+        size: int,
+        k: int,
+        constraints: TopKConstraints,
+    ) -> None:
+        self.size = size
+        self.k = k
+
+        matrix = get_trait_matrix(game.champions, game.traits)
+        table = get_score_table(matrix, game.traits, weights).tolist()
+        self.trait_ids = matrix.trait_ids
+        self.score_table: list[list[float]] = table
+
+        allowed = 0
+        for champ in game.champions.values():
+            if champ.id in constraints.excluded:
+                continue
+            if constraints.max_cost is not None and champ.cost > constraints.max_cost:
+                continue
+            allowed |= 1 << champ.id
+        self.allowed = allowed
+        self.required = ids_to_mask(constraints.required)
+
+        trait_idxs = {id: idx for idx, id in enumerate(self.trait_ids)}
+        self.champion_traits: dict[int, list[int]] = {
+            champ.id: [trait_idxs[id] for id in champ.traits]
+            for champ in game.champions.values()
+        }
+
+        # trait idx -> mask of the allowed champions with that trait
+        self.trait_masks = [0] * len(self.trait_ids)
+        for champ in game.champions.values():
+            if allowed >> champ.id & 1:
+                for idx in self.champion_traits[champ.id]:
+                    self.trait_masks[idx] |= 1 << champ.id
+
+        # champion -> mask of the allowed champions sharing a trait with it
+        self.neighbors: dict[int, int] = dict()
+        for champ in game.champions.values():
+            mask = 0
+            for idx in self.champion_traits[champ.id]:
+                mask |= self.trait_masks[idx]
+            self.neighbors[champ.id] = mask & ~(1 << champ.id)
+
+        # number of traits -> mask of the allowed champions with that many traits
+        self.masks_by_num_traits: list[tuple[int, int]] = []
+        for num_traits in sorted(
+            {len(ts) for ts in self.champion_traits.values()}, reverse=True
+        ):
+            mask = 0
+            for id, ts in self.champion_traits.items():
+                if len(ts) == num_traits and allowed >> id & 1:
+                    mask |= 1 << id
+            self.masks_by_num_traits.append((num_traits, mask))
+
+        # slopes[t][count][m] = envelope increments for adding up to m champions with trait t
+        self.slopes: list[list[list[list[float]]]] = []
+        for row in table:
+            max_count = len(row) - 1
+            self.slopes.append(
+                [
+                    [
+                        _hull_slopes(
+                            [row[count + j] - row[count] for j in range(m + 1)]
+                        )
+                        for m in range(max_count - count + 1)
+                    ]
+                    for count in range(max_count + 1)
+                ]
+            )
+
+        # increments[t][count] = score change from the count-th to the (count + 1)-th champion with trait t
+        self.increments = [
+            [row[count + 1] - row[count] for count in range(len(row) - 1)]
+            for row in table
+        ]
+
+        self.heap: list[tuple[float, int]] = []
+        self.num_nodes = 0
+
+    @property
+    def threshold(self) -> float:
+        if len(self.heap) < self.k:
+            return float("-inf")
+        return self.heap[0][0]
+
+    def upper_bound(self, score: float, counts: list[int], candidates: int, r: int):
+        num_slots = 0
+        remaining = r
+        for num_traits, mask in self.masks_by_num_traits:
+            n = min(remaining, (candidates & mask).bit_count())
+            num_slots += n * num_traits
+            remaining -= n
+            if not remaining:
+                break
+
+        increments: list[float] = []
+        steepest = [0.0] * len(self.trait_masks)
+        for idx, trait_mask in enumerate(self.trait_masks):
+            available = (candidates & trait_mask).bit_count()
+            if available:
+                slopes = self.slopes[idx][counts[idx]]
+                slopes = slopes[min(r, available, len(slopes) - 1)]
+                if slopes:
+                    increments.extend(slopes)
+                    steepest[idx] = slopes[0]
+
+        increments.sort(reverse=True)
+        slot_bound = sum(increments[:num_slots])
+
+        # The envelopes are concave so a champion gains at most
+        # the sum of its traits' steepest slopes
+        champion_gains: list[float] = []
+        while candidates:
+            bit = candidates & -candidates
+            candidates ^= bit
+            gain = 0.0
+            for idx in self.champion_traits[bit.bit_length() - 1]:
+                gain += steepest[idx]
+            champion_gains.append(gain)
+
+        champion_gains.sort(reverse=True)
+        champion_bound = sum(champion_gains[:r])
+
+        return score + min(slot_bound, champion_bound)
+
+    def push(self, score: float, mask: int):
+        if mask & self.required != self.required:
+            return
+
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, (score, mask))
+        elif score > self.heap[0][0]:
+            heapq.heapreplace(self.heap, (score, mask))
+
+    def add(self, score: float, counts: list[int], id: int) -> float:
+        for idx in self.champion_traits[id]:
+            score += self.increments[idx][counts[idx]]
+            counts[idx] += 1
+        return score
+
+    def remove(self, counts: list[int], id: int):
+        for idx in self.champion_traits[id]:
+            counts[idx] -= 1
+
+    def extend(
+        self,
+        mask: int,
+        num_members: int,
+        score: float,
+        counts: list[int],
+        extension: int,
+        closed: int,
+        above: int,
+    ):
+        """
+        mask is the current comp, extension the champions that may be added next,
+        closed the comp plus its neighbors and above the allowed champions
+        with a larger id than the comp's lowest one
+        """
+
+        self.num_nodes += 1
+
+        if num_members == self.size:
+            self.push(score, mask)
+            return
+
+        r = self.size - num_members
+        if r == 1:
+            # Score the last pick in place instead of recursing,
+            # most of the tree is this level
+            while extension:
+                bit = extension & -extension
+                extension ^= bit
+                id = bit.bit_length() - 1
+
+                gain = 0
+                for idx in self.champion_traits[id]:
+                    gain += self.increments[idx][counts[idx]]
+                self.push(score + gain, mask | bit)
+            return
+
+        # Every champion that can still join this branch
+        candidates = extension | (above & ~closed)
+        if (mask | candidates) & self.required != self.required:
+            return
+        if candidates.bit_count() < r:
+            return
+        if self.upper_bound(score, counts, candidates, r) <= self.threshold:
+            return
+
+        while extension:
+            bit = extension & -extension
+            extension ^= bit
+            id = bit.bit_length() - 1
+
+            child_score = self.add(score, counts, id)
+            neighbors = self.neighbors[id]
+            self.extend(
+                mask | bit,
+                num_members + 1,
+                child_score,
+                counts,
+                extension | (neighbors & above & ~closed),
+                closed | neighbors | bit,
+                above,
+            )
+            self.remove(counts, id)
+
+    def run(self) -> list[RankedComp]:
+        lowest_required = (self.required & -self.required).bit_length() - 1
+        empty_score = sum(row[0] for row in self.score_table)
+
+        ids = [id for id in self.champion_traits if self.allowed >> id & 1]
+        for id in sorted(ids):
+            if self.required and id > lowest_required:
+                break
+
+            bit = 1 << id
+            above = self.allowed & ~((bit << 1) - 1)
+            neighbors = self.neighbors[id]
+
+            counts = [0] * len(self.trait_ids)
+            score = self.add(empty_score, counts, id)
+            self.extend(
+                bit, 1, score, counts, neighbors & above, neighbors | bit, above
+            )
+
+        ranked = sorted(self.heap, key=lambda x: (-x[0], x[1]))
+        return [
+            RankedComp(comp=Composition(mask), score=score) for score, mask in ranked
+        ]
+
+
+def find_top_comps(
+    game: GameData,
+    weights: TraitWeights,
+    size: int,
+    k: int,
+    constraints: TopKConstraints | None = None,
+) -> list[RankedComp]:
+    """
+    Returns the k best comps of the given size, best first,
+    without generating the rest of the tier
+    """
+
+    search = _Search(game, weights, size, k, constraints or TopKConstraints())
+    return search.run()
@@ -0,0 +1,565 @@
+import argparse
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Iterable, Iterator
+
+import numpy as np
+import psycopg
+from lib.bulk import defer_constraints, restore_constraints
+from lib.columnar import ColumnarStore
+from lib.db import (
+    DB_URL,
+    PARTITIONED_TABLES,
+    CopyBatch,
+    Database,
+    ParallelWriter,
+    connect_db,
+    copy_batch,
+    count_tier_rows,
+    delete_tier,
+    encode_copy_batch,
+    get_partition,
+    init_db,
+    is_partitioned,
+    mark_done,
+    read_tier_ids,
+)
+from lib.game_data import get_game_data
+from lib.leases import LEASE_TIMEOUT, Lease, LeasedStage, run_workers
+from lib.metrics import METRICS, add_metrics_args, metrics_from_args
+from lib.pipeline import (
+    MARK_TIER_DONE,
+    Pipeline,
+    Stage,
+    add_batch_args,
+)
+from lib.scoring import calc_scores
+from lib.spill import (
+    DEFAULT_MAX_MEMORY,
+    DEFAULT_SPILL_DIR,
+    add_spill_args,
+    spill_from_args,
+)
+from lib.storage import Storage, open_storage, process_pending
+from lib.utils import print_elapsed
+from psycopg.rows import dict_row
+
+from expand_comps import (
+    COMPS_PER_TIER_BATCH,
+    EXPECTED_TIER_SIZES,
+    MAX_TEAM_SIZE,
+    N_WORKERS,
+    create_pool,
+    expand_tier,
+    expand_tier_spilled,
+    fetch_tier,
+    seed_tier,
+    write_tier,
+    write_tier_chunks,
+)
+from init_comp_champs import (
+    comp_champ_columns,
+    encode_comp_champs,
+    insert_comp_champs_sql,
+)
+from score_by_trait import (
+    COMPS_PER_ITERATION,
+    encode_scores,
+    get_default_score_table,
+    init_trait_weights,
+    score_columnar,
+    score_columns,
+    score_comps,
+)
+
+
+async def expand_to(
+    exe: ProcessPoolExecutor,
+    writer: ParallelWriter,
+    size: int,
+    max_memory: int | None = None,
+    spill_dir: Path = DEFAULT_SPILL_DIR,
+) -> int:
+    """
+    Expand the previous tier into this one, with max_memory see expand_tier_spilled()
+    """
+
+    async with await psycopg.AsyncConnection.connect(
+        DB_URL, row_factory=dict_row, autocommit=True
+    ) as conn:
+        if size == 1:
+            tier = seed_tier(get_game_data())
+            await asyncio.to_thread(write_tier, writer, tier, size)
+        elif max_memory:
+            with connect_db() as db:
+                parents = read_tier_ids(db, size - 1)
+
+            spill_dir.mkdir(parents=True, exist_ok=True)
+            path = spill_dir / f"size_{size}.ids"
+            try:
+                tier = expand_tier_spilled(exe, parents, path, max_memory)
+                await asyncio.to_thread(write_tier_chunks, writer, tier, size)
+            finally:
+                path.unlink(missing_ok=True)
+        else:
+            tier = expand_tier(exe, await fetch_tier(conn, size - 1))
+            await asyncio.to_thread(write_tier_chunks, writer, tier, size)
+
+        await conn.execute(MARK_TIER_DONE, ["expand", size])
+
+    return len(tier)
+
+
+def create_stages(
+    exe: ProcessPoolExecutor,
+    writer: ParallelWriter,
+    batch_size: int,
+    max_queued: int,
+    partitioned: bool,
+    max_memory: int | None = None,
+    spill_dir: Path = DEFAULT_SPILL_DIR,
+) -> list[Stage]:
+    def expand(db: Database, size: int) -> Iterator[int]:
+        # The tier isn't marked done yet so anything there is from an interrupted run
+        if counts := count_tier_rows(db, size):
+            cleared = ", ".join(f"{n:,} {table}" for table, n in counts.items())
+            print(f"clearing a partially expanded tier of size {size}: {cleared}")
+            delete_tier(db, size)
+        yield asyncio.run(expand_to(exe, writer, size, max_memory, spill_dir))
+
+    def memberships(db: Database, size: int) -> Iterator[int]:
+        with db.transaction():
+            count = insert_comp_champs_sql(db.cursor(), size)
+        yield count // size
+
+    def scores(db: Database, size: int) -> Iterator[int]:
+        return score_comps(db, writer, size, batch_size, max_queued)
+
+    def freeze(db: Database, size: int) -> Iterable[int]:
+        # Nothing writes to a finished tier again, so it's frozen once
+        # instead of autovacuum rescanning it as the later tiers grow
+        partitions = [get_partition(t, size) for t in PARTITIONED_TABLES]
+        db.execute(f"VACUUM (FREEZE, ANALYZE) {', '.join(partitions)}")
+        return []
+
+    def after_expand(size: int) -> list[tuple[str, int]]:
+        return [("expand", size)]
+
+    stages = [
+        Stage(
+            "expand",
+            expand,
+            requires=lambda size: [("expand", size - 1)] if size > 1 else [],
+        ),
+        Stage("memberships", memberships, requires=after_expand),
+        Stage("scores", scores, requires=after_expand),
+    ]
+
+    if partitioned:
+        names = [s.name for s in stages]
+        stages.append(
+            Stage(
+                "freeze",
+                freeze,
+                requires=lambda size: [(name, size) for name in names],
+            )
+        )
+
+    return stages
+
+
+def run_columnar(
+    exe: ProcessPoolExecutor,
+    store: ColumnarStore,
+    max_size: int,
+    batch_size: int,
+    max_memory: int | None = None,
+    spill_dir: Path = DEFAULT_SPILL_DIR,
+):
+    """
+    expand -> scores for each tier without a database, see ColumnarStore
+
+    Each tier is expanded with expand_tier_spilled(), so only max_memory of its ids
+    are in memory at once. A tier's columns are skipped if they already exist,
+    so a restarted run resumes from the first missing one
+    """
+
+    for size in range(1, max_size + 1):
+        if not store.has_column(size, "ids"):
+            start = time.time()
+            with METRICS.timer("tier", stage="expand", size=size) as timing:
+                if size == 1:
+                    tier = np.array(seed_tier(get_game_data()), dtype=np.int64)
+                    store.save_column(size, "ids", tier)
+                else:
+                    parents = store.read_column(size - 1, "ids")
+
+                    spill_dir.mkdir(parents=True, exist_ok=True)
+                    path = spill_dir / f"size_{size}.ids"
+                    try:
+                        tier = expand_tier_spilled(
+                            exe, parents, path, max_memory or DEFAULT_MAX_MEMORY
+                        )
+                        store.save_column(size, "ids", tier)
+                    finally:
+                        path.unlink(missing_ok=True)
+
+                timing.rows = len(tier)
+            print_elapsed(start, f"expanded {len(tier):,} comps of size {size}")
+
+        if not store.has_column(size, "scores"):
+            start = time.time()
+            with METRICS.timer("tier", stage="scores", size=size) as timing:
+                timing.rows = sum(score_columnar(store, size, batch_size))
+            print_elapsed(start, f"scored {timing.rows:,} comps of size {size}")
+
+
+def run_storage(
+    exe: ProcessPoolExecutor, storage: Storage, max_size: int, batch_size: int
+):
+    """
+    The pipeline's stages one tier at a time on any Storage, eg a SQLite file
+
+    Slower than the Postgres-only Pipeline (no parallel writers / server-side memberships)
+    but small tiers don't need a database server. A tier that isn't marked expanded
+    is redone, the other stages only process the comps they're missing
+    """
+
+    game = storage.get_game_data()
+    matrix, score_table = get_default_score_table(game)
+
+    def memberships(ids: np.ndarray):
+        storage.insert_rows("composition_champions", comp_champ_columns(ids))
+        storage.mark_done("needs_champions", ids.tolist())
+
+    def scores(ids: np.ndarray):
+        values = calc_scores(matrix, score_table, ids)
+        storage.insert_rows("scores_by_trait", score_columns(ids, values))
+
+    # stage -> (table of pending comps, write)
+    stages = {
+        "memberships": ("needs_champions", memberships),
+        "scores": ("scores_by_trait", scores),
+    }
+
+    for size in range(1, max_size + 1):
+        if ("expand", size) not in storage.get_done_tiers():
+            start = time.time()
+            with METRICS.timer("tier", stage="expand", size=size) as timing:
+                if size == 1:
+                    tier = seed_tier(game)
+                else:
+                    tier = expand_tier(exe, storage.read_tier(size - 1))
+
+                # Anything already there is from an interrupted run
+                with storage.transaction():
+                    storage.delete_tier(size)
+                    storage.insert_tier(size, np.array(tier, dtype=np.int64))
+                    storage.mark_tier_done("expand", size)
+                timing.rows = len(tier)
+            print_elapsed(start, f"expanded {len(tier):,} comps of size {size}")
+
+        for name, (table, write) in stages.items():
+            start = time.time()
+            with METRICS.timer("tier", stage=name, size=size) as timing:
+                timing.rows = sum(
+                    process_pending(storage, table, size, batch_size, write)
+                )
+            print_elapsed(start, f"{name}: {timing.rows:,} comps of size {size}")
+
+
+# Parent comps per expand lease, a batch for each pool worker
+EXPAND_LEASE_SIZE = COMPS_PER_TIER_BATCH * N_WORKERS
+
+# The comps of a lease's range, {condition} narrows them down to the pending ones
+_FETCH_LEASE = """
+    SELECT c.id
+    FROM compositions c
+    WHERE
+        c.size = %(size)s
+        AND c.id > %(first_id)s
+        AND c.id <= %(last_id)s
+        AND {condition}
+    ORDER BY c.id
+"""
+
+# Each child has one canonical parent, so the leases' children are disjoint and
+# complete_lease() writes a lease once even if it expired and was claimed again.
+# ON CONFLICT only skips comps that were already in the tier,
+# eg from an interrupted run of pipeline.py without --distributed
+_MERGE_LEASE_EXPAND = """
+    WITH inserted AS (
+        INSERT INTO compositions (id, size)
+        SELECT id, %(size)s
+        FROM lease_expand
+        ORDER BY id
+        ON CONFLICT DO NOTHING
+        RETURNING id
+    )
+    INSERT INTO needs_champions (id_composition)
+    SELECT id FROM inserted
+"""
+
+
+def fetch_lease(
+    db: Database, lease: Lease, condition: str = "TRUE", size: int | None = None
+) -> np.ndarray:
+    params = dict(lease.params, size=lease.size if size is None else size)
+    rows = db.execute(_FETCH_LEASE.format(condition=condition), params).fetchall()
+    return np.array([r["id"] for r in rows], dtype=np.int64)
+
+
+def create_leased_stages(
+    exe: ProcessPoolExecutor, batch_size: int
+) -> list[LeasedStage]:
+    """
+    The stages of create_stages() split into leases, for pipeline.py --distributed
+    """
+
+    game = get_game_data()
+    matrix, score_table = get_default_score_table(game)
+
+    def compute_expand(db: Database, lease: Lease) -> np.ndarray:
+        if lease.size == 1:
+            return np.array(seed_tier(game), dtype=np.int64)
+
+        return expand_tier(exe, fetch_lease(db, lease, size=lease.size - 1))
+
+    def write_expand(db: Database, lease: Lease, tier: np.ndarray) -> int:
+        db.execute(
+            """
+            CREATE TEMP TABLE IF NOT EXISTS lease_expand (
+                id      BIGINT      NOT NULL
+            ) ON COMMIT DELETE ROWS
+            """
+        )
+
+        cursor = db.cursor()
+        copy_batch(cursor, "lease_expand", encode_copy_batch(dict(id=("bigint", tier))))
+        cursor.execute(_MERGE_LEASE_EXPAND, dict(size=lease.size))
+        return cursor.rowcount
+
+    def compute_memberships(db: Database, lease: Lease) -> tuple[np.ndarray, CopyBatch]:
+        ids = fetch_lease(
+            db,
+            lease,
+            "EXISTS (SELECT 1 FROM needs_champions t WHERE t.id_composition = c.id)",
+        )
+        return ids, encode_comp_champs(ids.tolist())
+
+    def write_memberships(
+        db: Database, lease: Lease, value: tuple[np.ndarray, CopyBatch]
+    ) -> int:
+        ids, rows = value
+        copy_batch(db.cursor(), "composition_champions", rows)
+        mark_done(db, "needs_champions", ids.tolist())
+        return len(ids)
+
+    def compute_score_rows(db: Database, lease: Lease) -> CopyBatch:
+        ids = fetch_lease(
+            db,
+            lease,
+            """
+            NOT EXISTS (
+                SELECT 1 FROM scores_by_trait t
+                WHERE
+                    t.id_composition = c.id
+                    AND (t.size = %(size)s OR t.size IS NULL)
+            )
+            """,
+        )
+        return encode_scores(ids, calc_scores(matrix, score_table, ids))
+
+    def copy_to(table: str) -> Callable[[Database, Lease, CopyBatch], int]:
+        def write(db: Database, lease: Lease, rows: CopyBatch) -> int:
+            copy_batch(db.cursor(), table, rows)
+            return rows.num_rows
+
+        return write
+
+    def analyze_tier(db: Database, size: int):
+        # The other stages' lease queries are planned on these stats,
+        # which autovacuum only updates some time after the tier is loaded
+        db.execute("ANALYZE compositions, needs_champions")
+
+    def after_expand(size: int) -> list[tuple[str, int]]:
+        return [("expand", size)]
+
+    return [
+        LeasedStage(
+            "expand",
+            compute_expand,
+            write_expand,
+            requires=lambda size: [("expand", size - 1)] if size > 1 else [],
+            batch_size=EXPAND_LEASE_SIZE,
+            leased_size=lambda size: size - 1,
+            finish=analyze_tier,
+        ),
+        LeasedStage(
+            "memberships",
+            compute_memberships,
+            write_memberships,
+            requires=after_expand,
+            batch_size=batch_size,
+        ),
+        LeasedStage(
+            "scores",
+            compute_score_rows,
+            copy_to("scores_by_trait"),
+            requires=after_expand,
+            batch_size=batch_size,
+        ),
+    ]
+
+
+def check_existing_tiers(db: Database):
+    """
+    Refuse to start on comps the queue mode is still expanding
+
+    expand_comps.py records its complete tiers in pipeline_tiers like the expand stage,
+    so any other tier is partial and gets redone
+    """
+
+    row = db.execute(
+        """
+        SELECT MAX(c.size) size
+        FROM compositions c
+        INNER JOIN needs_expansion ne
+            ON ne.id_composition = c.id
+        WHERE c.size < %s
+        """,
+        [MAX_TEAM_SIZE],
+    ).fetchone()
+    if row and row["size"] is not None:
+        raise Exception(
+            f"Found unexpanded comps of size {row['size']} from the queue mode, finish those with expand_comps.py --mode queue first"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run expand -> memberships -> scores one size tier at a time"
+    )
+    parser.add_argument(
+        "--report-interval",
+        type=float,
+        default=30,
+        help="seconds between progress reports",
+    )
+    parser.add_argument(
+        "--max-size",
+        type=int,
+        default=MAX_TEAM_SIZE,
+        help="stop after the tiers of this size",
+    )
+    parser.add_argument(
+        "--bulk",
+        action="store_true",
+        help=(
+            "drop the foreign keys and composition_champions' indexes while loading "
+            "and rebuild them once at the end (an interrupted run resumes in bulk mode)"
+        ),
+    )
+    parser.add_argument(
+        "--partitioned",
+        action="store_true",
+        help="when creating the tables, partition them by comp size",
+    )
+    parser.add_argument(
+        "--columnar",
+        type=Path,
+        metavar="DIR",
+        help="write the tiers and scores to memory-mapped files in DIR instead of Postgres",
+    )
+    parser.add_argument(
+        "--storage",
+        help=(
+            'run the stages one tier at a time on "sqlite:<path>", "memory" or "postgres" '
+            "instead of the concurrent Postgres pipeline"
+        ),
+    )
+    group = parser.add_argument_group("distributed")
+    group.add_argument(
+        "--distributed",
+        action="store_true",
+        help=(
+            "split each tier into leases that any number of hosts running "
+            "pipeline.py --distributed against the same db claim and process"
+        ),
+    )
+    group.add_argument(
+        "--lease-workers",
+        type=int,
+        default=1,
+        help="threads claiming leases on this host",
+    )
+    group.add_argument(
+        "--lease-timeout",
+        type=float,
+        default=LEASE_TIMEOUT,
+        help="seconds before an unfinished lease can be taken over by another worker",
+    )
+    add_batch_args(parser, COMPS_PER_ITERATION)
+    add_spill_args(parser)
+    add_metrics_args(parser)
+    args = parser.parse_args()
+
+    init_trait_weights()
+
+    if args.columnar:
+        with metrics_from_args(args), create_pool() as exe:
+            store = ColumnarStore(args.columnar)
+            run_columnar(
+                exe, store, args.max_size, args.batch_size, **spill_from_args(args)
+            )
+    elif args.storage:
+        with (
+            metrics_from_args(args),
+            create_pool() as exe,
+            open_storage(args.storage) as storage,
+        ):
+            run_storage(exe, storage, args.max_size, args.batch_size)
+    elif args.distributed:
+        init_db(args.partitioned).close()
+        with metrics_from_args(args), create_pool() as exe:
+            run_workers(
+                create_leased_stages(exe, args.batch_size),
+                list(range(1, args.max_size + 1)),
+                args.lease_workers,
+                args.lease_timeout,
+            )
+    else:
+        db = init_db(args.partitioned)
+        check_existing_tiers(db)
+        if args.bulk:
+            count = defer_constraints(db)
+            print(f"dropped {count} constraints until the load is done")
+
+        with (
+            metrics_from_args(args),
+            create_pool() as exe,
+            ParallelWriter(args.writers) as writer,
+        ):
+            pipeline = Pipeline(
+                stages=create_stages(
+                    exe,
+                    writer,
+                    args.batch_size,
+                    args.queue_depth,
+                    is_partitioned(db),
+                    **spill_from_args(args),
+                ),
+                expected_sizes={
+                    size: count
+                    for size, count in EXPECTED_TIER_SIZES.items()
+                    if size <= args.max_size
+                },
+                report_interval=args.report_interval,
+            )
+            pipeline.run()
+
+            restore_constraints(db)
+
+        db.close()
@@ -1,36 +1,54 @@
-import multiprocessing
+import argparse
 import time
 from dataclasses import dataclass
-from itertools import chain
-from typing import Iterable, TypeAlias
-
-from lib.composition import Composition
-from lib.db import DbTrait, get_all_champions, get_all_traits, init_db
-from lib.utils import print_elapsed, to_n_batches
+from typing import Callable, Iterator
+
+import numpy as np
+from lib.columnar import ColumnarStore
+from lib.composition import Composition, count_members
+from lib.db import (
+    Columns,
+    CopyBatch,
+    Database,
+    DbTrait,
+    ParallelWriter,
+    WorkSource,
+    copy_batch,
+    encode_copy_batch,
+    init_db,
+)
+from lib.game_data import GameData, get_game_data
+from lib.metrics import add_metrics_args, metrics_from_args
+from lib.pipeline import (
+    MAX_QUEUED_BATCHES,
+    add_batch_args,
+    process_batches,
+)
+from lib.scoring import (
+    TraitMatrix,
+    TraitWeights,
+    calc_scores,
+    get_score_table,
+    get_trait_matrix,
+    score_trait,
+)
+from lib.utils import print_elapsed
 from psycopg import Cursor
-from tqdm import tqdm
-
-db = init_db()
-cursor = db.cursor()
-ALL_CHAMPIONS = get_all_champions(db)
-ALL_TRAITS = get_all_traits(db)
 
-TraitWeights: TypeAlias = dict[DbTrait, list[float]]
 TRAIT_WEIGHTS: TraitWeights = dict()
 
-N_WORKERS = 8
-POOL: multiprocessing.Pool = None
+COMPS_PER_ITERATION = 1_000_000
 
 
 @dataclass
 class CompositionScore:
-    id_composition: str
+    id_composition: int
     score: float
 
 
 def init_trait_weights():
     def find_trait(name: str):
-        for trait in ALL_TRAITS.values():
+        for trait in get_game_data().traits.values():
             if trait.name == name:
                 return trait
         else:
@@ -50,43 +68,60 @@ def init_trait_weights():
     assign_weight(trait, weights)
 
 
-def find_missing_scores(limit: int) -> list[str]:
-    # Limit h
-    rows = db.execute(
-        """
-        SELECT c.id
-        FROM compositions c
-        LEFT JOIN scores_by_trait s
-            ON s.id_composition = c.id
-        WHERE
-            s.id_composition IS NULL
-        LIMIT %s 
-        """,
-        [limit],
-    ).fetchall()
-
-    return [r["id"] for r in rows]
-
-
-def _get_comps(hashes: list[str]) -> list[Composition]:
-    comps: list[Composition] = []
-    for h in hashes:
-        champ_ids = [int(id) for id in h.split(",")]
-        comps.append(Composition(champ_ids))
-
-    return comps
-
+def pending_rows(
+    name: str,
+    table: str,
+    size: int | None = None,
+    batch_size: int = COMPS_PER_ITERATION,
+    has_size: bool = False,
+) -> WorkSource:
+    """
+    Comps without a row in the table, optionally only the ones of a given size
+
+    has_size is for tables with a size column, the lookups then only
+    touch the tier's partition (when partitioned). Rows from before the column existed are NULL
+    """
+
+    size_filter = "AND c.size = %(size)s" if size is not None else ""
+    row_size_filter = (
+        "AND (t.size = %(size)s OR t.size IS NULL)"
+        if has_size and size is not None
+        else ""
+    )
 
-def get_comps(hashes: list[str]) -> list[Composition]:
-    batches = to_n_batches(hashes, N_WORKERS)
+    return WorkSource(
+        name=name if size is None else f"{name}:{size}",
+        query=f"""
+            SELECT c.id
+            FROM compositions c
+            WHERE
+                c.id > %(after)s
+                {size_filter}
+                AND NOT EXISTS (
+                    SELECT 1 FROM {table} t
+                    WHERE
+                        t.id_composition = c.id
+                        {row_size_filter}
+                )
+            ORDER BY c.id
+            LIMIT %(limit)s
+            """,
+        batch_size=batch_size,
+        params=dict(size=size),
+    )
 
-    results = list(POOL.imap_unordered(_get_comps, batches))
 
-    return list(chain(*results))
+def pending_scores(
+    size: int | None = None, batch_size: int = COMPS_PER_ITERATION
+) -> WorkSource:
+    return pending_rows(
+        "scores_by_trait", "scores_by_trait", size, batch_size, has_size=True
+    )
 
 
 def count_traits(comp: Composition) -> dict[DbTrait, int]:
-    champs = [ALL_CHAMPIONS[id] for id in comp.ids]
+    game = get_game_data()
+    champs = [game.champions[id] for id in comp.ids]
 
     counts: dict[int, int] = dict()
     for c in champs:
@@ -94,7 +129,7 @@ def count_traits(comp: Composition) -> dict[DbTrait, int]:
             counts.setdefault(id, 0)
             counts[id] += 1
 
-    return {ALL_TRAITS[id]: count for id, count in counts.items()}
+    return {game.traits[id]: count for id, count in counts.items()}
 
 
 def calc_score(comp: Composition, weights: TraitWeights) -> CompositionScore:
@@ -102,77 +137,122 @@ def calc_score(comp: Composition, weights: TraitWeights) -> CompositionScore:
 
     trait_counts = count_traits(comp)
     for trait, count in trait_counts.items():
-        overrides = weights.get(trait)
-
-        for idx, thresh in enumerate(trait.thresholds):
-            if count >= thresh:
-                if not overrides:
-                    # No weight override, use default
-                    score += 1
-                elif idx < len(overrides):
-                    # Use weight override
-                    score += overrides[idx]
-                else:
-                    # Weight overrides for trait but not this count (which is larger than max threshold)
-                    break
-            else:
-                # Thresholds are in ascending order so we stop checking when one is smaller
-                break
+        score += score_trait(trait, count, weights.get(trait))
 
     return CompositionScore(
-        id_composition=comp.hash,
+        id_composition=comp.id,
         score=score,
     )
 
 
-def _calc_scores(
-    comps: list[Composition], weights: TraitWeights
-) -> list[CompositionScore]:
-    return [calc_score(c, weights) for c in comps]
+def score_columns(comp_ids: np.ndarray, scores: np.ndarray) -> Columns:
+    return dict(
+        id_composition=("bigint", comp_ids),
+        size=("integer", count_members(comp_ids)),
+        score=("real", scores),
+    )
 
 
-def calc_scores(
-    comps: list[Composition], weights: TraitWeights
-) -> list[CompositionScore]:
-    batches = to_n_batches(comps, N_WORKERS)
-    args = [(b, weights) for b in batches]
+def encode_scores(comp_ids: np.ndarray, scores: np.ndarray) -> CopyBatch:
+    return encode_copy_batch(score_columns(comp_ids, scores))
 
-    results = list(POOL.starmap(_calc_scores, args))
 
-    return list(chain(*results))
+def insert_scores(cursor: Cursor, comp_ids: np.ndarray, scores: np.ndarray):
+    copy_batch(cursor, "scores_by_trait", encode_scores(comp_ids, scores))
 
 
-def insert_scores(cursor: Cursor, scores: Iterable[CompositionScore]):
-    params = [(s.id_composition, s.score) for s in scores]
-    with cursor.copy("COPY scores_by_trait (id_composition, score) FROM STDIN") as copy:
-        for p in params:
-            copy.write_row(p)
+def run_pass(
+    db: Database,
+    source: WorkSource,
+    table: str,
+    encode: Callable[[np.ndarray], CopyBatch],
+    writer: ParallelWriter,
+    max_queued: int = MAX_QUEUED_BATCHES,
+) -> Iterator[int]:
+    """
+    Yields the number of comps in each committed batch
 
+    encode() runs in its own thread while the next batch is fetched
+    and the previous one is written
+    """
 
-if __name__ == "__main__":
-    POOL = multiprocessing.Pool(N_WORKERS)
+    def compute(ids: list[int]) -> CopyBatch:
+        return encode(np.array(ids, dtype=np.int64))
 
-    init_trait_weights()
+    def write(writer: ParallelWriter, ids: list[int], rows: CopyBatch):
+        writer.copy(table, rows)
+
+    yield from process_batches(
+        db, source, compute, write, "scoring", writer, max_queued
+    )
 
-    while True:
-        start = time.time()
 
-        print_elapsed(start, "fetching comps to score")
-        missing = find_missing_scores(limit=1_000_000)
-        if not missing:
-            print_elapsed(start, "all comps scored")
-            break
+def get_default_score_table(game: GameData) -> tuple[TraitMatrix, np.ndarray]:
+    """
+    The trait matrix and the TRAIT_WEIGHTS score table for calc_scores()
+    """
 
-        print_elapsed(start, "building comps")
-        comps = get_comps(missing)
+    matrix = get_trait_matrix(game.champions, game.traits)
+    return matrix, get_score_table(matrix, game.traits, TRAIT_WEIGHTS)
 
-        print_elapsed(start, "calculating scores")
-        scores = calc_scores(comps, TRAIT_WEIGHTS)
 
-        print_elapsed(start, "inserting scores")
-        with db.transaction():
-            insert_scores(cursor, scores)
+def score_comps(
+    db: Database,
+    writer: ParallelWriter,
+    size: int | None = None,
+    batch_size: int = COMPS_PER_ITERATION,
+    max_queued: int = MAX_QUEUED_BATCHES,
+) -> Iterator[int]:
+    matrix, score_table = get_default_score_table(get_game_data())
 
-        print_elapsed(start, "done")
+    yield from run_pass(
+        db,
+        pending_scores(size, batch_size),
+        "scores_by_trait",
+        lambda ids: encode_scores(ids, calc_scores(matrix, score_table, ids)),
+        writer,
+        max_queued,
+    )
+
+
+def score_columnar(
+    store: ColumnarStore, size: int, batch_size: int = COMPS_PER_ITERATION
+) -> Iterator[int]:
+    """
+    score_comps() for a tier in a ColumnarStore, the ids are read from (and the scores
+    written to) memory-mapped files so only a batch of each is in memory at a time
+    """
+
+    matrix, score_table = get_default_score_table(get_game_data())
+
+    ids = store.read_column(size, "ids")
+    with store.write_column(size, "scores", len(ids)) as scores:
+        for start in range(0, len(ids), batch_size):
+            end = start + batch_size
+            scores[start:end] = calc_scores(matrix, score_table, ids[start:end])
+            yield len(scores[start:end])
+
+
+def main(batch_size: int, max_queued: int, num_writers: int):
+    db = init_db()
+
+    init_trait_weights()
+
+    with ParallelWriter(num_writers) as writer:
+        start = time.time()
+        for count in score_comps(db, writer, None, batch_size, max_queued):
+            avg = count / (time.time() - start)
+            print_elapsed(start, f"scores: {count:,} comps ({avg:.1f} it/s)")
+            start = time.time()
+
+        print_elapsed(start, "all comps have scores")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_batch_args(parser, COMPS_PER_ITERATION)
+    add_metrics_args(parser)
+    args = parser.parse_args()
 
-    db.commit()
+    with metrics_from_args(args):
+        main(args.batch_size, args.queue_depth, args.writers)
@@ -0,0 +1,213 @@
+import argparse
+import time
+
+import numpy as np
+from lib.db import Database, WorkSource, copy_batch, encode_copy_batch, init_db
+from lib.game_data import GameData, get_game_data
+from lib.profiles import (
+    ScoringProfile,
+    create_profile,
+    get_all_profiles,
+    get_profile,
+    mark_scored,
+    parse_weights,
+    set_trait_weights,
+    start_scoring,
+)
+from lib.scoring import calc_scores, get_score_table, get_trait_matrix
+from lib.utils import print_elapsed
+from psycopg import Cursor
+
+COMPS_PER_ITERATION = 1_000_000
+
+
+def pending_profile_scores(profile: ScoringProfile) -> WorkSource:
+    return WorkSource(
+        name=f"scores:{profile.name}",
+        query="""
+            SELECT c.id
+            FROM compositions c
+            WHERE
+                c.id > %(after)s
+                AND NOT EXISTS (
+                    SELECT 1 FROM scores s
+                    WHERE
+                        s.id_profile = %(id_profile)s
+                        AND s.id_composition = c.id
+                )
+            ORDER BY c.id
+            LIMIT %(limit)s
+            """,
+        batch_size=COMPS_PER_ITERATION,
+        params=dict(id_profile=profile.id),
+    )
+
+
+def stale_profile_scores(profile: ScoringProfile, mask: int) -> WorkSource:
+    # Keyed by version so a rescore interrupted by a weight change starts over
+    # instead of skipping the comps only the newly changed traits affect
+    return WorkSource(
+        name=f"rescore:{profile.name}:v{profile.version}",
+        query="""
+            SELECT id_composition id
+            FROM scores
+            WHERE
+                id_profile = %(id_profile)s
+                AND id_composition > %(after)s
+                AND id_composition & %(mask)s <> 0
+            ORDER BY id_composition
+            LIMIT %(limit)s
+            """,
+        batch_size=COMPS_PER_ITERATION,
+        params=dict(id_profile=profile.id, mask=mask),
+        wrap=False,
+    )
+
+
+def get_traits_mask(game: GameData, trait_ids: list[int]) -> int:
+    """
+    Bitmask of every champion with at least one of the traits,
+    a comp is affected by a trait's weights iff it overlaps this mask
+    """
+
+    mask = 0
+    for id in trait_ids:
+        for champ in game.champions_by_trait.get(id, []):
+            mask |= 1 << champ.id
+
+    return mask
+
+
+def insert_profile_scores(
+    cursor: Cursor, profile: ScoringProfile, comp_ids: np.ndarray, scores: np.ndarray
+):
+    rows = encode_copy_batch(
+        dict(
+            id_profile=("integer", profile.id),
+            id_composition=("bigint", comp_ids),
+            score=("real", scores),
+        )
+    )
+    copy_batch(cursor, "scores", rows)
+
+
+def update_profile_scores(
+    cursor: Cursor, profile: ScoringProfile, comp_ids: np.ndarray, scores: np.ndarray
+):
+    cursor.execute(
+        """
+        CREATE TEMP TABLE IF NOT EXISTS temp_scores (
+            id_composition      BIGINT      PRIMARY KEY,
+            score               REAL        NOT NULL
+        ) ON COMMIT DELETE ROWS
+        """
+    )
+
+    rows = encode_copy_batch(
+        dict(id_composition=("bigint", comp_ids), score=("real", scores))
+    )
+    copy_batch(cursor, "temp_scores", rows)
+
+    cursor.execute(
+        """
+        UPDATE scores s
+        SET score = t.score
+        FROM temp_scores t
+        WHERE
+            s.id_profile = %s
+            AND s.id_composition = t.id_composition
+        """,
+        [profile.id],
+    )
+
+
+def score_profile(db: Database, profile: ScoringProfile):
+    """
+    Score the comps that don't have a score for this profile yet,
+    then rescore the comps containing a trait whose weights changed since the last run
+    """
+
+    cursor = db.cursor()
+    game = get_game_data()
+
+    with db.transaction():
+        profile = start_scoring(db, profile)
+
+    matrix = get_trait_matrix(game.champions, game.traits)
+    score_table = get_score_table(matrix, game.traits, profile.to_trait_weights(game))
+
+    stale_traits = profile.stale_traits
+    mask = get_traits_mask(game, stale_traits)
+
+    passes = [(pending_profile_scores(profile), insert_profile_scores)]
+    if mask:
+        names = ", ".join(game.traits[id].name for id in stale_traits)
+        print(f"Rescoring comps with the traits: {names}")
+        passes.append((stale_profile_scores(profile, mask), update_profile_scores))
+
+    for source, write in passes:
+        start = time.time()
+        for comp_ids in source.batches(cursor):
+            ids = np.array(comp_ids, dtype=np.int64)
+            scores = calc_scores(matrix, score_table, ids)
+
+            with db.transaction():
+                write(cursor, profile, ids, scores)
+                source.save(cursor)
+
+            elapsed = time.time() - start
+            avg = len(ids) / elapsed
+            print_elapsed(start, f"{source.name}: {len(ids):,} comps ({avg:.1f} it/s)")
+
+            start = time.time()
+
+    with db.transaction():
+        mark_scored(db, profile)
+        db.execute(
+            "DELETE FROM work_checkpoints WHERE starts_with(name, %s)",
+            [f"rescore:{profile.name}:"],
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("list")
+
+    set_parser = commands.add_parser("set")
+    set_parser.add_argument("name")
+    set_parser.add_argument(
+        "weights",
+        nargs="+",
+        help='per-threshold weights, eg "Heavenly=1,0,1,0,1,0" or "Heavenly=default"',
+    )
+
+    score_parser = commands.add_parser("score")
+    score_parser.add_argument("name")
+
+    args = parser.parse_args()
+
+    db = init_db()
+    game = get_game_data()
+
+    if args.command == "list":
+        for p in get_all_profiles(db):
+            weights = {game.traits[id].name: w for id, w in p.weights.items()}
+            print(f"{p.name} (v{p.version}, scored v{p.scored_version}): {weights}")
+    elif args.command == "set":
+        with db.transaction():
+            profile = create_profile(db, args.name)
+            for arg in args.weights:
+                id_trait, weights = parse_weights(game, arg)
+                profile = set_trait_weights(db, profile, game.traits[id_trait], weights)
+    elif args.command == "score":
+        profile = get_profile(db, args.name)
+        if not profile:
+            raise Exception(f'Profile not found: "{args.name}"')
+
+        score_profile(db, profile)
+
+
+if __name__ == "__main__":
+    main()
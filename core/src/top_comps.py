@@ -0,0 +1,79 @@
+import argparse
+import time
+
+from lib.db import DbChampion, init_db
+from lib.game_data import GameData, get_game_data
+from lib.profiles import get_profile, parse_weights
+from lib.scoring import TraitWeights
+from lib.top_k import TopKConstraints, find_top_comps
+from lib.utils import print_elapsed
+
+
+def find_champion(game: GameData, name: str) -> DbChampion:
+    for champ in game.champions.values():
+        if champ.name.lower() == name.lower():
+            return champ
+    else:
+        raise Exception(f'Champion not found: "{name}"')
+
+
+def get_weights(game: GameData, args: argparse.Namespace) -> TraitWeights:
+    weights: TraitWeights = dict()
+
+    # Only a profile needs the db
+    if args.profile:
+        profile = get_profile(init_db(), args.profile)
+        if not profile:
+            raise Exception(f'Profile not found: "{args.profile}"')
+
+        weights.update(profile.to_trait_weights(game))
+
+    for arg in args.weights:
+        id_trait, values = parse_weights(game, arg)
+        trait = game.traits[id_trait]
+
+        if values is None:
+            weights.pop(trait, None)
+        else:
+            weights[trait] = values
+
+    return weights
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Find the best comps of a size without generating / scoring the whole tier"
+    )
+    parser.add_argument("size", type=int)
+    parser.add_argument("-k", type=int, default=10, help="number of comps to return")
+    parser.add_argument("--profile", help="name of a scoring profile in the db")
+    parser.add_argument(
+        "--weights",
+        nargs="*",
+        default=[],
+        help='per-threshold weights (applied over the profile), eg "Heavenly=1,0,1,0,1,0"',
+    )
+    parser.add_argument("--require", nargs="*", default=[], help="champion names")
+    parser.add_argument("--exclude", nargs="*", default=[], help="champion names")
+    parser.add_argument("--max-cost", type=int)
+    args = parser.parse_args()
+
+    game = get_game_data()
+    weights = get_weights(game, args)
+    constraints = TopKConstraints(
+        required={find_champion(game, name).id for name in args.require},
+        excluded={find_champion(game, name).id for name in args.exclude},
+        max_cost=args.max_cost,
+    )
+
+    start = time.time()
+    ranked = find_top_comps(game, weights, args.size, args.k, constraints)
+    print_elapsed(start, f"found the top {len(ranked)} comps of size {args.size}")
+
+    for idx, r in enumerate(ranked):
+        names = ", ".join(game.champions[id].name for id in r.comp.ids)
+        print(f"{idx+1:>3}. {r.score:g} (id {r.comp.id}): {names}")
+
+
+if __name__ == "__main__":
+    main()
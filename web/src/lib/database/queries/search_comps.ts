@@ -1,5 +1,6 @@
+import { sql } from 'kysely'
 import { db } from '../db'
-import { toSqliteBool } from '../utils'
+import { fromSqliteBool } from '../utils'
 
 export const PAGE_SIZE = 100
 
@@ -32,81 +33,74 @@ export interface SearchCompsOptions {
 }
 
 export interface CompositionSearchResult {
-    id: number
+    // The ids are bitmasks up to 2^59, past what a JS number holds exactly
+    id: string
     id_champions: number[]
 }
 
+type CountColumn = 'num_ap' | 'num_ad' | 'num_melee' | 'num_semi_ranged' | 'num_ranged'
+
+interface ChampionRow {
+    id: number
+    cost: number
+    range: number
+    uses_ap: 0 | 1
+    id_traits: string | null
+}
+
 export async function searchComps(opts?: SearchCompsOptions): Promise<CompositionSearchResult[]> {
-    // Select all comps
+    // Select all comps, the members are only looked up for the returned page
     let query = db
         .selectFrom('compositions as c')
-        .innerJoin('composition_champions as cc', 'cc.id_composition', 'c.id')
-        .groupBy('c.id')
-        .select(({ fn }) => [
-            'c.id',
-            fn.agg<string>('group_concat', ['cc.id_champion']).as('id_champions')
+        .select((eb) => [
+            sql<string>`CAST(c.id AS TEXT)`.as('id'),
+            eb
+                .selectFrom('composition_champions as cc')
+                .whereRef('cc.id_composition', '=', 'c.id')
+                .select(({ fn }) => fn.agg<string>('group_concat', ['cc.id_champion']).as('ids'))
+                .as('id_champions')
         ])
         .limit(PAGE_SIZE)
 
     // Filter by size
-    for (let sz of opts?.sizes ?? []) {
-        query = query.where('c.size', '=', sz)
+    if (opts?.sizes?.length) {
+        query = query.where('c.size', 'in', opts.sizes)
     }
 
     // Filter by cost
     if (opts?.max_cost) {
-        query = query
-            .innerJoin('champions as ch', 'ch.id', 'cc.id_champion')
-            .having(({ fn }) => fn.max('ch.cost'), '<=', opts.max_cost)
+        query = query.where('c.max_cost', '<=', opts.max_cost)
     }
 
     // Per-champion filters
+    // Every filter needs a different champion, so eg two AP filters need num_ap >= 2
+    const minCounts: Partial<Record<CountColumn, number>> = {}
+    const champions = await getChampions()
+
     for (let filter of opts?.champions ?? []) {
         if (filter.type === 'single') {
-            query = query.having(({ fn }) => fn.max('cc.id_champion'), '=', filter.id)
-        } else {
-            // Costs
-            if (filter.costs) {
-                query = query
-                    .innerJoin('champions as ch', 'ch.id', 'cc.id_champion')
-                    .having('ch.cost', 'in', filter.costs)
-            }
-
-            // Damage type
-            if (filter.damageType) {
-                query = query
-                    .innerJoin('champions as ch', 'ch.id', 'cc.id_champion')
-                    .having('ch.uses_ap', 'in', toSqliteBool(filter.damageType === 'ad'))
+            if (filter.id !== undefined) {
+                query = query.where(sql<number>`(c.id >> ${filter.id}) & 1`, '=', 1)
             }
-
-            // Range
-            switch (filter.rangeType) {
-                case 'melee':
-                    query = query
-                        .innerJoin('champions as ch', 'ch.id', 'cc.id_champion')
-                        .having('ch.range', '=', 1)
-                    break
-                case 'semi-ranged':
-                    query = query
-                        .innerJoin('champions as ch', 'ch.id', 'cc.id_champion')
-                        .having('ch.range', '=', 2)
-                    break
-                case 'ranged':
-                    query = query
-                        .innerJoin('champions as ch', 'ch.id', 'cc.id_champion')
-                        .having('ch.range', '>', 2)
-                    break
+        } else {
+            for (let column of getCountColumns(filter)) {
+                minCounts[column] = (minCounts[column] ?? 0) + 1
             }
 
-            // Traits
-            if (filter.traits) {
-                query = query
-                    .innerJoin('champions as ch', 'ch.id', 'cc.id_champion')
-                    .having('ch.uses_ap', 'in', toSqliteBool(filter.damageType === 'ad'))
-            }
+            // Some member has to match every condition of the filter at once,
+            // which the counts can't express so check the member bitmask (the comp id)
+            const mask = champions
+                .filter((ch) => matchesFilter(ch, filter))
+                .reduce((mask, ch) => mask | (1n << BigInt(ch.id)), 0n)
+            query = query.where(sql<number>`c.id & ${mask}`, '!=', 0)
         }
     }
 
+    // The counts are indexed so these are range scans
+    for (let [column, count] of Object.entries(minCounts)) {
+        query = query.where(sql.ref<number>(`c.${column}`), '>=', count)
+    }
+
     // Filter by offset
     if (opts?.offset) {
         query = query.offset(opts.offset)
@@ -116,8 +110,86 @@ export async function searchComps(opts?: SearchCompsOptions): Promise<Compositio
 
     const parsed = rows.map((r) => ({
         ...r,
-        id_champions: r.id_champions.split(',').map((s) => parseInt(s))
+        id_champions: (r.id_champions ?? '').split(',').map((s) => parseInt(s))
     }))
 
     return parsed
 }
+
+async function getChampions(): Promise<ChampionRow[]> {
+    return await db
+        .selectFrom('champions as ch')
+        .leftJoin('champion_traits as ct', 'ct.id_champion', 'ch.id')
+        .groupBy('ch.id')
+        .select(({ fn }) => [
+            'ch.id',
+            'ch.cost',
+            'ch.range',
+            'ch.uses_ap',
+            fn.agg<string | null>('group_concat', ['ct.id_trait']).as('id_traits')
+        ])
+        .execute()
+}
+
+function getCountColumns(filter: VariableChampionFilter): CountColumn[] {
+    const columns: CountColumn[] = []
+
+    if (filter.damageType) {
+        columns.push(filter.damageType === 'ap' ? 'num_ap' : 'num_ad')
+    }
+
+    switch (filter.rangeType) {
+        case 'melee':
+            columns.push('num_melee')
+            break
+        case 'semi-ranged':
+            columns.push('num_semi_ranged')
+            break
+        case 'ranged':
+            columns.push('num_ranged')
+            break
+    }
+
+    return columns
+}
+
+function matchesFilter(ch: ChampionRow, filter: VariableChampionFilter): boolean {
+    // Costs
+    if (filter.costs && !filter.costs.includes(ch.cost as ChampionCost)) {
+        return false
+    }
+
+    // Damage type
+    if (filter.damageType && fromSqliteBool(ch.uses_ap) !== (filter.damageType === 'ap')) {
+        return false
+    }
+
+    // Range
+    switch (filter.rangeType) {
+        case 'melee':
+            if (ch.range !== 1) return false
+            break
+        case 'semi-ranged':
+            if (ch.range !== 2) return false
+            break
+        case 'ranged':
+            if (ch.range <= 2) return false
+            break
+    }
+
+    // Traits
+    if (filter.traits) {
+        const traits = (ch.id_traits ?? '').split(',').map((s) => parseInt(s))
+        const hasTrait = (id: number) => traits.includes(id)
+
+        const matches =
+            filter.traits.mode === 'and'
+                ? filter.traits.ids.every(hasTrait)
+                : filter.traits.ids.some(hasTrait)
+        if (!matches) {
+            return false
+        }
+    }
+
+    return true
+}
@@ -44,9 +44,17 @@ export interface ChampionTraitsTable {
 export interface CompositionsTable {
     id: number
 
-    hash: string
-    is_expanded: SqliteBool
     size: SqliteInteger
+    max_cost: SqliteInteger
+    total_cost: SqliteInteger
+    num_ap: SqliteInteger
+    num_ad: SqliteInteger
+    num_melee: SqliteInteger
+    num_semi_ranged: SqliteInteger
+    num_ranged: SqliteInteger
+    // Bit N is set if the comp has a champion with trait N / trait N is active
+    trait_mask: SqliteInteger
+    active_trait_mask: SqliteInteger
 }
 
 export interface CompositionChampionsTable {